@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the time sops commands spend getting data keys, with an agent.
+
+Each run gets the data key of a document with `sops.get_key`, with an
+empty key cache, as a new `sops -d` command does. KMS is replaced by a
+fake client that answers after `--latency` milliseconds. The "before"
+numbers call KMS in every run, the "after" numbers ask a sops agent
+listening on a Unix socket, which calls KMS once.
+
+    $ python benchmarks/bench_agent.py --runs 200 --latency 50
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+from sops import agent  # noqa
+
+
+class FakeKMS(object):
+
+    def __init__(self, key, latency):
+        self.key = key
+        self.latency = latency
+        self.calls = 0
+
+    def decrypt(self, CiphertextBlob):
+        self.calls += 1
+        time.sleep(self.latency)
+        return {'Plaintext': self.key}
+
+
+def timed(tree, runs):
+    start = time.time()
+    for i in range(runs):
+        sops.KEY_CACHE.invalidate()
+        sops.get_key(tree)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=50)
+    args = parser.parse_args()
+
+    kms = FakeKMS(os.urandom(32), args.latency / 1000)
+    sops.get_aws_session_for_entry = lambda entry: kms
+    tree = {'sops': {'kms': [{'arn': 'arn:aws:kms:us-east-1:123:key/1',
+                              'enc': 'ZW5j'}]}}
+    os.environ.pop('SOPS_AGENT_SOCK', None)
+    before = timed(tree, args.runs)
+    before_calls, kms.calls = kms.calls, 0
+
+    workdir = tempfile.mkdtemp()
+    sock = os.path.join(workdir, 'agent.sock')
+    server = agent.AgentServer(sock)
+    threading.Thread(target=server.serve_forever).start()
+    os.environ['SOPS_AGENT_SOCK'] = sock
+    try:
+        after = timed(tree, args.runs)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(workdir)
+
+    print("%d runs, %dms KMS latency, milliseconds per run:" % (
+        args.runs, args.latency))
+    print("  KMS per command %8.2f (%d calls)  sops agent %8.2f "
+          "(%d calls)  (x%.1f)" % (
+              before * 1000 / args.runs, before_calls,
+              after * 1000 / args.runs, kms.calls, before / after))
+
+
+if __name__ == '__main__':
+    main()
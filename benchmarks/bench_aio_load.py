@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the time taken to load many documents from asyncio code.
+
+Each document lists `--kms` master keys, and only the last one can decrypt
+its data key, as when a service runs in a region far from the first keys
+of the document. KMS is replaced by a fake client that answers after
+`--latency` milliseconds. The "before" numbers load the documents one by
+one with `sops.load` from a coroutine, the "after" numbers gather
+`sops.aload` calls. The longest stall of the event loop is measured by a
+ticker task running alongside the loads.
+
+    $ python benchmarks/bench_aio_load.py --files 100 --kms 3 --latency 50
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+class FakeKMS(object):
+
+    def __init__(self, key, latency):
+        self.key = key
+        self.latency = latency
+
+    def decrypt(self, CiphertextBlob):
+        time.sleep(self.latency)
+        if CiphertextBlob != b'good':
+            raise Exception("AccessDeniedException")
+        return {'Plaintext': self.key}
+
+
+def make_files(workdir, count, kms, key):
+    tree = OrderedDict(("secret%d" % i, "value %d" % i) for i in range(20))
+    tree['sops'] = dict(version=sops.VERSION, kms=[
+        {'arn': 'arn:aws:kms:us-east-1:123:key/%d' % i,
+         'enc': 'Z29vZA==' if i == kms - 1 else 'YmFk'}
+        for i in range(kms)])
+    tree = sops.encrypt_tree(tree, key)
+    paths = []
+    for i in range(count):
+        path = os.path.join(workdir, "secrets%d.json" % i)
+        sops.write_file(tree, path=path, filetype='json')
+        paths.append(path)
+    return paths
+
+
+async def ticker(ticks):
+    while True:
+        ticks.append(time.time())
+        await asyncio.sleep(0.001)
+
+
+async def sequential(paths):
+    for path in paths:
+        doc = sops.load(path)
+        sops.decrypt_tree(doc.tree, doc.key)
+
+
+async def concurrent(paths):
+    async def load(path):
+        doc = await sops.aload(path)
+        await sops.adecrypt_tree(doc.tree, doc.key)
+    await asyncio.gather(*[load(path) for path in paths])
+
+
+def timed(loop, coroutine):
+    ticks = []
+    tick = loop.create_task(ticker(ticks))
+    start = time.time()
+    loop.run_until_complete(coroutine)
+    elapsed = time.time() - start
+    ticks.append(time.time())
+    tick.cancel()
+    loop.run_until_complete(asyncio.wait([tick]))
+    return elapsed, max(b - a for a, b in zip(ticks, ticks[1:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--kms', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=50)
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    kms = FakeKMS(key, args.latency / 1000)
+    sops.get_aws_session_for_entry = lambda entry: kms
+    workdir = tempfile.mkdtemp()
+    loop = asyncio.new_event_loop()
+    devnull = open(os.devnull, 'w')
+    # silence the failed master keys reported by sops
+    stderr, sys.stderr = sys.stderr, devnull
+    try:
+        paths = make_files(workdir, args.files, args.kms, key)
+        before, before_stall = timed(loop, sequential(paths))
+        after, after_stall = timed(loop, concurrent(paths))
+    finally:
+        sys.stderr = stderr
+        devnull.close()
+        loop.close()
+        shutil.rmtree(workdir)
+
+    print("%d files, %d kms keys, %dms latency:" % (
+        args.files, args.kms, args.latency))
+    print("  seconds to load        sops.load %8.2f  sops.aload %8.2f  "
+          "(x%.1f)" % (before, after, before / after))
+    print("  longest loop stall ms  sops.load %8.2f  sops.aload %8.2f" % (
+        before_stall * 1000, after_stall * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the time taken to rotate the data keys of many files.
+
+The "before" numbers rotate each file as the README used to recommend,
+with `sops -d -i` then `sops -e -i -r`, the "after" numbers run a single
+`sops -r -i --recursive` over the directory with `--jobs` processes. The
+data keys are encrypted with the PGP key of the functional tests,
+imported in a temporary GNUPGHOME.
+
+    $ python benchmarks/bench_bulk_rotation.py --files 200 --jobs 4
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import sops  # noqa
+
+FP = '1022470DE3F0BC54BC6AB62DE05550BC07FB1A0A'
+
+SOPS = [sys.executable, '-c', 'import sops; sops.main()']
+
+
+def make_files(directory, count):
+    os.mkdir(directory)
+    tree = OrderedDict(("secret%d" % i, "value %d" % i) for i in range(20))
+    tree, need_key = sops.verify_or_create_sops_branch(tree, pgp_fps=FP)
+    key, tree = sops.get_key(tree, need_key)
+    tree = sops.encrypt_tree(tree, key)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, "secrets%d.json" % i)
+        sops.write_file(tree, path=path, filetype='json')
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--jobs', type=int, default=None)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    devnull = open(os.devnull, 'w')
+    env = dict(os.environ, PYTHONPATH=ROOT, SOPS_PGP_FP=FP)
+    env.pop('SOPS_AGENT_SOCK', None)
+    try:
+        env['GNUPGHOME'] = os.environ['GNUPGHOME'] = \
+            os.path.join(workdir, 'gnupg')
+        os.mkdir(os.environ['GNUPGHOME'], 0o700)
+        subprocess.check_call(
+            ['gpg', '--batch', '--import',
+             os.path.join(ROOT, 'tests', 'sops_functional_tests_key.asc')],
+            stdout=devnull, stderr=devnull)
+        # silence sops and the gpg processes it runs in this process
+        stderr = os.dup(2)
+        os.dup2(devnull.fileno(), 2)
+        try:
+            paths = make_files(os.path.join(workdir, 'before'), args.files)
+            make_files(os.path.join(workdir, 'after'), args.files)
+        finally:
+            os.dup2(stderr, 2)
+            os.close(stderr)
+
+        command = SOPS + ['-r', '-i', '--recursive',
+                          os.path.join(workdir, 'after'),
+                          '--checkpoint', os.path.join(workdir, 'done')]
+        if args.jobs:
+            command += ['--jobs', str(args.jobs)]
+        start = time.time()
+        subprocess.check_call(command, stdout=devnull, stderr=devnull,
+                              env=env)
+        after = time.time() - start
+
+        start = time.time()
+        for path in paths:
+            subprocess.check_call(SOPS + ['-d', '-i', path], stdout=devnull,
+                                  stderr=devnull, env=env)
+            subprocess.check_call(SOPS + ['-e', '-i', '-r', path],
+                                  stdout=devnull, stderr=devnull, env=env)
+        before = time.time() - start
+    finally:
+        devnull.close()
+        shutil.rmtree(workdir)
+
+    print("%d files, seconds to rotate their data keys:" % args.files)
+    print("  sops -d -i; sops -e -i -r per file %8.2f  "
+          "sops -r -i --recursive %8.2f  (x%.1f)" %
+          (before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
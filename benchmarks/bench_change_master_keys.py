@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the time taken to add a KMS master key to many files.
+
+Each file has `--values` values and a data key known in advance, the KMS
+client is replaced by a fake that answers after `--latency` milliseconds.
+The "before" numbers do what saving the file after adding the master key
+in the editor does: decrypt every value, encrypt them again with the
+stash of their IVs, and encrypt the data key with the new master key. The
+"after" numbers use `sops.change_master_keys`, which only encrypts the data
+key, and leaves the values as they are.
+
+    $ python benchmarks/bench_change_master_keys.py --files 200
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+ARN = 'arn:aws:kms:us-east-1:123:key/1'
+
+
+class FakeKMS(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def encrypt(self, KeyId, Plaintext):
+        time.sleep(self.latency)
+        return {'CiphertextBlob': Plaintext}
+
+
+def make_files(workdir, count, values):
+    key = os.urandom(32)
+    paths = []
+    for i in range(count):
+        tree = OrderedDict(("secret%d" % j, "value %d" % j)
+                           for j in range(values))
+        tree['sops'] = OrderedDict([('version', sops.VERSION), ('pgp', [
+            OrderedDict([('fp', 'FP%d' % i), ('enc', 'pgp message')])])])
+        path = os.path.join(workdir, "secrets%d.json" % i)
+        sops.write_file(sops.encrypt_tree(tree, key), path=path,
+                        filetype='json')
+        paths.append(path)
+    return key, paths
+
+
+def with_editor(path, key):
+    tree = sops.load_file_into_tree(path, 'json')
+    stash = sops.Stash()
+    tree = sops.walk_and_decrypt(tree, key, stash=stash)
+    tree['sops']['kms'] = [{'arn': ARN}]
+    tree = sops.walk_and_encrypt(tree, key, stash=stash)
+    tree = sops.update_master_keys(tree, key)
+    sops.write_file(tree, path=path, filetype='json')
+
+
+def with_flags(path, key):
+    tree = sops.load_file_into_tree(path, 'json')
+    tree = sops.change_master_keys(tree, key, add_kms=ARN)
+    sops.write_file(tree, path=path, filetype='json')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--values', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=10)
+    args = parser.parse_args()
+
+    kms = FakeKMS(args.latency / 1000)
+    sops.get_aws_session_for_entry = lambda entry: kms
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    workdir = tempfile.mkdtemp()
+    try:
+        key, paths = make_files(workdir, args.files, args.values)
+        # silence the entries updated by sops
+        sys.stdout = devnull
+        timings = []
+        for change in (with_editor, with_flags):
+            start = time.time()
+            for path in paths:
+                change(path, key)
+            timings.append(time.time() - start)
+            key, paths = make_files(workdir, args.files, args.values)
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+        shutil.rmtree(workdir)
+
+    before, after = timings
+    print("%d files of %d values, seconds to add a KMS master key:" % (
+        args.files, args.values))
+    print("  editor %8.2f  --add-kms %8.2f  (x%.1f)" %
+          (before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
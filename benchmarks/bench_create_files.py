@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Count the KMS calls made to create new files, and time them.
+
+`--files` data keys are created for documents with one KMS master key,
+then with `--arns` of them. KMS is replaced by a fake client that counts
+the calls to each API, and answers after `--latency` milliseconds. The
+"before" numbers generate the data key locally and encrypt it with every
+master key, the "after" numbers use `sops.generate_key`, which has KMS
+generate the data key when the document has a single KMS master key.
+
+    $ python benchmarks/bench_create_files.py --files 100 --arns 3
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+class FakeKMS(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = {}
+
+    def _call(self, api):
+        self.calls[api] = self.calls.get(api, 0) + 1
+        time.sleep(self.latency)
+
+    def encrypt(self, KeyId, Plaintext):
+        self._call('Encrypt')
+        return {'CiphertextBlob': Plaintext}
+
+    def generate_data_key(self, KeyId, KeySpec):
+        self._call('GenerateDataKey')
+        key = os.urandom(32)
+        return {'Plaintext': key, 'CiphertextBlob': key}
+
+
+def local_key(tree):
+    key = os.urandom(32)
+    sops.encrypt_key_with_master_keys(key, tree)
+    return key
+
+
+def timed(kms, create, files, arns):
+    kms.calls = {}
+    start = time.time()
+    for i in range(files):
+        create({'sops': {'kms': [
+            {'arn': 'arn:aws:kms:us-east-1:123:key/%d' % i}
+            for i in range(arns)]}})
+    elapsed = time.time() - start
+    calls = ', '.join('%s %.1f' % (api, float(count) / files)
+                      for api, count in sorted(kms.calls.items()))
+    return elapsed * 1000 / files, calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=100)
+    parser.add_argument('--arns', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=20)
+    args = parser.parse_args()
+
+    kms = FakeKMS(args.latency / 1000)
+    sops.get_aws_session_for_entry = lambda entry: kms
+    print("%d files, %dms KMS latency, per file:" % (
+        args.files, args.latency))
+    for arns in sorted(set([1, args.arns])):
+        for name, create in [("local key", local_key),
+                             ("generate_key", sops.generate_key)]:
+            print("  %d ARN(s)  %-12s %8.2fms  calls: %s" % (
+                (arns, name) + timed(kms, create, args.files, arns)))
+
+
+if __name__ == '__main__':
+    main()
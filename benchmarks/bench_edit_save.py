@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the cost of saving a document after changing one value.
+
+"before" encrypts every leaf again, "after" uses the stash filled while
+decrypting, which copies the ENC strings of unchanged leaves through.
+
+    $ python benchmarks/bench_edit_save.py --leaves 30000
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import copy
+import os
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+def build_tree(leaves):
+    tree = OrderedDict()
+    for i in range(leaves // 10):
+        tree["branch%d" % i] = OrderedDict(
+            ("key%d" % j, "value-%d-%d" % (i, j)) for j in range(10))
+    tree['sops'] = dict()
+    return tree
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--leaves', type=int, default=30000)
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    tree = sops.walk_and_encrypt(build_tree(args.leaves), key)
+    stash = sops.Stash()
+    tree = sops.walk_and_decrypt(tree, key, stash=stash)
+    tree['branch0']['key0'] = 'changed'
+
+    work = copy.deepcopy(tree)
+    start = time.time()
+    sops.walk_and_encrypt(work, key)
+    before = time.time() - start
+    work = copy.deepcopy(tree)
+    start = time.time()
+    sops.walk_and_encrypt(work, key, stash=stash)
+    after = time.time() - start
+
+    print("%d leaves, one changed value, time to encrypt before saving:" %
+          args.leaves)
+    print("  before %7.3fs  after %7.3fs  (x%.2f)" %
+          (before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
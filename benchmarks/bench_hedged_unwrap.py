@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the latency of decrypting data keys when a KMS region degrades.
+
+Documents have two KMS master keys. KMS is replaced by a fake client that
+answers after `--latency` milliseconds, except for `--degraded` percent of
+the calls to the first region, which take `--slow` milliseconds. The data
+key is decrypted `--runs` times with an empty key cache, with the master
+keys tried one after the other, then hedged after `--delay` milliseconds,
+then all at once.
+
+    $ python benchmarks/bench_hedged_unwrap.py --runs 50 --degraded 20
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+class FakeKMS(object):
+
+    def __init__(self, key, latency, slow, degraded):
+        self.key = key
+        self.latency = latency
+        self.slow = slow
+        self.degraded = degraded
+
+    def decrypt(self, CiphertextBlob):
+        if CiphertextBlob == b'us-east-1' and \
+           random.random() < self.degraded:
+            time.sleep(self.slow)
+        else:
+            time.sleep(self.latency)
+        return {'Plaintext': self.key}
+
+
+def percentiles(tree, runs, delay):
+    random.seed(0)
+    latencies = []
+    for i in range(runs):
+        sops.KEY_CACHE.invalidate()
+        start = time.time()
+        sops.get_key(tree, hedge_delay=delay)
+        latencies.append(time.time() - start)
+    latencies.sort()
+    return [latencies[int(p * (runs - 1))] * 1000 for p in (0.5, 0.9, 1)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=30)
+    parser.add_argument('--slow', type=float, default=1000)
+    parser.add_argument('--degraded', type=float, default=20)
+    parser.add_argument('--delay', type=float, default=100)
+    args = parser.parse_args()
+
+    kms = FakeKMS(os.urandom(32), args.latency / 1000, args.slow / 1000,
+                  args.degraded / 100)
+    sops.get_aws_session_for_entry = lambda entry: kms
+    tree = {'sops': {'kms': [
+        {'arn': 'arn:aws:kms:%s:123:key/1' % region,
+         'enc': sops.b64encode(region.encode('utf-8')).decode('utf-8')}
+        for region in ('us-east-1', 'eu-west-1')]}}
+
+    print("%d runs, %d%% of the calls to the first region take %dms, the "
+          "others %dms:" % (args.runs, args.degraded, args.slow,
+                            args.latency))
+    print("  milliseconds       p50      p90      max")
+    for name, delay in [("in order", None),
+                        ("hedged %dms" % args.delay, args.delay / 1000),
+                        ("all at once", 0)]:
+        print("  %-12s %8.1f %8.1f %8.1f" % (
+            (name,) + tuple(percentiles(tree, args.runs, delay))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the KMS calls and time taken to load documents repeatedly.
+
+`--files` documents are loaded `--loads` times each, as a service that
+reloads its configuration does. KMS is replaced by a fake client that
+answers after `--latency` milliseconds and counts its calls. The "before"
+numbers disable the data key cache, the "after" numbers use the default
+one.
+
+    $ python benchmarks/bench_key_cache.py --files 20 --loads 10
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+class FakeKMS(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.keys = dict()
+        self.calls = 0
+
+    def decrypt(self, CiphertextBlob):
+        self.calls += 1
+        time.sleep(self.latency)
+        return {'Plaintext': self.keys[CiphertextBlob]}
+
+
+def make_files(workdir, count, kms):
+    paths = []
+    for i in range(count):
+        key = os.urandom(32)
+        kms.keys[b'blob%d' % i] = key
+        tree = OrderedDict(("secret%d" % j, "value %d" % j)
+                           for j in range(20))
+        tree['sops'] = dict(version=sops.VERSION, kms=[
+            {'arn': 'arn:aws:kms:us-east-1:123:key/1',
+             'enc': sops.b64encode(b'blob%d' % i).decode('utf-8')}])
+        tree = sops.encrypt_tree(tree, key)
+        path = os.path.join(workdir, "secrets%d.json" % i)
+        sops.write_file(tree, path=path, filetype='json')
+        paths.append(path)
+    return paths
+
+
+def timed(kms, paths, loads):
+    kms.calls = 0
+    sops.KEY_CACHE.invalidate()
+    start = time.time()
+    for i in range(loads):
+        for path in paths:
+            sops.load(path).decrypt()
+    return time.time() - start, kms.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=20)
+    parser.add_argument('--loads', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=30)
+    args = parser.parse_args()
+
+    kms = FakeKMS(args.latency / 1000)
+    sops.get_aws_session_for_entry = lambda entry: kms
+    workdir = tempfile.mkdtemp()
+    try:
+        paths = make_files(workdir, args.files, kms)
+        ttl = sops.KEY_CACHE.ttl
+        sops.KEY_CACHE.ttl = 0
+        before, before_calls = timed(kms, paths, args.loads)
+        sops.KEY_CACHE.ttl = ttl
+        after, after_calls = timed(kms, paths, args.loads)
+    finally:
+        shutil.rmtree(workdir)
+
+    print("%d files loaded %d times, %dms KMS latency:" % (
+        args.files, args.loads, args.latency))
+    print("  no cache   %6d KMS calls %8.2f seconds" % (before_calls, before))
+    print("  key cache  %6d KMS calls %8.2f seconds  (x%.1f)" % (
+        after_calls, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
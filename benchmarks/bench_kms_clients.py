@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the time taken to get KMS clients for the entries of documents.
+
+Each operation gets the KMS clients of three entries: two regions, and a
+role in one of them. boto3 clients are built for real, no request is sent
+to AWS, and STS is replaced by a fake client that answers `assume_role`
+after `--latency` milliseconds. The "before" numbers build new clients and
+assume the role in every operation, the "after" numbers reuse them from
+`sops.AWS_CLIENTS`.
+
+    $ python benchmarks/bench_kms_clients.py --operations 50
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import boto3  # noqa
+import sops  # noqa
+
+ENTRIES = [
+    {'arn': 'arn:aws:kms:us-east-1:123:key/1'},
+    {'arn': 'arn:aws:kms:eu-west-1:123:key/2'},
+    {'arn': 'arn:aws:kms:eu-west-1:456:key/3',
+     'role': 'arn:aws:iam::456:role/sops'}]
+
+
+class FakeSTS(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def assume_role(self, RoleArn, RoleSessionName):
+        time.sleep(self.latency)
+        return {'AssumedRoleUser': {'Arn': RoleArn},
+                'Credentials': {
+                    'AccessKeyId': 'AKIA', 'SecretAccessKey': 'secret',
+                    'SessionToken': 'token',
+                    'Expiration': datetime.utcfromtimestamp(
+                        time.time() + 3600)}}
+
+
+def timed(operations, reuse):
+    start = time.time()
+    for i in range(operations):
+        if not reuse:
+            sops.AWS_CLIENTS.clear()
+        for entry in ENTRIES:
+            sops.get_aws_session_for_entry(entry)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--operations', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=30)
+    args = parser.parse_args()
+
+    boto3_client = boto3.client
+    sts = FakeSTS(args.latency / 1000)
+    boto3.client = lambda service, **kwargs: \
+        sts if service == 'sts' else boto3_client(service, **kwargs)
+    devnull = open(os.devnull, 'w')
+    # silence the roles assumed by sops
+    stderr, sys.stderr = sys.stderr, devnull
+    try:
+        # load the boto3 data files once, for both runs
+        timed(1, False)
+        before = timed(args.operations, False)
+        after = timed(args.operations, True)
+    finally:
+        sys.stderr = stderr
+        devnull.close()
+
+    print("%d operations, %d KMS entries, %dms STS latency:" % (
+        args.operations, len(ENTRIES), args.latency))
+    print("  milliseconds per operation  new clients %8.2f  pool %8.2f  "
+          "(x%.1f)" % (before * 1000 / args.operations,
+                       after * 1000 / args.operations, before / after))
+
+
+if __name__ == '__main__':
+    main()
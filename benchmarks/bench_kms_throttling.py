@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure a bulk job that encrypts data keys faster than KMS allows.
+
+`--threads` threads encrypt `--keys` data keys with a KMS master key. KMS
+is replaced by a fake client that answers after `--latency` milliseconds,
+and throttles the requests above `--quota` per second. The "before"
+numbers don't limit or retry the requests, as when throttled master keys
+were skipped, the "after" numbers use `sops.KMS_LIMITER`, first with
+retries only, then with its rate set to `--rate`.
+
+    $ python benchmarks/bench_kms_throttling.py --keys 2000 --quota 200
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+class Throttled(Exception):
+    response = {'Error': {'Code': 'ThrottlingException'}}
+
+
+class FakeKMS(object):
+
+    def __init__(self, quota, latency):
+        self.quota = quota
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.tokens = quota
+        self.time = time.time()
+
+    def encrypt(self, KeyId, Plaintext):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.quota,
+                              self.tokens + (now - self.time) * self.quota)
+            self.time = now
+            throttled = self.tokens < 1
+            if not throttled:
+                self.tokens -= 1
+        time.sleep(self.latency)
+        if throttled:
+            raise Throttled("Rate exceeded")
+        return {'CiphertextBlob': Plaintext}
+
+
+def run(kms, keys, threads, limiter):
+    sops.KMS_LIMITER = limiter
+    time.sleep(1)
+    kms.tokens = kms.quota
+    entry = {'arn': 'arn:aws:kms:us-east-1:123:key/1'}
+
+    def encrypt(i):
+        return 'enc' in sops.encrypt_key_with_kms(os.urandom(32),
+                                                  dict(entry))
+    start = time.time()
+    pool = ThreadPool(threads)
+    try:
+        encrypted = sum(pool.map(encrypt, range(keys)))
+    finally:
+        pool.close()
+    elapsed = time.time() - start
+    stats = limiter.stats().get('us-east-1', {})
+    return (encrypted, keys - encrypted, encrypted / elapsed,
+            stats.get('requests', 0), stats.get('throttles', 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--keys', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--quota', type=float, default=200)
+    parser.add_argument('--rate', type=float, default=180)
+    parser.add_argument('--latency', type=float, default=20)
+    args = parser.parse_args()
+
+    kms = FakeKMS(args.quota, args.latency / 1000)
+    sops.get_aws_session_for_entry = lambda entry: kms
+    devnull = open(os.devnull, 'w')
+    # silence the master keys skipped by sops
+    stderr, sys.stderr = sys.stderr, devnull
+    try:
+        results = [
+            ("no limiter", run(kms, args.keys, args.threads,
+                               sops.KmsRateLimiter(retries=0))),
+            ("retries", run(kms, args.keys, args.threads,
+                            sops.KmsRateLimiter())),
+            ("%d/s" % args.rate, run(kms, args.keys, args.threads,
+                                     sops.KmsRateLimiter(rate=args.rate)))]
+    finally:
+        sys.stderr = stderr
+        devnull.close()
+
+    print("%d keys, %d threads, KMS quota %d/s at %dms:" % (
+        args.keys, args.threads, args.quota, args.latency))
+    print("  %-12s %9s %8s %10s %9s %9s" % (
+        "", "encrypted", "skipped", "keys/s", "requests", "throttles"))
+    for name, result in results:
+        print("  %-12s %9d %8d %10.1f %9d %9d" % ((name,) + result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the latency of reading a single value out of a large document.
+
+"before" decrypts the whole tree with `sops.walk_and_decrypt`, "after"
+reads the value through a `sops.LazyTree`.
+
+    $ python benchmarks/bench_lazy_tree.py --leaves 20000
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import copy
+import os
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+def build_tree(leaves):
+    tree = OrderedDict()
+    for i in range(leaves // 10):
+        tree["branch%d" % i] = OrderedDict(
+            ("key%d" % j, "value-%d-%d" % (i, j)) for j in range(10))
+    tree['sops'] = dict()
+    return tree
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--leaves', type=int, default=20000)
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    tree = sops.walk_and_encrypt(build_tree(args.leaves), key)
+    last = "branch%d" % (args.leaves // 10 - 1)
+
+    work = copy.deepcopy(tree)
+    start = time.time()
+    value = sops.walk_and_decrypt(work, key)[last]['key9']
+    before = time.time() - start
+    start = time.time()
+    assert sops.LazyTree(tree, key)[last]['key9'] == value
+    after = time.time() - start
+
+    print("%d leaves, time to read one value:" % args.leaves)
+    print("  before %9.6fs  after %9.6fs  (x%.0f)" %
+          (before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the number of leaves encrypted and decrypted per second.
+
+The "before" numbers come from a copy of the per-leaf implementation that
+compiled the ENC regex and created a Cipher object for every value. The
+"after" numbers use the per-document `sops.LeafCipher`.
+
+    $ python benchmarks/bench_leaf_cipher.py --leaves 20000
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import re
+import sys
+import time
+from base64 import b64encode, b64decode
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+from cryptography.hazmat.backends import default_backend  # noqa
+from cryptography.hazmat.primitives.ciphers import (  # noqa
+    Cipher, modes, algorithms)
+
+
+def legacy_encrypt(value, key, aad=b''):
+    value = str(value).encode('utf-8')
+    iv = os.urandom(32)
+    encryptor = Cipher(algorithms.AES(key), modes.GCM(iv),
+                       default_backend()).encryptor()
+    encryptor.authenticate_additional_data(aad)
+    enc_value = encryptor.update(value) + encryptor.finalize()
+    return "ENC[AES256_GCM,data:{value},iv:{iv}," \
+        "tag:{tag},type:{valtype}]".format(
+            value=b64encode(enc_value).decode('utf-8'),
+            iv=b64encode(iv).decode('utf-8'),
+            tag=b64encode(encryptor.tag).decode('utf-8'),
+            valtype='str')
+
+
+def legacy_decrypt(value, key, aad=b''):
+    valre = b'^ENC\\[AES256_GCM,data:(.+),iv:(.+),tag:(.+)'
+    valre += b',type:(.+)'
+    valre += b'\\]'
+    res = re.match(valre, value.encode('utf-8'))
+    if res is None:
+        return value
+    enc_value = b64decode(res.group(1))
+    iv = b64decode(res.group(2))
+    tag = b64decode(res.group(3))
+    decryptor = Cipher(algorithms.AES(key), modes.GCM(iv, tag),
+                       default_backend()).decryptor()
+    decryptor.authenticate_additional_data(aad)
+    return (decryptor.update(enc_value) + decryptor.finalize()).decode('utf-8')
+
+
+def rate(func, values, aads):
+    start = time.time()
+    for value, aad in zip(values, aads):
+        func(value, aad)
+    return len(values) / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--leaves', type=int, default=20000)
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    cleartexts = ["value-%d-%s" % (i, "x" * 24) for i in range(args.leaves)]
+    aads = [("key%d:" % i).encode('utf-8') for i in range(args.leaves)]
+    cipher = sops.LeafCipher(key)
+
+    enc_before = rate(lambda v, a: legacy_encrypt(v, key, aad=a),
+                      cleartexts, aads)
+    enc_after = rate(lambda v, a: cipher.encrypt(v, aad=a), cleartexts, aads)
+    encrypted = [cipher.encrypt(v, aad=a) for v, a in zip(cleartexts, aads)]
+    dec_before = rate(lambda v, a: legacy_decrypt(v, key, aad=a),
+                      encrypted, aads)
+    dec_after = rate(lambda v, a: cipher.decrypt(v, aad=a), encrypted, aads)
+
+    print("%d leaves, leaves per second:" % args.leaves)
+    print("  encrypt  before %10.0f  after %10.0f  (x%.2f)" %
+          (enc_before, enc_after, enc_after / enc_before))
+    print("  decrypt  before %10.0f  after %10.0f  (x%.2f)" %
+          (dec_before, dec_after, dec_after / dec_before))
+
+
+if __name__ == '__main__':
+    main()
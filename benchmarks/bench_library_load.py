@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the time taken to decrypt many files at the start of a service.
+
+The "before" numbers run one `sops -d` process per file, the "after"
+numbers load and decrypt every file in process with `sops.load`. The data
+keys are encrypted with the PGP key of the functional tests, imported in a
+temporary GNUPGHOME, so both cases run gpg once per file.
+
+    $ python benchmarks/bench_library_load.py --files 200
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import sops  # noqa
+
+FP = '1022470DE3F0BC54BC6AB62DE05550BC07FB1A0A'
+
+
+def make_files(workdir, count):
+    tree = OrderedDict(("secret%d" % i, "value %d" % i) for i in range(20))
+    tree, need_key = sops.verify_or_create_sops_branch(tree, pgp_fps=FP)
+    key, tree = sops.get_key(tree, need_key)
+    tree = sops.encrypt_tree(tree, key)
+    paths = []
+    for i in range(count):
+        path = os.path.join(workdir, "secrets%d.json" % i)
+        sops.write_file(tree, path=path, filetype='json')
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=50)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    devnull = open(os.devnull, 'w')
+    try:
+        os.environ['GNUPGHOME'] = os.path.join(workdir, 'gnupg')
+        os.mkdir(os.environ['GNUPGHOME'], 0o700)
+        subprocess.check_call(
+            ['gpg', '--batch', '--import',
+             os.path.join(ROOT, 'tests', 'sops_functional_tests_key.asc')],
+            stdout=devnull, stderr=devnull)
+        # silence sops and the gpg processes it runs in this process
+        stderr = os.dup(2)
+        os.dup2(devnull.fileno(), 2)
+        try:
+            paths = make_files(workdir, args.files)
+            start = time.time()
+            for path in paths:
+                sops.load(path).decrypt()
+            after = time.time() - start
+        finally:
+            os.dup2(stderr, 2)
+            os.close(stderr)
+
+        start = time.time()
+        for path in paths:
+            subprocess.check_call(
+                [sys.executable, os.path.join(ROOT, 'sops', '__init__.py'),
+                 '-d', path], stdout=devnull, stderr=devnull)
+        before = time.time() - start
+    finally:
+        devnull.close()
+        shutil.rmtree(workdir)
+
+    print("%d files, seconds to decrypt them all:" % args.files)
+    print("  sops -d per file %8.2f  sops.load %8.2f  (x%.1f)" %
+          (before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
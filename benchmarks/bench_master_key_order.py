@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the time taken to decrypt data keys far from the first region.
+
+Documents have KMS master keys in `--regions` regions, and the machine is
+close to the last one. KMS is replaced by a fake client that answers
+after `--far` milliseconds, or `--near` milliseconds in the last region.
+The data key is decrypted `--runs` times with an empty key cache. The
+"before" numbers try the master keys in the order of the document, the
+"after" numbers in the order of the master key statistics, starting
+without any.
+
+    $ python benchmarks/bench_master_key_order.py --runs 100
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+class FakeKMS(object):
+
+    def __init__(self, key, near, far, near_region):
+        self.key = key
+        self.near = near
+        self.far = far
+        self.near_region = near_region
+
+    def decrypt(self, CiphertextBlob):
+        if CiphertextBlob == self.near_region:
+            time.sleep(self.near)
+        else:
+            time.sleep(self.far)
+        return {'Plaintext': self.key}
+
+
+class DocumentOrder(sops.MasterKeyStats):
+
+    def record(self, kind, entry, success, latency):
+        pass
+
+    def rank(self, kind, entry):
+        return (0, 0)
+
+
+def timed(tree, runs):
+    start = time.time()
+    for i in range(runs):
+        sops.KEY_CACHE.invalidate()
+        sops.get_key(tree)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--regions', type=int, default=3)
+    parser.add_argument('--near', type=float, default=10)
+    parser.add_argument('--far', type=float, default=150)
+    args = parser.parse_args()
+
+    regions = ['region-%d' % i for i in range(args.regions)]
+    kms = FakeKMS(os.urandom(32), args.near / 1000, args.far / 1000,
+                  regions[-1].encode('utf-8'))
+    sops.get_aws_session_for_entry = lambda entry: kms
+    tree = {'sops': {'kms': [
+        {'arn': 'arn:aws:kms:%s:123:key/1' % region,
+         'enc': sops.b64encode(region.encode('utf-8')).decode('utf-8')}
+        for region in regions]}}
+
+    sops.MASTER_KEY_STATS = DocumentOrder()
+    before = timed(tree, args.runs)
+    sops.MASTER_KEY_STATS = sops.MasterKeyStats()
+    after = timed(tree, args.runs)
+
+    print("%d runs, %d regions at %dms, the last one at %dms:" % (
+        args.runs, args.regions, args.far, args.near))
+    print("  milliseconds per data key  document order %8.2f  "
+          "fastest first %8.2f  (x%.1f)" % (
+              before * 1000 / args.runs, after * 1000 / args.runs,
+              before / after))
+
+
+if __name__ == '__main__':
+    main()
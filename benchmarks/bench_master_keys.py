@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the time taken to encrypt a new data key with many master keys.
+
+Documents have `--kms` KMS master keys, replaced by a fake client that
+answers after `--latency` milliseconds, and `--pgp` PGP master keys, all
+with the PGP key of the functional tests imported in a temporary
+GNUPGHOME, so gpg runs for real. The "before" numbers use one worker, as
+when the master keys were called one after the other, the "after" numbers
+use the default MASTER_KEY_WORKERS: the KMS keys are called concurrently,
+and the PGP keys in one gpg process alongside them.
+
+    $ python benchmarks/bench_master_keys.py --kms 6 --pgp 10
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import sops  # noqa
+
+FP = '1022470DE3F0BC54BC6AB62DE05550BC07FB1A0A'
+
+
+class FakeKMS(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def encrypt(self, KeyId, Plaintext):
+        time.sleep(self.latency)
+        return {'CiphertextBlob': Plaintext}
+
+
+def timed(kms, pgp, runs=3):
+    best = None
+    for i in range(runs):
+        tree = {'sops': {
+            'kms': [{'arn': 'arn:aws:kms:us-east-1:123:key/%d' % i}
+                    for i in range(kms)],
+            'pgp': [{'fp': FP} for i in range(pgp)]}}
+        start = time.time()
+        sops.get_key(tree, need_key=True)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--kms', type=int, default=6)
+    parser.add_argument('--pgp', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=100)
+    args = parser.parse_args()
+
+    kms = FakeKMS(args.latency / 1000)
+    sops.get_aws_session_for_entry = lambda entry: kms
+    workdir = tempfile.mkdtemp()
+    devnull = open(os.devnull, 'w')
+    try:
+        os.environ['GNUPGHOME'] = os.path.join(workdir, 'gnupg')
+        os.mkdir(os.environ['GNUPGHOME'], 0o700)
+        subprocess.check_call(
+            ['gpg', '--batch', '--import',
+             os.path.join(ROOT, 'tests', 'sops_functional_tests_key.asc')],
+            stdout=devnull, stderr=devnull)
+        # silence sops and the gpg processes it runs in this process
+        stderr = os.dup(2)
+        os.dup2(devnull.fileno(), 2)
+        try:
+            workers = sops.MASTER_KEY_WORKERS
+            sops.MASTER_KEY_WORKERS = 1
+            before = timed(args.kms, args.pgp)
+            sops.MASTER_KEY_WORKERS = workers
+            after = timed(args.kms, args.pgp)
+        finally:
+            os.dup2(stderr, 2)
+            os.close(stderr)
+    finally:
+        devnull.close()
+        shutil.rmtree(workdir)
+
+    print("%d KMS keys at %dms, %d PGP keys, seconds to encrypt a new data "
+          "key:" % (args.kms, args.latency, args.pgp))
+    print("  one after the other %8.2f  concurrently %8.2f  (x%.1f)" %
+          (before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
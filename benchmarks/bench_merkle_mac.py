@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the cost of checking and updating one value, by MAC format.
+
+Documents are trees of branches with `--fanout` items, from depth 2 to
+`--depth`. With a sha512 MAC, checking one value decrypts the whole
+document, and updating one value decrypts and encrypts it again as edit
+mode does. With a merkle MAC, only the branches along the path of the
+value are hashed, so the cost follows the depth of the value instead of
+the size of the document.
+
+    $ python benchmarks/bench_merkle_mac.py --fanout 10 --depth 5
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import copy
+import os
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+def build_tree(fanout, depth):
+    def branch(level):
+        if level == depth:
+            return OrderedDict(("key%d" % i, "value %d" % i)
+                               for i in range(fanout))
+        return OrderedDict(("branch%d" % i, branch(level + 1))
+                           for i in range(fanout))
+    tree = branch(1)
+    tree['sops'] = dict(version=sops.VERSION)
+    return tree
+
+
+def timed(func, runs=3):
+    best = None
+    for i in range(runs):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def sha512_update(tree, key, path, aad):
+    tree = copy.deepcopy(tree)
+
+    def update():
+        stash = sops.Stash()
+        sops.walk_and_decrypt(tree, key, stash=stash)
+        parent = sops.truncate_tree(tree, sops.format_tree_path(path[:-1]))
+        parent[path[-1]] = "new value"
+        sops.walk_and_encrypt(tree, key, stash=stash)
+    return update
+
+
+def merkle_update(tree, key, path, aad):
+    cipher = sops.LeafCipher(key)
+    parent = sops.truncate_tree(tree, sops.format_tree_path(path[:-1]))
+
+    def update():
+        parent[path[-1]] = cipher.encrypt("new value", aad=aad)
+        sops.store_merkle_mac(tree, cipher, [path])
+    return update
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fanout', type=int, default=10)
+    parser.add_argument('--depth', type=int, default=5)
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    print("fanout %d, milliseconds to check and to update the last value:" %
+          args.fanout)
+    print("%6s %8s  %12s %12s  %12s %12s" % (
+        "depth", "values", "sha512 check", "merkle check",
+        "sha512 update", "merkle update"))
+    for depth in range(2, args.depth + 1):
+        path = tuple("branch%d" % (args.fanout - 1)
+                     for i in range(depth - 1)) + \
+            ("key%d" % (args.fanout - 1),)
+        aad = b''.join(k.encode('utf-8') + b':' for k in path)
+        trees = dict()
+        for mac_format in sops.MAC_FORMATS:
+            tree = build_tree(args.fanout, depth)
+            sops.set_mac_format(tree, mac_format)
+            trees[mac_format] = sops.walk_and_encrypt(tree, key)
+        sha512_check = timed(
+            lambda: sops.LazyTree(trees['sha512'], key).verify())
+        merkle_check = timed(
+            lambda: sops.LazyTree(trees['merkle'], key).verify(
+                [sops.format_tree_path(path)]))
+        sha512_upd = timed(sha512_update(trees['sha512'], key, path, aad),
+                           runs=1)
+        merkle_upd = timed(merkle_update(trees['merkle'], key, path, aad))
+        print("%6d %8d  %12.2f %12.2f  %12.2f %12.2f" % (
+            depth, args.fanout ** depth, sha512_check * 1000,
+            merkle_check * 1000, sha512_upd * 1000, merkle_upd * 1000))
+
+
+if __name__ == '__main__':
+    main()
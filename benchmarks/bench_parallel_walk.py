@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Compare serial and thread pool walkers on a large document.
+
+    $ python benchmarks/bench_parallel_walk.py --leaves 50000 --jobs 1 2 4
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import copy
+import os
+import sys
+import time
+from base64 import b64encode
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+def random_value(size):
+    return b64encode(os.urandom(size * 3 // 4)).decode('utf-8')
+
+
+def build_tree(leaves, size):
+    tree = OrderedDict()
+    for i in range(leaves // 10):
+        tree["branch%d" % i] = OrderedDict(
+            ("key%d" % j, random_value(size) if size else "v%d" % j)
+            for j in range(10))
+    tree['sops'] = dict()
+    return tree
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--leaves', type=int, default=50000)
+    parser.add_argument('--size', type=int, default=0,
+                        help="size of each value in bytes")
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    tree = build_tree(args.leaves, args.size)
+    for jobs in args.jobs:
+        work = copy.deepcopy(tree)
+        start = time.time()
+        sops.walk_and_encrypt(work, key, jobs=jobs)
+        enc = time.time() - start
+        start = time.time()
+        sops.walk_and_decrypt(work, key, jobs=jobs)
+        dec = time.time() - start
+        print("jobs=%-3d encrypt %7.3fs  decrypt %7.3fs" % (jobs, enc, dec))
+
+
+if __name__ == '__main__':
+    main()
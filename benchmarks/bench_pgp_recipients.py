@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the time taken to encrypt data keys with many PGP master keys.
+
+`--recipients` PGP keys are generated in a temporary GNUPGHOME, and
+`--keys` data keys are encrypted with all of them, so gpg runs for real.
+The "before" numbers run gpg once per PGP key, with encrypt_key_with_pgp,
+the "after" numbers run it once for all of them, with
+encrypt_key_with_pgp_entries.
+
+    $ python benchmarks/bench_pgp_recipients.py --recipients 10 --keys 20
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+def timed(encrypt, fps, keys):
+    popen = subprocess.Popen
+    processes = []
+
+    def counted(*args, **kwargs):
+        processes.append(args[0])
+        return popen(*args, **kwargs)
+    sops.subprocess.Popen = counted
+    try:
+        start = time.time()
+        for i in range(keys):
+            entries = encrypt(os.urandom(32), [{'fp': fp} for fp in fps])
+            assert all(entry.get('enc') for entry in entries)
+        elapsed = time.time() - start
+    finally:
+        sops.subprocess.Popen = popen
+    return elapsed * 1000 / keys, float(len(processes)) / keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--recipients', type=int, default=10)
+    parser.add_argument('--keys', type=int, default=20)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    devnull = open(os.devnull, 'w')
+    os.environ['GNUPGHOME'] = os.path.join(workdir, 'gnupg')
+    os.mkdir(os.environ['GNUPGHOME'], 0o700)
+    try:
+        for i in range(args.recipients):
+            subprocess.check_call(
+                ['gpg', '--batch', '--passphrase', '', '--quick-gen-key',
+                 'sops bench %d' % i, 'future-default', 'default', 'never'],
+                stdout=devnull, stderr=devnull)
+        listing = subprocess.Popen(
+            ['gpg', '--with-colons', '--fixed-list-mode', '--list-keys'],
+            stdout=subprocess.PIPE, stderr=devnull).communicate()[0]
+        lines = listing.decode('utf-8').splitlines()
+        fps = [lines[n + 1].split(':')[9] for n, line in enumerate(lines)
+               if line.startswith('pub')]
+        # silence the gpg processes run by sops
+        stderr = os.dup(2)
+        os.dup2(devnull.fileno(), 2)
+        try:
+            before = timed(lambda key, entries: [
+                sops.encrypt_key_with_pgp(key, entry) for entry in entries],
+                fps, args.keys)
+            after = timed(sops.encrypt_key_with_pgp_entries, fps, args.keys)
+        finally:
+            os.dup2(stderr, 2)
+            os.close(stderr)
+        subprocess.call(['gpgconf', '--kill', 'gpg-agent'],
+                        stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
+        shutil.rmtree(workdir)
+
+    print("%d data keys, %d PGP keys, per data key:" % (
+        args.keys, args.recipients))
+    print("  one gpg per key  %8.1fms %5.1f processes" % before)
+    print("  one gpg for all  %8.1fms %5.1f processes  (x%.1f)" % (
+        after + (before[0] / after[0],)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the time taken to decrypt every file of a directory.
+
+The "before" numbers run one `sops -d` process per file, the "after"
+numbers run a single `sops -d --recursive` over the directory with
+`--jobs` processes. The files share a data key, encrypted with the PGP key
+of the functional tests imported in a temporary GNUPGHOME: one gpg process
+is run per file before, and once in total after, by the agent that serves
+the data keys to the worker processes.
+
+    $ python benchmarks/bench_recursive.py --files 500 --jobs 4
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+import sops  # noqa
+
+FP = '1022470DE3F0BC54BC6AB62DE05550BC07FB1A0A'
+
+SOPS = [sys.executable, '-c', 'import sops; sops.main()']
+
+
+def make_files(directory, count):
+    tree = OrderedDict(("secret%d" % i, "value %d" % i) for i in range(20))
+    tree, need_key = sops.verify_or_create_sops_branch(tree, pgp_fps=FP)
+    key, tree = sops.get_key(tree, need_key)
+    tree = sops.encrypt_tree(tree, key)
+    paths = []
+    for i in range(count):
+        # spread the files over directories of 100 files
+        path = os.path.join(directory, "d%d" % (i // 100),
+                            "secrets%d.json" % i)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        sops.write_file(tree, path=path, filetype='json')
+        paths.append(path)
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--jobs', type=int, default=None)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    devnull = open(os.devnull, 'w')
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.pop('SOPS_AGENT_SOCK', None)
+    try:
+        env['GNUPGHOME'] = os.environ['GNUPGHOME'] = \
+            os.path.join(workdir, 'gnupg')
+        os.mkdir(os.environ['GNUPGHOME'], 0o700)
+        subprocess.check_call(
+            ['gpg', '--batch', '--import',
+             os.path.join(ROOT, 'tests', 'sops_functional_tests_key.asc')],
+            stdout=devnull, stderr=devnull)
+        # silence sops and the gpg processes it runs in this process
+        stderr = os.dup(2)
+        os.dup2(devnull.fileno(), 2)
+        try:
+            paths = make_files(os.path.join(workdir, 'src'), args.files)
+        finally:
+            os.dup2(stderr, 2)
+            os.close(stderr)
+
+        command = SOPS + ['-d', '--recursive', os.path.join(workdir, 'src'),
+                          '--output-dir', os.path.join(workdir, 'out')]
+        if args.jobs:
+            command += ['--jobs', str(args.jobs)]
+        start = time.time()
+        subprocess.check_call(command, stdout=devnull, stderr=devnull,
+                              env=env)
+        after = time.time() - start
+
+        start = time.time()
+        for path in paths:
+            subprocess.check_call(SOPS + ['-d', path], stdout=devnull,
+                                  stderr=devnull, env=env)
+        before = time.time() - start
+    finally:
+        devnull.close()
+        shutil.rmtree(workdir)
+
+    print("%d files, seconds to decrypt them all:" % args.files)
+    print("  sops -d per file %8.2f  sops -d --recursive %8.2f  (x%.1f)" %
+          (before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the time taken to change one value of a document.
+
+The "edit" numbers follow what edit mode does: decrypt the tree with a
+stash, write it to a temporary file, load it back and encrypt it again.
+The "--set" numbers use `sops.update_tree`, on documents with a sha512
+and with a merkle MAC. Writing the document back is left out of both.
+
+    $ python benchmarks/bench_set_value.py --leaves 10000
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import copy
+import os
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+def build_tree(leaves, mac_format):
+    tree = OrderedDict()
+    for i in range(leaves // 10):
+        tree["branch%d" % i] = OrderedDict(
+            ("key%d" % j, "value %d %d" % (i, j)) for j in range(10))
+    tree['sops'] = dict(version=sops.VERSION)
+    sops.set_mac_format(tree, mac_format)
+    return tree
+
+
+def edit(tree, key, path, value):
+    stash = sops.Stash()
+    tree = sops.walk_and_decrypt(tree, key, stash=stash)
+    tmppath = sops.write_file(tree, filetype='json')
+    tree = sops.load_file_into_tree(tmppath, 'json',
+                                    restore_sops=tree['sops'])
+    os.remove(tmppath)
+    tree[path[0]][path[1]] = value
+    return sops.walk_and_encrypt(tree, key, stash=stash)
+
+
+def timed(func, tree):
+    tree = copy.deepcopy(tree)
+    start = time.time()
+    func(tree)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--leaves', type=int, default=10000)
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    path = ("branch%d" % (args.leaves // 20), "key5")
+    print("%d leaves, milliseconds to set one value:" % args.leaves)
+    for mac_format in sops.MAC_FORMATS:
+        tree = sops.walk_and_encrypt(build_tree(args.leaves, mac_format), key)
+        before = timed(lambda t: edit(t, key, path, "new value"), tree)
+        after = timed(lambda t: sops.update_tree(t, key,
+                                                 [(path, "new value")]),
+                      tree)
+        print("  %-6s mac  edit %10.2f  --set %10.2f  (x%.1f)" %
+              (mac_format, before * 1000, after * 1000, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the time taken to import sops when the CLI starts.
+
+Each run imports sops in a new interpreter with `python -X importtime`
+and reads the cumulative time of the `sops` module. The "before" numbers
+also import boto3 and ruamel.yaml, as sops did at module load, the "after"
+numbers import sops alone. The script fails if importing sops loads one of
+`--forbid` modules, or if the median import time is over `--max-ms`, so it
+can guard against regressions in CI.
+
+    $ python benchmarks/bench_startup.py --runs 20 --max-ms 150
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def import_time(modules):
+    """Import modules in a new interpreter with -X importtime, return the
+    total of their cumulative times in ms, and the modules imported.
+    """
+    code = "import %s" % ", ".join(modules)
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=ROOT, stderr=subprocess.PIPE)
+    err = proc.communicate()[1].decode('utf-8')
+    if proc.returncode != 0:
+        raise SystemExit(err)
+    total = 0
+    imported = set()
+    for line in err.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            # the header line
+            continue
+        name = name.strip()
+        imported.add(name)
+        if name in modules:
+            total += int(cumulative)
+    return total / 1000.0, imported
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help="fail if importing sops takes longer")
+    parser.add_argument('--forbid', nargs='*',
+                        default=['boto3', 'botocore', 'ruamel.yaml'],
+                        help="fail if importing sops imports these modules")
+    args = parser.parse_args()
+    if sys.version_info < (3, 7):
+        raise SystemExit("-X importtime needs python 3.7")
+
+    before = median([import_time(['boto3', 'ruamel.yaml', 'sops'])[0]
+                     for _ in range(args.runs)])
+    runs = [import_time(['sops']) for _ in range(args.runs)]
+    after = median([ms for ms, _ in runs])
+    imported = set.union(*[names for _, names in runs])
+
+    print("%d runs, median ms to import sops:" % args.runs)
+    print("  eager imports %8.1f  lazy imports %8.1f  (x%.1f)" %
+          (before, after, before / after))
+    failed = False
+    for name in args.forbid:
+        if name in imported:
+            print("FAIL: importing sops imports %s" % name)
+            failed = True
+    if args.max_ms is not None and after > args.max_ms:
+        print("FAIL: importing sops takes %.1f ms, over %.1f ms" %
+              (after, args.max_ms))
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
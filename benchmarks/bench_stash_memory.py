@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the memory used by the edit mode stash while decrypting a tree.
+
+The "before" numbers come from the nested stash of dicts that kept a copy
+of the cleartext of every leaf, the "after" numbers from `sops.Stash`,
+which keeps the ENC string of every leaf to copy unchanged values through.
+Memory is measured with tracemalloc (python 3.4+), traced from before the
+encrypted tree is loaded so that the ENC strings a stash keeps alive are
+counted, while those freed as the leaves are decrypted are not. The cost
+of a stash is the memory left allocated by decrypting the tree with it,
+minus that left by decrypting the tree without one.
+
+    $ python benchmarks/bench_stash_memory.py --leaves 50000 --size 2048
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import json
+import os
+import sys
+import tracemalloc
+from base64 import b64encode, b64decode
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import sops  # noqa
+
+
+def build_tree(leaves, size):
+    tree = OrderedDict()
+    for i in range(leaves // 10):
+        tree["branch%d" % i] = OrderedDict(
+            ("key%d" % j,
+             b64encode(os.urandom(size * 3 // 4)).decode('utf-8'))
+            for j in range(10))
+    tree['sops'] = dict()
+    return tree
+
+
+def legacy_decrypt(tree, key):
+    """Decrypt the tree and fill a stash the way edit mode used to."""
+    cipher = sops.LeafCipher(key)
+    stash = dict()
+
+    def operation(value, aad, ignored, path):
+        iv = b64decode(cipher.split(value)[1])
+        value, cleartext = cipher.open(value, aad)
+        node = stash
+        for k in path:
+            node = node.setdefault(k, {'has_stash': True})
+        node['iv'] = iv
+        node['aad'] = aad
+        node['cleartext'] = cleartext
+        return value, cleartext
+
+    sops.walk_leaves(tree, operation, stash=sops.Stash())
+    return stash
+
+
+def stash_decrypt(tree, key):
+    """Decrypt the tree and fill a sops.Stash, as edit mode does."""
+    stash = sops.Stash()
+    sops.walk_and_decrypt(tree, key, stash=stash)
+    return stash
+
+
+def measure(document, decrypt):
+    """Load the JSON `document` and decrypt it with `decrypt`. Return the
+    memory left allocated and the peak, less the memory of the encrypted
+    tree.
+    """
+    tracemalloc.start()
+    tree = json.loads(document, object_pairs_hook=OrderedDict)
+    loaded = tracemalloc.get_traced_memory()[0]
+    result = decrypt(tree)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del tree, result
+    return current - loaded, peak - loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--leaves', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=1024,
+                        help="size of each value in bytes")
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    crypttree = sops.walk_and_encrypt(build_tree(args.leaves, args.size), key)
+    document = json.dumps(crypttree)
+    del crypttree
+
+    none, none_peak = measure(
+        document, lambda tree: sops.walk_and_decrypt(tree, key))
+    before, before_peak = measure(
+        document, lambda tree: legacy_decrypt(tree, key))
+    after, after_peak = measure(
+        document, lambda tree: stash_decrypt(tree, key))
+
+    mb = 1024.0 * 1024.0
+    print("%d leaves of %d bytes, memory of the stash filled while "
+          "decrypting:" % (args.leaves, args.size))
+    print("  retained  before %8.1f MB  after %8.1f MB" %
+          ((before - none) / mb, (after - none) / mb))
+    print("  peak      before %8.1f MB  after %8.1f MB" %
+          ((before_peak - none_peak) / mb, (after_peak - none_peak) / mb))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Measure the overhead of walking a wide tree, without any cipher work.
+
+The "before" numbers come from a copy of the recursive walkers, the
+"after" numbers from `sops.walk_leaves`. Both use an operation that
+returns values unchanged. The best of --runs runs is reported.
+
+    $ python benchmarks/bench_tree_walk.py --branches 2000 --width 50
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import sys
+import time
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ruamel.yaml  # noqa
+import sops  # noqa
+
+
+def noop(value, aad=b'', stash=None, path=None):
+    return value, None
+
+
+def legacy_walk(branch, aad=b'', stash=None):
+    for k, v in branch.items():
+        caad = aad + k.encode('utf-8') + b':'
+        nstash = dict()
+        if stash and k in stash:
+            nstash = stash[k]
+        if isinstance(v, dict):
+            branch[k] = legacy_walk(v, aad=caad, stash=nstash)
+        elif isinstance(v, list):
+            branch[k] = legacy_walk_list(v, aad=caad, stash=nstash)
+        elif isinstance(v, ruamel.yaml.scalarstring.PreservedScalarString):
+            branch[k] = ruamel.yaml.scalarstring.PreservedScalarString(
+                noop(v, aad=caad, stash=nstash)[0])
+        else:
+            branch[k] = noop(v, aad=caad, stash=nstash)[0]
+    return branch
+
+
+def legacy_walk_list(branch, aad=b'', stash=None):
+    nstash = dict()
+    kl = []
+    for i, v in enumerate(list(branch)):
+        if stash and i in stash:
+            nstash = stash[i]
+        if isinstance(v, dict):
+            kl.append(legacy_walk(v, aad=aad, stash=nstash))
+        elif isinstance(v, list):
+            kl.append(legacy_walk_list(v, aad=aad, stash=nstash))
+        else:
+            kl.append(noop(v, aad=aad, stash=nstash)[0])
+    return kl
+
+
+def build_tree(branches, width):
+    tree = OrderedDict()
+    for i in range(branches):
+        tree["branch%d" % i] = OrderedDict(
+            [("key%d" % j, "value") for j in range(width)] +
+            [("list", ["value"] * width)])
+    return tree
+
+
+def timed(func, tree):
+    start = time.time()
+    func(tree)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--branches', type=int, default=2000)
+    parser.add_argument('--width', type=int, default=50)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    leaves = args.branches * args.width * 2
+    before = min(timed(legacy_walk, build_tree(args.branches, args.width))
+                 for _ in range(args.runs))
+    after = min(timed(lambda tree: sops.walk_leaves(tree, noop, isRoot=False),
+                      build_tree(args.branches, args.width))
+                for _ in range(args.runs))
+    print("%d leaves, walk overhead:" % leaves)
+    print("  before %7.3fs  after %7.3fs  (x%.2f)" %
+          (before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
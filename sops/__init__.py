@@ -11,21 +11,31 @@
 
 from __future__ import print_function, unicode_literals
 import argparse
+import calendar
 import hashlib
+import threading
 import os
+import random
 import re
+import struct
 import subprocess
 import sys
 import tempfile
+import time
 from base64 import b64encode, b64decode
+from binascii import hexlify, unhexlify
 from datetime import datetime
 from socket import gethostname
 from textwrap import dedent
 
-import boto3
-import ruamel.yaml
+from cryptography.exceptions import InvalidTag
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, modes, algorithms
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+except ImportError:
+    # cryptography < 2.0 has no AEAD interface, fall back to Cipher objects
+    AESGCM = None
 
 if sys.version_info[0] == 2 and sys.version_info[1] == 6:
     # python2.6 needs simplejson and ordereddict
@@ -37,6 +47,21 @@ else:
 
 if sys.version_info[0] == 3:
     raw_input = input
+    import queue
+else:
+    import Queue as queue
+
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks on windows, concurrent sops processes may lose some of
+    # the master key statistics they record
+    fcntl = None
 
 VERSION = 0.9
 
@@ -52,11 +77,21 @@ To use multiple KMS or PGP keys, separate them by commas. For example:
     $ sops -p "10F2[...]0A, 85D[...]B3F21" file.yaml
 
 The -p and -k flags are ignored if the document already contains master
-keys. To add/remove master keys in existing documents, open then with -s
-and edit the `sops` branch directly.
+keys. To add/remove master keys in existing documents, use the --add-kms,
+--rm-kms, --add-pgp and --rm-pgp flags, or open them with -s and edit the
+`sops` branch directly.
 
 By default, editing is done in vim, and will use the $EDITOR env if set.
 
+With --recursive, -d, -e and -r process every file of a directory in a
+pool of processes, in place with -i or to --output-dir.
+
+`sops agent` starts an agent that keeps decrypted data keys in memory and
+serves them to other sops commands, see `sops agent -h`.
+
+`sops stats` shows the success rates and latencies of the master keys, that
+sops uses to try the fastest master keys first.
+
 Version {version} - See the Readme at github.com/mozilla/sops
 """.format(version=VERSION)
 
@@ -91,19 +126,107 @@ Remove this text and add your content to the file.
 
 """
 
-NOW = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+MAC_FORMATS = ('sha512', 'merkle')
+
+
+class SopsError(Exception):
+    """Base class of the errors raised by sops.
+
+    `error_code` is the exit status of the sops command when it fails with
+    the error.
+
+    """
+    error_code = 1
+
+    def __init__(self, msg, error_code=None):
+        super(SopsError, self).__init__(msg)
+        if error_code is not None:
+            self.error_code = error_code
+
+
+class MacError(SopsError):
+    """The MAC of a document is missing or doesn't match its values."""
+    error_code = 51
 
-INPUT_VERSION = VERSION
+
+class MasterKeyError(SopsError):
+    """No master key could encrypt or decrypt the data key."""
+    error_code = 128
+
+
+class TreePathError(SopsError):
+    """A tree path is invalid, or doesn't exist in the tree."""
+    error_code = 91
+
+
+class DocumentError(SopsError):
+    """A document, or its `sops` branch, is malformed."""
 
 
 def main():
+    """Run the sops command, and exit with the error code of the SopsError
+    it fails with, if any.
+    """
+    try:
+        _main()
+    except SopsError as e:
+        panic(str(e), e.error_code)
+
+
+def configure_kms_rate(rates=None):
+    """Configure KMS_LIMITER with `rates`, or the SOPS_KMS_RATE env
+    variable.
+    """
+    if rates is None:
+        rates = os.environ.get('SOPS_KMS_RATE')
+    if not rates:
+        return
+    try:
+        KMS_LIMITER.configure(rates)
+    except ValueError:
+        raise SopsError("invalid KMS rates '%s'" % rates)
+
+
+def parse_hedge_delay(delay):
+    """Return the seconds of a hedge delay, see get_key_hedged. Raise
+    SopsError if it isn't a number of seconds, 0 or more.
+    """
+    try:
+        seconds = float(delay)
+    except (TypeError, ValueError):
+        seconds = None
+    # also rejects nan, and inf which can't be waited for
+    if seconds is None or not 0 <= seconds < float('inf'):
+        raise SopsError("invalid hedge delay '%s', expected a number of "
+                        "seconds, 0 or more" % delay)
+    return seconds
+
+
+def _is_command(name):
+    """Return whether sops is run as the `sops <name>` command, rather
+    than on a file named <name>. A file of that name in the current
+    directory takes precedence.
+    """
+    return sys.argv[1:2] == [name] and not os.path.exists(name)
+
+
+def _main():
+    if _is_command('agent'):
+        from sops import agent
+        agent.main(sys.argv[2:])
+        sys.exit(0)
+    if _is_command('stats'):
+        stats_main(sys.argv[2:])
+        sys.exit(0)
     argparser = argparse.ArgumentParser(
-        usage='sops <file>',
+        usage='sops <file> | sops -d|-e|-r --recursive <dir> | sops agent '
+              '| sops stats',
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description='SOPS - encrypted files editor that uses AWS KMS and PGP',
         epilog=dedent(DESC))
     argparser.add_argument('file',
-                           help="file to edit; create it if it doesn't exist")
+                           help="file to edit; create it if it doesn't exist. "
+                                "A directory with --recursive")
     argparser.add_argument('-k', '--kms', dest='kmsarn',
                            help="comma separated list of KMS ARNs")
     argparser.add_argument('-p', '--pgp', dest='pgpfp',
@@ -122,10 +245,37 @@ def main():
                            dest='rotate',
                            help="generate a new data encryption key and "
                                 "encrypt all values with the new key")
-    argparser.add_argument('--extract', dest='tree_path',
+    argparser.add_argument('--extract', dest='tree_paths', action='append',
                            help="extract a specific key or branch from the "
                                 "input JSON or YAML document. (decrypt mode "
-                                "only). ex: --extract '[\"somekey\"][0]'")
+                                "only). ex: --extract '[\"somekey\"][0]'. "
+                                "Can be repeated to extract several paths")
+    argparser.add_argument('--set', dest='set_values', nargs=2,
+                           action='append', metavar=('PATH', 'VALUE'),
+                           help="set the value at a tree path and write "
+                                "<file> in place, without opening an editor. "
+                                "The value is decoded from JSON if it can be. "
+                                "ex: --set '[\"db\"][\"port\"]' 5432. "
+                                "Can be repeated")
+    argparser.add_argument('--unset', dest='unset_paths', action='append',
+                           metavar='PATH',
+                           help="remove the value at a tree path and write "
+                                "<file> in place. Can be repeated")
+    argparser.add_argument('--add-kms', dest='add_kms', metavar='ARNS',
+                           help="encrypt the data key with comma separated "
+                                "KMS ARNs and add them to the master keys of "
+                                "<file>, in place. The values of <file> are "
+                                "not changed")
+    argparser.add_argument('--rm-kms', dest='rm_kms', metavar='ARNS',
+                           help="remove comma separated KMS ARNs from the "
+                                "master keys of <file>, in place")
+    argparser.add_argument('--add-pgp', dest='add_pgp', metavar='FPS',
+                           help="encrypt the data key with comma separated "
+                                "PGP fingerprints and add them to the master "
+                                "keys of <file>, in place")
+    argparser.add_argument('--rm-pgp', dest='rm_pgp', metavar='FPS',
+                           help="remove comma separated PGP fingerprints "
+                                "from the master keys of <file>, in place")
     argparser.add_argument('--input-type', dest='input_type',
                            help="input type (yaml, json, ...), "
                                 "if undef, use file extension")
@@ -140,7 +290,78 @@ def main():
                            dest='ignore_mac',
                            help="ignore Message Authentication Code "
                                 "during decryption")
+    argparser.add_argument('--defer-mac', action='store_true',
+                           dest='defer_mac',
+                           help="with --extract, verify the Message "
+                                "Authentication Code after writing the "
+                                "extracted values instead of before")
+    argparser.add_argument('--mac-format', dest='mac_format',
+                           choices=MAC_FORMATS,
+                           help="format of the Message Authentication Code "
+                                "when encrypting: a sha512 of all the values "
+                                "(default), or a merkle hash tree that can "
+                                "be checked and updated one path at a time")
+    argparser.add_argument('--jobs', type=int, dest='jobs',
+                           help="number of threads used to encrypt and "
+                                "decrypt values (default: 1), or of "
+                                "processes with --recursive (default: one "
+                                "per CPU)")
+    argparser.add_argument('-R', '--recursive', action='store_true',
+                           dest='recursive',
+                           help="decrypt (-d), encrypt (-e), rotate the "
+                                "data key (-r) or change the master keys "
+                                "(--add-kms, ...) of every file under the "
+                                "directory <file>, in place (-i) or to "
+                                "--output-dir, in a pool of --jobs "
+                                "processes")
+    argparser.add_argument('--include', dest='include', action='append',
+                           metavar='GLOB',
+                           help="with --recursive, only process the files "
+                                "whose path relative to <file> matches GLOB. "
+                                "Can be repeated")
+    argparser.add_argument('--exclude', dest='exclude', action='append',
+                           metavar='GLOB',
+                           help="with --recursive, skip the files and "
+                                "directories whose path or name matches "
+                                "GLOB. Can be repeated (default: '.*')")
+    argparser.add_argument('--output-dir', dest='output_dir', metavar='DIR',
+                           help="with --recursive, write each file to the "
+                                "same path relative to DIR instead of in "
+                                "place")
+    argparser.add_argument('--checkpoint', dest='checkpoint', metavar='FILE',
+                           help="with --recursive, record the files done in "
+                                "FILE, and skip the files it lists, to "
+                                "resume a command that failed. FILE is "
+                                "removed once every file is done")
+    argparser.add_argument('--kms-concurrency', type=int,
+                           dest='kms_concurrency', metavar='N',
+                           help="with --recursive, maximum KMS requests in "
+                                "flight across all the processes "
+                                "(default: unlimited)")
+    argparser.add_argument('--hedge-delay', dest='hedge_delay',
+                           metavar='SECONDS',
+                           help="decrypt the data key with the next master "
+                                "key when the previous one hasn't answered "
+                                "within SECONDS, or with every master key at "
+                                "once with 0, and use the first key "
+                                "decrypted. Master keys are tried one after "
+                                "the other by default, or after the delay "
+                                "in the SOPS_HEDGE_DELAY env variable")
+    argparser.add_argument('--kms-rate', dest='kms_rate', metavar='RATES',
+                           help="maximum KMS requests per second in each "
+                                "region, and for some regions as "
+                                "REGION=RATE, ex: 50,us-east-1=100. "
+                                "Throttled requests are retried at a lower "
+                                "rate. Defaults to the SOPS_KMS_RATE env "
+                                "variable, unlimited if unset")
     args = argparser.parse_args()
+    configure_kms_rate(args.kms_rate)
+
+    hedge_delay = args.hedge_delay
+    if hedge_delay is None:
+        hedge_delay = os.environ.get('SOPS_HEDGE_DELAY') or None
+    if hedge_delay is not None:
+        hedge_delay = parse_hedge_delay(hedge_delay)
 
     kms_arns = ""
     if 'SOPS_KMS_ARN' in os.environ:
@@ -154,6 +375,12 @@ def main():
     if args.pgpfp:
         pgp_fps = args.pgpfp
 
+    if args.recursive:
+        _main_recursive(argparser, args, kms_arns, pgp_fps, hedge_delay)
+        sys.exit(0)
+    if args.jobs is None:
+        args.jobs = 1
+
     # use input type as output type if not specified
     if args.input_type:
         itype = args.input_type
@@ -168,8 +395,11 @@ def main():
     tree, need_key, existing_file = initialize_tree(args.file, itype,
                                                     kms_arns=kms_arns,
                                                     pgp_fps=pgp_fps)
+    change_keys = (args.add_kms or args.rm_kms or args.add_pgp or
+                   args.rm_pgp)
     if not existing_file:
-        if (args.encrypt or args.decrypt):
+        if (args.encrypt or args.decrypt or args.set_values or
+                args.unset_paths or change_keys):
             panic("cannot operate on non-existent file", error_code=100)
         else:
             print("%s doesn't exist, creating it." % args.file)
@@ -180,8 +410,10 @@ def main():
 
     if args.encrypt:
         # Encrypt mode: encrypt, display and exit
-        key, tree = get_key(tree, need_key)
-        tree = walk_and_encrypt(tree, key)
+        key, tree = get_key(tree, need_key, hedge_delay=hedge_delay)
+        if args.mac_format:
+            set_mac_format(tree, args.mac_format)
+        tree = encrypt_tree(tree, key, jobs=args.jobs)
         dest = '/dev/stdout'
         if args.in_place:
             dest = args.file
@@ -190,30 +422,82 @@ def main():
         write_file(tree, path=dest, filetype=otype)
         sys.exit(0)
 
+    if args.decrypt and args.tree_paths:
+        # Extract mode: only decrypt the branches that are extracted. A
+        # sha512 MAC covers the whole document, checking it requires
+        # decrypting every value, so it can be deferred until after the
+        # output. A merkle MAC is only checked on the extracted paths.
+        key, tree = get_key(tree, hedge_delay=hedge_delay)
+        lazy = LazyTree(tree, key)
+        verify = not args.ignore_mac
+        if verify and not args.defer_mac:
+            lazy.verify(args.tree_paths)
+        tree = extract_paths(lazy, args.tree_paths)
+        dest = '/dev/stdout'
+        if args.in_place:
+            dest = args.file
+        write_file(tree, path=dest, filetype=otype)
+        if verify and args.defer_mac:
+            lazy.verify(args.tree_paths)
+        sys.exit(0)
+
     if args.decrypt:
         # Decrypt mode: decrypt, display and exit
-        key, tree = get_key(tree)
-        tree = walk_and_decrypt(tree, key, ignoreMac=args.ignore_mac)
+        key, tree = get_key(tree, hedge_delay=hedge_delay)
+        tree = decrypt_tree(tree, key, ignore_mac=args.ignore_mac,
+                            jobs=args.jobs)
         if not args.show_master_keys:
             tree.pop('sops', None)
         dest = '/dev/stdout'
         if args.in_place:
             dest = args.file
-        if args.tree_path:
-            tree = truncate_tree(tree, args.tree_path)
         write_file(tree, path=dest, filetype=otype)
         sys.exit(0)
 
+    if args.set_values or args.unset_paths:
+        # Set mode: change values in place, only the new values are
+        # encrypted and the ciphertext of the others is kept
+        key, tree = get_key(tree, hedge_delay=hedge_delay)
+        assignments = [(parse_tree_path(path), parse_value(value, tree))
+                       for path, value in args.set_values or []]
+        removals = [parse_tree_path(path) for path in args.unset_paths or []]
+        tree = update_tree(tree, key, assignments, removals,
+                           ignoreMac=args.ignore_mac,
+                           mac_format=args.mac_format, jobs=args.jobs)
+        tree = update_master_keys(tree, key)
+        if otype == "bytes":
+            otype = "json"
+        path = write_file(tree, path=args.file, filetype=otype)
+        print("file written to %s" % (path), file=sys.stderr)
+        sys.exit(0)
+
+    if change_keys:
+        # Master keys mode: only the sops branch changes, the data key is
+        # only decrypted to encrypt it with the master keys added
+        if need_key:
+            raise DocumentError("%s is not encrypted with sops" % args.file)
+        key = None
+        if args.add_kms or args.add_pgp:
+            key, tree = get_key(tree, hedge_delay=hedge_delay)
+        tree = change_master_keys(tree, key, add_kms=args.add_kms,
+                                  rm_kms=args.rm_kms, add_pgp=args.add_pgp,
+                                  rm_pgp=args.rm_pgp)
+        if otype == "bytes":
+            otype = "json"
+        path = write_file(tree, path=args.file, filetype=otype)
+        print("file written to %s" % (path), file=sys.stderr)
+        sys.exit(0)
+
     # EDIT Mode: decrypt, edit, encrypt and save
-    key, tree = get_key(tree, need_key)
+    key, tree = get_key(tree, need_key, hedge_delay=hedge_delay)
 
-    # we need a stash to save the IV and AAD and reuse them
+    # we need a stash to save the IVs and reuse them
     # if a given value has not changed during editing
-    stash = dict()
-    stash['sops'] = dict(tree['sops'])
+    stash = Stash()
+    sops_branch = dict(tree['sops'])
     if existing_file:
         tree = walk_and_decrypt(tree, key, stash=stash,
-                                ignoreMac=args.ignore_mac)
+                                ignoreMac=args.ignore_mac, jobs=args.jobs)
 
     # hide the sops branch during editing
     if not args.show_master_keys:
@@ -249,7 +533,7 @@ def main():
         else:
             # sops branch was removed for editing, restoring it
             tree = load_file_into_tree(tmppath, otype,
-                                       restore_sops=stash['sops'])
+                                       restore_sops=sops_branch)
         if check_master_keys(tree):
             has_master_keys = True
         else:
@@ -270,7 +554,9 @@ def main():
         panic("%s has not been modified, exit without writing" % args.file,
               error_code=200)
 
-    tree = walk_and_encrypt(tree, key, stash=stash)
+    if args.mac_format:
+        set_mac_format(tree, args.mac_format)
+    tree = walk_and_encrypt(tree, key, stash=stash, jobs=args.jobs)
     tree = update_master_keys(tree, key)
     os.remove(tmppath)
 
@@ -282,6 +568,49 @@ def main():
     sys.exit(0)
 
 
+def _main_recursive(argparser, args, kms_arns, pgp_fps, hedge_delay):
+    """Run the --recursive mode of the sops command, see sops.batch."""
+    change_keys = (args.add_kms or args.rm_kms or args.add_pgp or
+                   args.rm_pgp)
+    if change_keys and (args.decrypt or args.encrypt or args.rotate):
+        argparser.error("--add-kms, --rm-kms, --add-pgp and --rm-pgp can't "
+                        "be used with -d, -e or -r")
+    if change_keys:
+        mode = 'master_keys'
+    elif args.decrypt:
+        mode = 'decrypt'
+    elif args.encrypt:
+        mode = 'encrypt'
+    elif args.rotate:
+        mode = 'rotate'
+    else:
+        argparser.error("--recursive needs -d, -e, -r or master keys to "
+                        "add or remove")
+    if args.tree_paths or args.set_values or args.unset_paths:
+        argparser.error("--recursive can't be used with --extract, --set "
+                        "or --unset")
+    if not (args.in_place or args.output_dir):
+        argparser.error("--recursive needs -i or --output-dir")
+    options = dict(kms_arns=kms_arns, pgp_fps=pgp_fps,
+                   hedge_delay=hedge_delay, kms_rate=args.kms_rate,
+                   input_type=args.input_type, output_type=args.output_type,
+                   ignore_mac=args.ignore_mac, mac_format=args.mac_format,
+                   show_master_keys=args.show_master_keys,
+                   new_key=args.rotate, add_kms=args.add_kms,
+                   rm_kms=args.rm_kms, add_pgp=args.add_pgp,
+                   rm_pgp=args.rm_pgp)
+    from sops import batch
+    results = batch.run(args.file, mode, options,
+                        output_dir=args.output_dir, include=args.include,
+                        exclude=args.exclude, jobs=args.jobs,
+                        checkpoint=args.checkpoint,
+                        kms_concurrency=args.kms_concurrency)
+    failed = [path for path, error, seconds in results if error is not None]
+    if failed:
+        raise SopsError("%d of %d files failed" % (len(failed),
+                                                   len(results)))
+
+
 def detect_filetype(file):
     """Detect the type of file based on its extension.
     Return a string that describes the format: `bytes`, `yaml`, `json`
@@ -294,6 +623,28 @@ def detect_filetype(file):
     return 'bytes'
 
 
+def _yaml():
+    """Return the ruamel.yaml module, imported on first use, since JSON and
+    text documents don't need it.
+    """
+    import ruamel.yaml
+    return ruamel.yaml
+
+
+class _NoValue(object):
+    """A type that no value has."""
+
+
+def _preserved_scalar_type():
+    """Return the type of the strings that ruamel.yaml writes as literal
+    blocks, or _NoValue if ruamel.yaml isn't loaded, as no value can be one
+    of them then.
+    """
+    if 'ruamel.yaml' not in sys.modules:
+        return _NoValue
+    return _yaml().scalarstring.PreservedScalarString
+
+
 def initialize_tree(path, itype, kms_arns=None, pgp_fps=None):
     """ Try to load the file from path in a tree, and failing that,
         initialize a new tree using default data
@@ -310,16 +661,11 @@ def initialize_tree(path, itype, kms_arns=None, pgp_fps=None):
         tree, need_key = verify_or_create_sops_branch(tree,
                                                       kms_arns=kms_arns,
                                                       pgp_fps=pgp_fps)
-        # try to set the input version to the one set in the file
-        try:
-            global INPUT_VERSION
-            INPUT_VERSION = tree['sops']['version']
-        except:
-            None
     else:
         # load a new tree using template data
         if itype == "yaml":
-            tree = ruamel.yaml.load(DEFAULT_YAML, ruamel.yaml.RoundTripLoader)
+            yaml = _yaml()
+            tree = yaml.load(DEFAULT_YAML, yaml.RoundTripLoader)
         elif itype == "json":
             tree = json.loads(DEFAULT_JSON, object_pairs_hook=OrderedDict)
         else:
@@ -338,7 +684,8 @@ def load_file_into_tree(path, filetype, restore_sops=None):
     tree = OrderedDict()
     with open(path, "rb") as fd:
         if filetype == 'yaml':
-            tree = ruamel.yaml.load(fd, ruamel.yaml.RoundTripLoader)
+            yaml = _yaml()
+            tree = yaml.load(fd, yaml.RoundTripLoader)
         elif filetype == 'json':
             data = fd.read()
             if isinstance(data, bytes):
@@ -397,8 +744,9 @@ def verify_or_create_sops_branch(tree, kms_arns=None, pgp_fps=None):
     if not (pgp_fps is None):
         tree, has_at_least_one_method = parse_pgp_fp(tree, pgp_fps)
     if not has_at_least_one_method:
-        panic("Error: No KMS ARN or PGP Fingerprint found to encrypt the data "
-              "key, read the help (-h) for more information.", 111)
+        raise MasterKeyError("Error: No KMS ARN or PGP Fingerprint found to "
+                             "encrypt the data key, read the help (-h) for "
+                             "more information.", 111)
     return tree, need_new_data_key
 
 
@@ -406,32 +754,102 @@ def parse_kms_arn(tree, kms_arns):
     """Take a string that contains one or more KMS ARNs, possibly with roles,
        and transform them it into KMS entries of the sops tree
     """
-    has_at_least_one_method = False
-    tree['sops']['kms'] = list()
+    tree['sops']['kms'] = kms_entries(kms_arns)
+    return tree, len(tree['sops']['kms']) > 0
+
+
+def kms_entries(kms_arns):
+    """Return the KMS entries, without encrypted key, of a comma separated
+    list of KMS ARNs, each possibly followed by `+` and a role ARN.
+    """
+    entries = list()
     for arn in kms_arns.split(','):
         arn = arn.replace(" ", "")
-        entry = {}
         rolepos = arn.find("+arn:aws:iam::")
         if rolepos > 0:
             entry = {"arn": arn[:rolepos], "role": arn[rolepos+1:]}
         else:
             entry = {"arn": arn}
-        tree['sops']['kms'].append(entry)
-        has_at_least_one_method = True
-    return tree, has_at_least_one_method
+        entries.append(entry)
+    return entries
 
 
 def parse_pgp_fp(tree, pgp_fps):
     """Take a string of PGP fingerprint
        and create pgp entries in the sops tree
     """
-    has_at_least_one_method = False
-    tree['sops']['pgp'] = list()
-    for fp in pgp_fps.split(','):
-        entry = {"fp": fp.replace(" ", "")}
-        tree['sops']['pgp'].append(entry)
-        has_at_least_one_method = True
-    return tree, has_at_least_one_method
+    tree['sops']['pgp'] = pgp_entries(pgp_fps)
+    return tree, len(tree['sops']['pgp']) > 0
+
+
+def pgp_entries(pgp_fps):
+    """Return the PGP entries, without encrypted key, of a comma separated
+    list of fingerprints.
+    """
+    return [{"fp": fp.replace(" ", "")} for fp in pgp_fps.split(',')]
+
+
+def _master_key_id(kind, entry):
+    if kind == 'kms':
+        return (entry.get('arn'), entry.get('role'))
+    return ((entry.get('fp') or '').upper(),)
+
+
+def change_master_keys(tree, key=None, add_kms=None, rm_kms=None,
+                       add_pgp=None, rm_pgp=None):
+    """Add and remove master keys of an encrypted tree, and encrypt its
+    data key `key` with the master keys added.
+
+    The master keys are comma separated lists, as in the -k and -p flags.
+    A KMS ARN without a role removes its entries with any role. Only the
+    `sops` branch changes: the values, the MAC and the version are kept,
+    so the encrypted values of the document stay the same, and `key` is
+    only needed to add master keys. Raise MasterKeyError, and leave the
+    tree unchanged, if a master key added can't encrypt the data key, or
+    if no master key would be left.
+
+    """
+    branch = dict((kind, list(tree['sops'].get(kind) or []))
+                  for kind in ('kms', 'pgp'))
+    removals = [('kms', entry) for entry in kms_entries(rm_kms or '')
+                if entry['arn']] + \
+        [('pgp', entry) for entry in pgp_entries(rm_pgp or '')
+         if entry['fp']]
+    for kind, removed in removals:
+        if kind == 'kms' and 'role' not in removed:
+            match = (lambda entry: entry.get('arn') == removed['arn'])
+        else:
+            removed_id = _master_key_id(kind, removed)
+            match = (lambda entry:
+                     _master_key_id(kind, entry) == removed_id)
+        branch[kind] = [entry for entry in branch[kind] if not match(entry)]
+    additions = [('kms', entry) for entry in kms_entries(add_kms or '')
+                 if entry['arn']] + \
+        [('pgp', entry) for entry in pgp_entries(add_pgp or '')
+         if entry['fp']]
+    added = dict(kms=[], pgp=[])
+    for kind, entry in additions:
+        if _master_key_id(kind, entry) not in [
+                _master_key_id(kind, e) for e in branch[kind]]:
+            added[kind].append(entry)
+    if added['kms'] or added['pgp']:
+        if key is None:
+            raise ValueError("the data key is needed to add master keys")
+        new = {'sops': added}
+        count = encrypt_key_with_master_keys(key, new)
+        if count < len(added['kms']) + len(added['pgp']):
+            raise MasterKeyError("could not encrypt the data key with every "
+                                 "master key added")
+        for kind in ('kms', 'pgp'):
+            branch[kind] += new['sops'][kind]
+    if not any(entry.get('enc') for kind in ('kms', 'pgp')
+               for entry in branch[kind]):
+        raise MasterKeyError("no master key would be left to decrypt the "
+                             "data key")
+    for kind in ('kms', 'pgp'):
+        if branch[kind] or kind in tree['sops']:
+            tree['sops'][kind] = branch[kind]
+    return tree
 
 
 def update_master_keys(tree, key):
@@ -440,24 +858,13 @@ def update_master_keys(tree, key):
     """
     if 'kms' in tree['sops']:
         if not isinstance(tree['sops']['kms'], list):
-            panic("invalid KMS format in SOPS branch, must be a list")
-        i = -1
-        for entry in tree['sops']['kms']:
-            i += 1
-            if not ('enc' in entry) or entry['enc'] == "":
-                print("updating kms entry")
-                updated = encrypt_key_with_kms(key, entry)
-                tree['sops']['kms'][i] = updated
+            raise DocumentError("invalid KMS format in SOPS branch, must be "
+                                "a list")
     if 'pgp' in tree['sops']:
         if not isinstance(tree['sops']['pgp'], list):
-            panic("invalid PGP format in SOPS branch, must be a list")
-        i = -1
-        for entry in tree['sops']['pgp']:
-            i += 1
-            if not ('enc' in entry) or entry['enc'] == "":
-                print("updating pgp entry")
-                updated = encrypt_key_with_pgp(key, entry)
-                tree['sops']['pgp'][i] = updated
+            raise DocumentError("invalid PGP format in SOPS branch, must be "
+                                "a list")
+    encrypt_key_with_master_keys(key, tree, only_missing=True)
 
     # update version number if newer than current
     if 'version' in tree['sops']:
@@ -485,191 +892,329 @@ def check_master_keys(tree):
 
 
 def walk_and_decrypt(branch, key, aad=b'', stash=None, digest=None,
-                     isRoot=True, ignoreMac=False):
-    """Walk the branch recursively and decrypt leaves."""
-    if isRoot and not ignoreMac:
-        digest = hashlib.sha512()
-    carryaad = aad
-    for k, v in branch.items():
-        if k == 'sops' and isRoot:
-            continue    # everything under the `sops` key stays in clear
-        nstash = dict()
-        caad = aad
-        if INPUT_VERSION >= 0.9:
-            caad = aad + k.encode('utf-8') + b':'
-        else:
-            caad = carryaad
-            caad += k.encode('utf-8')
-            carryaad = caad
-        if stash:
-            stash[k] = {'has_stash': True}
-            nstash = stash[k]
-        if isinstance(v, dict):
-            branch[k] = walk_and_decrypt(v, key, aad=caad, stash=nstash,
-                                         digest=digest, isRoot=False)
-        elif isinstance(v, list):
-            branch[k] = walk_list_and_decrypt(v, key, aad=caad, stash=nstash,
-                                              digest=digest)
-        elif isinstance(v, ruamel.yaml.scalarstring.PreservedScalarString):
-            ev = decrypt(v, key, aad=caad, stash=nstash, digest=digest)
-            branch[k] = ruamel.yaml.scalarstring.PreservedScalarString(ev)
-        else:
-            branch[k] = decrypt(v, key, aad=caad, stash=nstash, digest=digest)
-
-    if isRoot and not ignoreMac:
-        # compute the hash computed on values with the one stored
-        # in the file. If they match, all is well.
-        if not ('mac' in branch['sops']):
-            panic("'mac' not found, unable to verify file integrity", 52)
-        h = digest.hexdigest().upper()
-        # We know the original hash is trustworthy because it is encrypted
-        # with the data key and authenticated using the lastmodified timestamp
-        orig_h = decrypt(branch['sops']['mac'], key,
-                         aad=branch['sops']['lastmodified'].encode('utf-8'))
-        if h != orig_h:
-            panic("Checksum verification failed!\nexpected %s\nbut got  %s" %
-                  (orig_h, h), 51)
+                     isRoot=True, ignoreMac=False, cipher=None, jobs=1):
+    """Walk the branch and decrypt leaves.
+
+    If a `Stash` is provided, the IVs of the leaves are saved in it.
+    If `jobs` is greater than 1, the leaves are decrypted by a pool of
+    `jobs` threads. Without a `cipher`, the version of the document is read
+    from the `sops` branch of a root branch.
 
+    """
+    if cipher is None:
+        cipher = LeafCipher(key, tree_version(branch) if isRoot else VERSION)
+    check_mac = isRoot and not ignoreMac
+    if check_mac and has_merkle_mac(branch):
+        # the hash tree covers the encrypted values, check it before
+        # decrypting anything
+        verify_merkle_mac(branch, cipher)
+        check_mac = False
+    if check_mac:
+        digest = hashlib.sha512()
+    if jobs > 1:
+        leaves = walk_leaves(branch, aad=aad, stash=stash, isRoot=isRoot,
+                             carry_aad=cipher.carry_aad)
+        process_leaves(leaves, cipher.open, digest=digest, stash=stash,
+                       jobs=jobs)
+    else:
+        walk_leaves(branch, cipher.open, digest=digest, aad=aad, stash=stash,
+                    isRoot=isRoot, carry_aad=cipher.carry_aad)
+    if check_mac:
+        verify_mac(branch, cipher, digest)
     return branch
 
 
-def walk_list_and_decrypt(branch, key, aad=b'', stash=None, digest=None):
+def verify_mac(branch, cipher, digest):
+    """Compare the digest computed on the values of the tree with the MAC
+    stored in the `sops` branch, and raise MacError if they don't match.
+    """
+    # compute the hash computed on values with the one stored
+    # in the file. If they match, all is well.
+    if not ('mac' in branch['sops']):
+        raise MacError("'mac' not found, unable to verify file integrity",
+                       52)
+    h = digest.hexdigest().upper()
+    # We know the original hash is trustworthy because it is encrypted
+    # with the data key and authenticated using the lastmodified timestamp
+    orig_h = cipher.decrypt(
+        branch['sops']['mac'],
+        aad=branch['sops']['lastmodified'].encode('utf-8'))
+    if h != orig_h:
+        raise MacError("Checksum verification failed!\nexpected %s\n"
+                       "but got  %s" % (orig_h, h))
+
+
+def walk_list_and_decrypt(branch, key, aad=b'', stash=None, digest=None,
+                          cipher=None, jobs=1):
     """Walk a list contained in a branch and decrypts its values."""
-    nstash = dict()
-    kl = []
-    for i, v in enumerate(list(branch)):
-        if stash:
-            stash[i] = {'has_stash': True}
-            nstash = stash[i]
-        if isinstance(v, dict):
-            kl.append(walk_and_decrypt(v, key, aad=aad, stash=nstash,
-                                       digest=digest, isRoot=False))
-        elif isinstance(v, list):
-            kl.append(walk_list_and_decrypt(v, key, aad=aad, stash=nstash,
-                                            digest=digest))
-        else:
-            kl.append(decrypt(v, key, aad=aad, stash=nstash, digest=digest))
-    return kl
+    return walk_and_decrypt(branch, key, aad=aad, stash=stash, digest=digest,
+                            isRoot=False, ignoreMac=True, cipher=cipher,
+                            jobs=jobs)
 
 
-def decrypt(value, key, aad=b'', stash=None, digest=None):
+def decrypt(value, key, aad=b'', stash=None, digest=None, path=None,
+            version=VERSION):
     """Return a decrypted value."""
-    valre = b'^ENC\[AES256_GCM,data:(.+),iv:(.+),tag:(.+)'
-    # extract fields using a regex
-    if INPUT_VERSION >= 0.8:
-        valre += b',type:(.+)'
-    valre += b'\]'
-    res = re.match(valre, value.encode('utf-8'))
-    # if the value isn't in encrypted form, return it as is
-    if res is None:
-        return value
-    enc_value = b64decode(res.group(1))
-    iv = b64decode(res.group(2))
-    tag = b64decode(res.group(3))
-    valtype = 'str'
-    if INPUT_VERSION >= 0.8:
-        valtype = res.group(4)
-    decryptor = Cipher(algorithms.AES(key),
-                       modes.GCM(iv, tag),
-                       default_backend()
-                       ).decryptor()
-    decryptor.authenticate_additional_data(aad)
-    cleartext = decryptor.update(enc_value) + decryptor.finalize()
-
-    if stash:
-        # save the values for later if we need to reencrypt
-        stash['iv'] = iv
-        stash['aad'] = aad
-        stash['cleartext'] = cleartext
-
-    if digest:
-        digest.update(cleartext)
-
-    if valtype == b'bytes':
-        return cleartext
-    if valtype == b'str':
-        # Welcome to python compatibility hell... :(
-        # Python 2 treats everything as str, but python 3 treats bytes and str
-        # as different types. So if a file was encrypted by sops with py2, and
-        # contains bytes data, it will have type 'str' and py3 will decode
-        # it as utf-8. This will result in a UnicodeDecodeError exception
-        # because random bytes are not unicode. So the little try block below
-        # catches it and returns the raw bytes if the value isn't unicode.
-        cv = cleartext
-        try:
-            cv = cleartext.decode('utf-8')
-        except UnicodeDecodeError:
-            return cleartext
-        return cv
-    if valtype == b'int':
-        return int(cleartext.decode('utf-8'))
-    if valtype == b'float':
-        return float(cleartext.decode('utf-8'))
-    if valtype == b'bool':
-        if cleartext.lower() == b'true':
-            return True
-        return False
-    panic("unknown type "+valtype, 23)
+    return LeafCipher(key, version).decrypt(value, aad=aad, stash=stash,
+                                            digest=digest, path=path)
 
 
 def walk_and_encrypt(branch, key, aad=b'', stash=None,
-                     isRoot=True, digest=None):
-    """Walk the branch recursively and encrypts its leaves."""
-    if isRoot:
+                     isRoot=True, digest=None, cipher=None, jobs=1):
+    """Walk the branch and encrypts its leaves.
+
+    If a `Stash` is provided, the IVs of unchanged leaves are reused.
+    If `jobs` is greater than 1, the leaves are encrypted by a pool of
+    `jobs` threads. The leaves are written in the current format, the
+    version of a root branch is raised to VERSION to match.
+
+    """
+    if cipher is None:
+        cipher = LeafCipher(key)
+    if isRoot and branch['sops'].get('version', 0) < VERSION:
+        branch['sops']['version'] = VERSION
+    merkle = isRoot and has_merkle_mac(branch)
+    if isRoot and not merkle:
         digest = hashlib.sha512()
-    for k, v in branch.items():
-        if k == 'sops' and isRoot:
-            continue    # everything under the `sops` key stays in clear
-        caad = aad + k.encode('utf-8') + b':'
-        nstash = dict()
-        if stash and k in stash:
-            nstash = stash[k]
-        if isinstance(v, dict):
-            # recursively walk the tree
-            branch[k] = walk_and_encrypt(v, key, aad=caad, stash=nstash,
-                                         digest=digest, isRoot=False)
-        elif isinstance(v, list):
-            branch[k] = walk_list_and_encrypt(v, key, aad=caad, stash=nstash,
-                                              digest=digest)
-        elif isinstance(v, ruamel.yaml.scalarstring.PreservedScalarString):
-            ev = encrypt(v, key, aad=caad, stash=nstash, digest=digest)
-            branch[k] = ruamel.yaml.scalarstring.PreservedScalarString(ev)
-        else:
-            branch[k] = encrypt(v, key, aad=caad, stash=nstash, digest=digest)
-    if isRoot:
-        branch['sops']['lastmodified'] = NOW
-        # finalize and store the message authentication code in encrypted form
-        h = str()
-        h = digest.hexdigest().upper()
-        mac = encrypt(h, key,
-                      aad=branch['sops']['lastmodified'].encode('utf-8'))
-        branch['sops']['mac'] = mac
+    if jobs > 1:
+        leaves = walk_leaves(branch, aad=aad, stash=stash, isRoot=isRoot)
+        process_leaves(leaves, cipher.seal, digest=digest, stash=stash,
+                       jobs=jobs)
+    else:
+        walk_leaves(branch, cipher.seal, digest=digest, aad=aad, stash=stash,
+                    isRoot=isRoot)
+    if merkle:
+        store_merkle_mac(branch, cipher)
+    elif isRoot:
+        store_mac(branch, cipher, digest)
     return branch
 
 
-def walk_list_and_encrypt(branch, key, aad=b'', stash=None, digest=None):
+def store_mac(branch, cipher, digest):
+    """Store the digest computed on the values of the tree in encrypted form
+    in the `sops` branch.
+    """
+    branch['sops']['lastmodified'] = cipher.now
+    # finalize and store the message authentication code in encrypted form
+    h = digest.hexdigest().upper()
+    mac = cipher.encrypt(h, aad=branch['sops']['lastmodified'].encode('utf-8'))
+    branch['sops']['mac'] = mac
+
+
+def walk_list_and_encrypt(branch, key, aad=b'', stash=None, digest=None,
+                          cipher=None, jobs=1):
     """Walk a list contained in a branch and encrypts its values."""
-    nstash = dict()
-    kl = []
-    for i, v in enumerate(list(branch)):
-        if stash and i in stash:
-            nstash = stash[i]
-        if isinstance(v, dict):
-            kl.append(walk_and_encrypt(v, key, aad=aad, stash=nstash,
-                                       digest=digest, isRoot=False))
-        elif isinstance(v, list):
-            kl.append(walk_list_and_encrypt(v, key, aad=aad, stash=nstash,
-                                            digest=digest))
+    return walk_and_encrypt(branch, key, aad=aad, stash=stash, isRoot=False,
+                            digest=digest, cipher=cipher, jobs=jobs)
+
+
+def has_merkle_mac(tree):
+    """Return True if the MAC of `tree` is a merkle hash tree."""
+    return 'sops' in tree and tree['sops'].get('mac_format') == 'merkle'
+
+
+def set_mac_format(tree, mac_format):
+    """Select the format of the MAC stored the next time `tree` is
+    encrypted, one of MAC_FORMATS.
+    """
+    if mac_format == 'merkle':
+        tree['sops']['mac_format'] = 'merkle'
+    else:
+        tree['sops'].pop('mac_format', None)
+        tree['sops'].pop('mac_tree', None)
+
+
+def verify_merkle_mac(tree, cipher, paths=None):
+    """Check the merkle MAC of `tree` on the paths provided, as tuples of
+    keys and list indexes, or on the whole tree. Raise MacError if it
+    doesn't match.
+    """
+    mac = MerkleMac(tree['sops'].get('mac_tree'), store=False)
+    for path in paths or [()]:
+        verify_mac(tree, cipher, mac.digest(tree, path))
+
+
+def store_merkle_mac(tree, cipher, paths=None):
+    """Hash the encrypted tree and store its merkle MAC in the `sops` branch.
+
+    If `paths` is provided, only the values at these paths are assumed to
+    have changed since the MAC was stored, and only the hashes along them
+    are computed again.
+
+    """
+    if not paths or 'mac_tree' not in tree['sops']:
+        mac = MerkleMac()
+        digest = mac.digest(tree)
+        tree['sops']['mac_tree'] = mac.table()
+    else:
+        mac = MerkleMac(tree['sops']['mac_tree'])
+        for path in paths:
+            digest = mac.digest(tree, path)
+        if mac.reordered:
+            tree['sops']['mac_tree'] = mac.table()
+    store_mac(tree, cipher, digest)
+
+
+def _items(branch):
+    if isinstance(branch, list):
+        return enumerate(branch)
+    return iter(branch.items())
+
+
+def walk_leaves(branch, operation=None, digest=None, aad=b'', stash=None,
+                isRoot=True, carry_aad=False):
+    """Walk the branch and apply `operation` to its leaves.
+
+    `operation` is either LeafCipher.open or LeafCipher.seal, its results
+    are written back into the tree and added to the digest in traversal
+    order. If `operation` is None, the leaves are returned instead, as a
+    list of (parent, key, value, aad, path) tuples for `process_leaves`.
+
+    Dicts and lists are walked with an explicit stack instead of recursion,
+    so the depth of a document is not bound by the recursion limit. The aad
+    prefix of a branch is computed once and shared by all its items. The
+    path of leaves is only tracked when a stash is provided or when leaves
+    are returned.
+
+    If `carry_aad` is set, the aad of a key is built from the keys that
+    precede it in its branch, as documents older than 0.9 did.
+
+    """
+    leaves = []
+    preserved = _preserved_scalar_type()
+    containers = (dict, list)
+    root = branch if isRoot else None
+    carry = bytearray(aad) if carry_aad else None
+    path = None
+    if stash is not None or operation is None:
+        path = ()
+    # each frame holds the iterator over the items of a branch, the branch,
+    # and the aad prefix and path its items share
+    stack = [(_items(branch), branch, isinstance(branch, list), aad, carry,
+              path)]
+    while stack:
+        items, parent, is_list, paad, carry, ppath = stack[-1]
+        for k, v in items:
+            if is_list:
+                caad = paad
+            else:
+                if k == 'sops' and parent is root:
+                    continue    # everything under the `sops` key stays clear
+                if carry is None:
+                    caad = paad + k.encode('utf-8') + b':'
+                else:
+                    carry += k.encode('utf-8')
+                    caad = bytes(carry)
+            if ppath is not None:
+                path = ppath + (k,)
+            if isinstance(v, containers):
+                is_child_list = isinstance(v, list)
+                ccarry = None
+                if carry_aad and not is_child_list:
+                    ccarry = bytearray(caad)
+                stack.append((_items(v), v, is_child_list, caad, ccarry,
+                              path))
+                break
+            if operation is None:
+                leaves.append((parent, k, v, caad, path))
+                continue
+            value, cleartext = operation(v, caad, stash, path)
+            if cleartext is not None and digest is not None:
+                digest.update(cleartext)
+            if not is_list and isinstance(v, preserved):
+                value = preserved(value)
+            parent[k] = value
         else:
-            kl.append(encrypt(v, key, aad=aad, stash=nstash,
-                              digest=digest))
-    return kl
+            stack.pop()
+    return leaves
+
+
+def process_leaves(leaves, operation, digest=None, stash=None, jobs=1):
+    """Apply `operation` to leaves returned by `walk_leaves` and write
+    the results back into the tree.
 
+    Chunks of leaves are handed to a pool of `jobs` threads, which the
+    AES-GCM code of `cryptography` runs in without holding the GIL.
+    Results are written back, and added to the digest, in the order of the
+    leaves so that the MAC is the same as the one computed serially.
+
+    """
+    preserved = _preserved_scalar_type()
+    results = _process_in_pool(leaves, operation, stash, jobs)
+    for leaf, (value, cleartext) in results:
+        parent, k, v = leaf[0], leaf[1], leaf[2]
+        if cleartext is not None and digest is not None:
+            digest.update(cleartext)
+        if not isinstance(parent, list) and isinstance(v, preserved):
+            value = preserved(value)
+        parent[k] = value
+
+
+def _process_in_pool(leaves, operation, stash, jobs):
+    """Yield (leaf, result) pairs, computed by a pool of `jobs` threads."""
+    def run(chunk):
+        return [operation(leaf[2], leaf[3], stash, leaf[4]) for leaf in chunk]
+
+    size = max(1, min(512, len(leaves) // (jobs * 4)))
+    chunks = [leaves[i:i + size] for i in range(0, len(leaves), size)]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(jobs)
+    try:
+        results = pool.map(run, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    for chunk, chunk_results in zip(chunks, results):
+        for pair in zip(chunk, chunk_results):
+            yield pair
 
-def encrypt(value, key, aad=b'', stash=None, digest=None):
+
+def encrypt(value, key, aad=b'', stash=None, digest=None, path=None):
     """Return an encrypted string of the value provided."""
-    # save the original type
-    # the order in which we do this matters. For example, a bool
+    return LeafCipher(key).encrypt(value, aad=aad, stash=stash, digest=digest,
+                                   path=path)
+
+
+def _decode_str(cleartext):
+    # Welcome to python compatibility hell... :(
+    # Python 2 treats everything as str, but python 3 treats bytes and str
+    # as different types. So if a file was encrypted by sops with py2, and
+    # contains bytes data, it will have type 'str' and py3 will decode
+    # it as utf-8. This will result in a UnicodeDecodeError exception
+    # because random bytes are not unicode. So the little try block below
+    # catches it and returns the raw bytes if the value isn't unicode.
+    try:
+        return cleartext.decode('utf-8')
+    except UnicodeDecodeError:
+        return cleartext
+
+
+# convert the cleartext of a leaf back into a value of its original type
+VALUE_DECODERS = {
+    'str': _decode_str,
+    'bytes': lambda cleartext: cleartext,
+    'int': lambda cleartext: int(cleartext.decode('utf-8')),
+    'float': lambda cleartext: float(cleartext.decode('utf-8')),
+    'bool': lambda cleartext: cleartext.lower() == b'true',
+}
+
+# map the python type of a value to the type stored in its ENC string.
+# bytes is listed first so that `str` wins on python 2, where both are
+# the same type.
+VALUE_TYPES = {bytes: 'bytes', str: 'str', bool: 'bool', int: 'int',
+               float: 'float'}
+if sys.version_info[0] == 2:
+    VALUE_TYPES[unicode] = 'str'  # noqa
+
+
+def value_type(value):
+    """Return the name of the type of a value, as stored in ENC strings."""
+    try:
+        return VALUE_TYPES[type(value)]
+    except KeyError:
+        pass
+    # subclasses, such as ruamel's scalar types, are resolved once and
+    # cached. The order in which we do this matters. For example, a bool
     # is also an int, but an int isn't a bool, so we test for bool first
     if isinstance(value, str) or \
        (sys.version_info[0] == 2 and isinstance(value, unicode)):  # noqa
@@ -682,109 +1227,1501 @@ def encrypt(value, key, aad=b'', stash=None, digest=None):
         valtype = 'float'
     else:
         valtype = 'bytes'
+    VALUE_TYPES[type(value)] = valtype
+    return valtype
+
+
+ENC_PREFIX = 'ENC[AES256_GCM,'
+
+ENC_FORMAT = "ENC[AES256_GCM,data:{value},iv:{iv},tag:{tag},type:{valtype}]"
+
+
+class LeafCipher(object):
+    """Encrypt and decrypt the leaves of a document with its data key.
+
+    A LeafCipher is created once per operation on a document, and holds
+    its context: the AES-GCM context for the data key is reused for every
+    leaf, the format rules that depend on the version of the document are
+    resolved at creation time, and `now` is the timestamp the MAC is
+    stored with. Nothing is shared between documents, so different
+    documents can be processed in different threads.
+
+    """
+
+    def __init__(self, key, version=VERSION, now=None):
+        self.key = key
+        self.version = version
+        if now is None:
+            now = timestamp()
+        self.now = now
+        # documents older than 0.8 don't store the type of values
+        self.has_type = version >= 0.8
+        # documents older than 0.9 carry the aad of previous keys of
+        # a branch instead of using the path to the value
+        self.carry_aad = version < 0.9
+        # ENC strings can be copied as is into a document written in the
+        # current format only if they were written in that format
+        self.passthrough = self.has_type and not self.carry_aad
+        self._nfields = 4 if self.has_type else 3
+        self._aead = None
+        if AESGCM is not None:
+            self._aead = AESGCM(key)
+
+    def split(self, value):
+        """Extract the fields of an `ENC[AES256_GCM,...]` string.
+
+        Return a tuple of (data, iv, tag, type), or None if the value
+        isn't in encrypted form.
+
+        """
+        try:
+            if not (value.startswith(ENC_PREFIX) and value.endswith(']')):
+                return None
+        except (AttributeError, TypeError):
+            return None
+        fields = value[len(ENC_PREFIX):-1].split(',')
+        if len(fields) != self._nfields:
+            return None
+        data, iv, tag = fields[0], fields[1], fields[2]
+        if not (data.startswith('data:') and iv.startswith('iv:') and
+                tag.startswith('tag:')):
+            return None
+        valtype = 'str'
+        if self.has_type:
+            if not fields[3].startswith('type:'):
+                return None
+            valtype = fields[3][5:]
+        return data[5:], iv[3:], tag[4:], valtype
+
+    def decrypt(self, value, aad=b'', stash=None, digest=None, path=None):
+        """Return a decrypted value."""
+        value, cleartext = self.open(value, aad=aad, stash=stash, path=path)
+        if digest and cleartext is not None:
+            digest.update(cleartext)
+        return value
+
+    def open(self, value, aad=b'', stash=None, path=None):
+        """Decrypt a value without updating a digest.
+
+        Return a tuple of the decrypted value and of the cleartext bytes the
+        MAC is computed on. The cleartext is None if the value isn't in
+        encrypted form, in which case the value is returned as is. If a
+        `Stash` is provided, the IV is saved in it under `path`. A value
+        that fails authentication raises a MacError.
+
+        """
+        fields = self.split(value)
+        if fields is None:
+            return value, None
+        enc_value = b64decode(fields[0])
+        iv = b64decode(fields[1])
+        tag = b64decode(fields[2])
+        valtype = fields[3]
+        try:
+            if self._aead is not None and len(tag) == 16:
+                cleartext = self._aead.decrypt(iv, enc_value + tag, aad)
+            else:
+                decryptor = Cipher(algorithms.AES(self.key),
+                                   modes.GCM(iv, tag),
+                                   default_backend()).decryptor()
+                decryptor.authenticate_additional_data(aad)
+                cleartext = decryptor.update(enc_value) + \
+                    decryptor.finalize()
+        except InvalidTag:
+            where = ""
+            if path is not None:
+                where = " at tree%s" % format_tree_path(path)
+            raise MacError("authentication of the value%s failed, it was "
+                           "modified or the data key is wrong" % where)
+
+        if stash is not None:
+            # save the values for later if we need to reencrypt
+            stash.record(path, iv, valtype, cleartext,
+                         value if self.passthrough else None)
+
+        try:
+            decode = VALUE_DECODERS[valtype]
+        except KeyError:
+            raise DocumentError("unknown type " + valtype, 23)
+        return decode(cleartext), cleartext
+
+    def encrypt(self, value, aad=b'', stash=None, digest=None, path=None):
+        """Return an encrypted string of the value provided."""
+        enc, cleartext = self.seal(value, aad=aad, stash=stash, path=path)
+        if digest:
+            digest.update(cleartext)
+        return enc
+
+    def seal(self, value, aad=b'', stash=None, path=None):
+        """Encrypt a value without updating a digest.
+
+        Return a tuple of the ENC string and of the cleartext bytes the
+        MAC is computed on. If a `Stash` is provided and the value saved
+        under `path` has not changed, its ENC string is returned as is or,
+        failing that, its IV is reused.
+
+        """
+        # save the original type
+        valtype = value_type(value)
+
+        if not isinstance(value, bytes):
+            # if not bytes, convert to bytes
+            value = str(value).encode('utf-8')
+
+        # if we have a stash, and the value of cleartext has not changed,
+        # attempt to reuse its ENC string, or to take the IV.
+        # if the stash has no existing value, or the cleartext has changed,
+        # generate new IV.
+        iv = None
+        if stash is not None:
+            entry = stash.get(path, valtype, value)
+            if entry is not None:
+                if entry.enc is not None:
+                    return entry.enc, value
+                iv = entry.iv
+        if iv is None:
+            iv = os.urandom(32)
+        if self._aead is not None:
+            sealed = self._aead.encrypt(iv, value, aad)
+            enc_value, tag = sealed[:-16], sealed[-16:]
+        else:
+            encryptor = Cipher(algorithms.AES(self.key),
+                               modes.GCM(iv),
+                               default_backend()).encryptor()
+            encryptor.authenticate_additional_data(aad)
+            enc_value = encryptor.update(value) + encryptor.finalize()
+            tag = encryptor.tag
+        enc = ENC_FORMAT.format(value=b64encode(enc_value).decode('utf-8'),
+                                iv=b64encode(iv).decode('utf-8'),
+                                tag=b64encode(tag).decode('utf-8'),
+                                valtype=valtype)
+        return enc, value
+
+
+class StashEntry(object):
+    """The IV and ENC string of a decrypted leaf, and a checksum of its type
+    and cleartext.
+    """
+    __slots__ = ('iv', 'checksum', 'enc')
+
+    def __init__(self, iv, checksum, enc=None):
+        self.iv = iv
+        self.checksum = checksum
+        self.enc = enc
+
+
+class Stash(object):
+    """Save the leaves of a decrypted tree, to reuse them when the tree is
+    encrypted again and a value has not changed.
+
+    Entries are stored in a flat table indexed by the path of leaves, a
+    tuple of keys and list indexes. Only a checksum of the cleartext is
+    kept to detect changes, not the cleartext itself. When the original
+    ENC string of a leaf is known, an unchanged value is copied through
+    without being encrypted again, otherwise its IV is reused.
+
+    Copying values through trades memory for speed: the ENC strings stay
+    alive as long as the stash, instead of being freed as the tree is
+    decrypted, and in base64 they are a third larger than the cleartext.
+    See benchmarks/bench_stash_memory.py and benchmarks/bench_edit_save.py.
+
+    """
+
+    def __init__(self):
+        self.entries = dict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def checksum(valtype, cleartext):
+        return hashlib.sha256(valtype.encode('utf-8') + b':' +
+                              cleartext).digest()
+
+    def record(self, path, iv, valtype, cleartext, enc=None):
+        """Save the IV, and optionally the ENC string, of the leaf at `path`.
+        """
+        self.entries[path] = StashEntry(iv, self.checksum(valtype, cleartext),
+                                        enc)
+
+    def get(self, path, valtype, cleartext):
+        """Return the entry of the leaf at `path` if its value has not
+        changed, or None.
+        """
+        entry = self.entries.get(path)
+        if entry is None or \
+           entry.checksum != self.checksum(valtype, cleartext):
+            return None
+        return entry
+
+
+class MerkleMac(object):
+    """A MAC made of a hash tree over the encrypted values of a document.
+
+    Values are hashed in their encrypted form, and branches over the names
+    and hashes of their items, so the tree is hashed without decrypting
+    anything. The hashes of branches are kept in a table indexed by their
+    path, stored in clear as `mac_tree` in the `sops` branch, while the
+    hash of the document is encrypted as `mac` like the sha512 MAC.
+
+    Hashing the tree along a single path only hashes the items of the
+    branches on that path, the table stands in for the other branches.
+    Since every stored hash rolls up to the encrypted one, an altered
+    table fails the check as well. The table is updated in place with the
+    hashes computed, unless `store` is False.
+
+    """
+
+    def __init__(self, hashes=None, store=True):
+        if hashes is None:
+            hashes = dict()
+        self.hashes = hashes
+        self.store = store
+        self.reordered = False
+
+    def table(self):
+        """Return the stored hashes, sorted by path."""
+        table = dict()
+        for name in sorted(self.hashes):
+            table[name] = self.hashes[name]
+        return table
+
+    def digest(self, tree, path=()):
+        """Hash the document after the value at `path` changed and return
+        its hash, as a hashlib object.
+
+        The branch or value at `path` is hashed in full, and the hashes of
+        the branches on the way to the root are stored again. If `path` no
+        longer exists, its parent is hashed with the remaining items. Items
+        added to or removed from a list shift the ones after them, `path`
+        must then be the path of the list.
+
+        """
+        path = tuple(path)
+        if not path:
+            if self.store:
+                self.hashes.clear()
+            return self.hash_branch(tree, ())
+        nodes = [tree]
+        for k in path:
+            try:
+                if not isinstance(nodes[-1], (dict, list)):
+                    raise TypeError(k)
+                nodes.append(nodes[-1][k])
+            except (KeyError, IndexError, TypeError):
+                break
+        if len(nodes) <= len(path):
+            self._forget(path[:len(nodes)])
+            path = path[:len(nodes) - 1]
+            if isinstance(nodes[-1], (dict, list)):
+                h = self.hash_items(nodes[-1], path)
+            else:
+                h = _merkle_leaf(nodes[-1])
+        elif isinstance(nodes[-1], (dict, list)):
+            self._forget(path)
+            h = self.hash_branch(nodes[-1], path)
+        else:
+            h = _merkle_leaf(nodes[-1])
+        for depth in range(len(path) - 1, -1, -1):
+            h = self.hash_items(nodes[depth], path[:depth], path[depth], h)
+        return h
+
+    def hash_branch(self, branch, path):
+        """Hash every branch and value under `branch` and store the hashes
+        of the branches.
+        """
+        stack = [(_items(branch), path, _merkle_hasher(branch))]
+        while True:
+            items, ppath, h = stack[-1]
+            for k, v in items:
+                if k == 'sops' and not ppath:
+                    continue
+                if isinstance(v, (dict, list)):
+                    stack.append((_items(v), ppath + (k,), _merkle_hasher(v)))
+                    break
+                _merkle_update(h, k, _merkle_leaf(v).digest())
+            else:
+                stack.pop()
+                if ppath and self.store:
+                    self._put(ppath, h)
+                if not stack:
+                    return h
+                _merkle_update(stack[-1][2], ppath[-1], h.digest())
+
+    def hash_items(self, branch, path, changed=None, changed_hash=None):
+        """Hash `branch` from the hashes of its items, using `changed_hash`
+        for the item named `changed` and the table for the other branches.
+        """
+        h = _merkle_hasher(branch)
+        for k, v in _items(branch):
+            if k == 'sops' and not path:
+                continue
+            if k == changed:
+                digest = changed_hash.digest()
+            elif isinstance(v, (dict, list)):
+                digest = self._stored(v, path + (k,))
+            else:
+                digest = _merkle_leaf(v).digest()
+            _merkle_update(h, k, digest)
+        if path and self.store:
+            self._put(path, h)
+        return h
+
+    def _stored(self, branch, path):
+        try:
+            return unhexlify(self.hashes[format_tree_path(path)])
+        except (KeyError, TypeError, ValueError):
+            # not in the table, or not a hash, hash the branch instead
+            return self.hash_branch(branch, path).digest()
+
+    def _put(self, path, h):
+        name = format_tree_path(path)
+        if name not in self.hashes:
+            self.reordered = True
+        self.hashes[name] = h.hexdigest()
+
+    def _forget(self, path):
+        if not self.store:
+            return
+        prefix = format_tree_path(path)
+        for name in [name for name in self.hashes
+                     if name.startswith(prefix)]:
+            del self.hashes[name]
+            self.reordered = True
+
+
+def _merkle_hasher(branch):
+    return hashlib.sha512(b'L' if isinstance(branch, list) else b'D')
+
+
+def _merkle_update(hasher, k, digest):
+    if isinstance(k, int):
+        k = '%d' % k
+    name = k.encode('utf-8')
+    hasher.update(struct.pack('>I', len(name)) + name + digest)
+
+
+def _merkle_leaf(value):
+    return hashlib.sha512(
+        b'V' + json.dumps(value, default=str).encode('utf-8'))
+
+
+class LazyTree(Mapping):
+    """A read-only view of an encrypted tree that decrypts values on access.
+
+    Values are decrypted the first time they are read and memoized. The
+    MAC is only checked when `verify()` is called or, if `verify_on_iter`
+    is set, the first time a branch of the tree is iterated over. A sha512
+    MAC covers every value of the document, which are all decrypted to
+    check it, while a merkle MAC is checked on the branch alone.
+
+        tree = sops.load_file_into_tree(path, 'yaml')
+        key, tree = sops.get_key(tree)
+        secrets = sops.LazyTree(tree, key)
+        password = secrets['db']['password']
+
+    Branches are returned as LazyTree and LazyList views, the `sops` branch
+    is returned as is.
+
+    """
+
+    def __init__(self, tree, key, verify_on_iter=False, version=None,
+                 _state=None, _aad=b'', _path=()):
+        if _state is None:
+            if version is None:
+                version = tree_version(tree)
+            _state = _LazyState(tree, LeafCipher(key, version),
+                                verify_on_iter)
+        self._state = _state
+        self._branch = tree
+        self._aad = _aad
+        self._path = _path
+        self._carried = None
+
+    def _key_aad(self, k):
+        if not self._state.cipher.carry_aad:
+            return self._aad + k.encode('utf-8') + b':'
+        # documents older than 0.9 use the keys that precede a value in its
+        # branch as aad, compute them for the whole branch once
+        if self._carried is None:
+            carried = dict()
+            carry = bytearray(self._aad)
+            for key in self._branch:
+                if key == 'sops' and not self._path:
+                    continue
+                carry += key.encode('utf-8')
+                carried[key] = bytes(carry)
+            self._carried = carried
+        return self._carried[k]
+
+    def __getitem__(self, k):
+        value = self._branch[k]
+        if k == 'sops' and not self._path:
+            return value    # everything under the `sops` key stays in clear
+        return self._state.lookup(value, self._key_aad(k), self._path + (k,),
+                                  preserve=True)
+
+    def __iter__(self):
+        self._state.iterating(self._path)
+        return iter(self._branch)
+
+    def __contains__(self, k):
+        return k in self._branch
+
+    def __len__(self):
+        return len(self._branch)
+
+    def verify(self, paths=None):
+        """Check the MAC of the document.
+
+        With a merkle MAC, only the branch, or the tree paths relative to
+        it in `paths`, are checked. Otherwise, every value is decrypted.
+
+        """
+        if paths:
+            paths = [self._path + parse_tree_path(p) for p in paths]
+        self._state.verify(paths or [self._path])
+
+    def materialize(self):
+        """Return a decrypted copy of the branch."""
+        return self._state.materialize(self._branch, self._aad,
+                                       isRoot=not self._path)
+
+
+class LazyList(Sequence):
+    """A read-only view of an encrypted list, see LazyTree."""
+
+    def __init__(self, branch, state, aad, path):
+        self._state = state
+        self._branch = branch
+        self._aad = aad
+        self._path = path
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self._branch)
+        if i < 0:
+            raise IndexError("list index out of range")
+        return self._state.lookup(self._branch[i], self._aad,
+                                  self._path + (i,))
+
+    def __iter__(self):
+        self._state.iterating(self._path)
+        for i in range(len(self._branch)):
+            yield self[i]
+
+    def __len__(self):
+        return len(self._branch)
+
+    def __eq__(self, other):
+        if not isinstance(other, (list, LazyList)):
+            return False
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def verify(self):
+        """Check the MAC of the document, see LazyTree.verify."""
+        self._state.verify([self._path])
+
+    def materialize(self):
+        """Return a decrypted copy of the list."""
+        return self._state.materialize(self._branch, self._aad)
+
+
+class _LazyState(object):
+    """The state shared by the views of a LazyTree."""
+
+    def __init__(self, tree, cipher, verify_on_iter):
+        self.tree = tree
+        self.cipher = cipher
+        self.verify_on_iter = verify_on_iter
+        self.verified = False
+        self.verified_paths = set()
+        self.memo = dict()
+        self.lock = threading.Lock()
+
+    def lookup(self, value, aad, path, preserve=False):
+        """Return the view or the decrypted value of `value`."""
+        try:
+            return self.memo[path]
+        except KeyError:
+            pass
+        if isinstance(value, dict):
+            result = LazyTree(value, None, _state=self, _aad=aad, _path=path)
+        elif isinstance(value, list):
+            result = LazyList(value, self, aad, path)
+        else:
+            result = self.cipher.open(value, aad, path=path)[0]
+            preserved = _preserved_scalar_type()
+            if preserve and isinstance(value, preserved):
+                result = preserved(result)
+        return self.memo.setdefault(path, result)
+
+    def iterating(self, path):
+        if self.verify_on_iter and not self.verified:
+            self.verify([path])
+
+    def verify(self, paths=None):
+        with self.lock:
+            if self.verified:
+                return
+            if has_merkle_mac(self.tree):
+                self._verify_merkle(paths or [()])
+                return
+            digest = hashlib.sha512()
+            preserved = _preserved_scalar_type()
+            leaves = walk_leaves(self.tree, carry_aad=self.cipher.carry_aad)
+            for parent, k, v, aad, path in leaves:
+                value, cleartext = self.cipher.open(v, aad, path=path)
+                if cleartext is not None:
+                    digest.update(cleartext)
+                if not isinstance(parent, list) and isinstance(v, preserved):
+                    value = preserved(value)
+                self.memo.setdefault(path, value)
+            verify_mac(self.tree, self.cipher, digest)
+            self.verified = True
+
+    def _verify_merkle(self, paths):
+        # skip the paths under a branch that was already checked
+        paths = [path for path in paths
+                 if not any(path[:i] in self.verified_paths
+                            for i in range(len(path) + 1))]
+        if paths:
+            verify_merkle_mac(self.tree, self.cipher, paths)
+            self.verified_paths.update(paths)
+        self.verified = () in self.verified_paths
+
+    def materialize(self, branch, aad, isRoot=False):
+        branch = copy_tree(branch)
+        walk_and_decrypt(branch, None, aad=aad, isRoot=isRoot,
+                         ignoreMac=True, cipher=self.cipher)
+        return branch
+
+
+def _empty_like(branch):
+    empty = branch.__class__()
+    if hasattr(branch, 'copy_attributes'):
+        # keep the comments and formatting of ruamel.yaml branches
+        branch.copy_attributes(empty)
+    return empty
+
+
+def copy_tree(branch):
+    """Return a copy of the dicts and lists of a tree. Leaves are shared."""
+    root = _empty_like(branch)
+    stack = [(branch, root)]
+    while stack:
+        src, dst = stack.pop()
+        for k, v in _items(src):
+            if isinstance(v, (dict, list)):
+                child = _empty_like(v)
+                stack.append((v, child))
+                v = child
+            if isinstance(dst, list):
+                dst.append(v)
+            else:
+                dst[k] = v
+    return root
+
+
+def extract_paths(tree, paths):
+    """Return the branches or values of a tree at the paths provided.
+
+    With a single path, its branch or value is returned. With several
+    paths, a mapping of each path to its branch or value is returned.
+    Branches of a LazyTree are decrypted, and only them.
+
+    """
+    if isinstance(tree, LazyTree):
+        results = tree._branch.__class__()
+    else:
+        results = tree.__class__()
+    for path in paths:
+        result = truncate_tree(tree, path)
+        if isinstance(result, (LazyTree, LazyList)):
+            result = result.materialize()
+        results[path] = result
+    if len(paths) == 1:
+        return results[paths[0]]
+    return results
+
+
+def parse_value(value, tree=None):
+    """Return the value of a --set flag, decoded from JSON if it can be.
+
+    Objects are decoded into the mapping type of `tree`, if provided.
+
+    """
+    mapping = OrderedDict
+    if isinstance(tree, dict):
+        mapping = tree.__class__
+    try:
+        return json.loads(value, object_pairs_hook=mapping)
+    except ValueError:
+        return value
+
+
+def update_tree(tree, key, assignments=(), removals=(), ignoreMac=False,
+                mac_format=None, jobs=1):
+    """Set and remove values of an encrypted tree.
 
-    if not isinstance(value, bytes):
-        # if not bytes, convert to bytes
-        value = str(value).encode('utf-8')
+    `assignments` is a list of (path, value) pairs, and `removals` a list
+    of paths, as tuples of keys and list indexes. Values are set first,
+    creating missing branches, then removed.
 
-    if digest:
-        digest.update(value)
+    With a merkle MAC, only the new values are encrypted, and the MAC is
+    checked and updated on the changed paths alone. Otherwise, the tree is
+    decrypted to check and compute the sha512 MAC, and the ciphertext of
+    unchanged values is copied through when it is encrypted again.
 
-    # if we have a stash, and the value of cleartext has not changed,
-    # attempt to take the IV.
-    # if the stash has no existing value, or the cleartext has changed,
-    # generate new IV.
-    if stash and 'cleartext' in stash and stash['cleartext'] == value:
-        iv = stash['iv']
+    The updated tree is returned, the tree provided is left as is, also
+    when a path is invalid.
+
+    """
+    cipher = LeafCipher(key, tree_version(tree))
+    if has_merkle_mac(tree) and cipher.passthrough and \
+            mac_format in (None, 'merkle'):
+        # removing list items shifts the ones after them, the whole list
+        # has changed
+        changed = [path for path, value in assignments] + \
+            [path[:-1] if isinstance(path[-1], int) else path
+             for path in removals if path]
+        if not ignoreMac:
+            verify_merkle_mac(tree, cipher, changed)
+        tree = _copy_paths(tree, [path for path, value in assignments] +
+                           list(removals))
+        for path, value in assignments:
+            aad = b''.join(k.encode('utf-8') + b':' for k in path
+                           if not isinstance(k, int))
+            if isinstance(value, (dict, list)):
+                value = walk_and_encrypt(value, key, aad=aad, isRoot=False,
+                                         cipher=cipher)
+            else:
+                value = cipher.encrypt(value, aad=aad)
+            _assign(tree, path, value)
+        for path in removals:
+            _remove(tree, path)
+        store_merkle_mac(tree, cipher, changed)
+        return tree
+    stash = Stash()
+    tree = walk_and_decrypt(copy_tree(tree), key, stash=stash,
+                            ignoreMac=ignoreMac, cipher=cipher, jobs=jobs)
+    for path, value in assignments:
+        _assign(tree, path, value)
+    for path in removals:
+        _remove(tree, path)
+    if mac_format:
+        set_mac_format(tree, mac_format)
+    return walk_and_encrypt(tree, key, stash=stash, jobs=jobs)
+
+
+def _copy_paths(tree, paths):
+    """Return a copy of a tree that shares its branches with it, except
+    for the `sops` branch and the branches along `paths`, which are
+    copied, so that they can be changed.
+    """
+    root = _copy_branch(tree)
+    if 'sops' in root:
+        # the MAC and the hashes of the mac_tree are replaced in place
+        sops = root['sops'] = _copy_branch(root['sops'])
+        if isinstance(sops.get('mac_tree'), dict):
+            sops['mac_tree'] = _copy_branch(sops['mac_tree'])
+    copies = set([id(root)])
+    for path in paths:
+        branch = root
+        for k in path[:-1]:
+            try:
+                child = branch[k]
+            except (KeyError, IndexError, TypeError):
+                break
+            if not isinstance(child, (dict, list)):
+                break
+            if id(child) not in copies:
+                child = branch[k] = _copy_branch(child)
+                copies.add(id(child))
+            branch = child
+    return root
+
+
+def _copy_branch(branch):
+    copy = _empty_like(branch)
+    if isinstance(branch, list):
+        copy.extend(branch)
     else:
-        iv = os.urandom(32)
-    encryptor = Cipher(algorithms.AES(key),
-                       modes.GCM(iv),
-                       default_backend()).encryptor()
-    encryptor.authenticate_additional_data(aad)
-    enc_value = encryptor.update(value) + encryptor.finalize()
-    return "ENC[AES256_GCM,data:{value},iv:{iv}," \
-        "tag:{tag},type:{valtype}]".format(
-            value=b64encode(enc_value).decode('utf-8'),
-            iv=b64encode(iv).decode('utf-8'),
-            tag=b64encode(encryptor.tag).decode('utf-8'),
-            valtype=valtype)
-
-
-def get_key(tree, need_key=False):
+        copy.update(branch)
+    return copy
+
+
+def _assign(tree, path, value):
+    if not path or path[0] == 'sops':
+        raise TreePathError("cannot set tree path: tree%s" %
+                            format_tree_path(path))
+    branch = tree
+    for i, k in enumerate(path):
+        if isinstance(branch, list) and isinstance(k, int) and \
+                k <= len(branch):
+            if k == len(branch):
+                branch.append(tree.__class__())
+        elif not isinstance(branch, dict) or isinstance(k, int):
+            raise TreePathError("cannot set tree path: tree%s" %
+                                format_tree_path(path))
+        if i == len(path) - 1:
+            branch[k] = value
+        elif isinstance(branch, dict) and k not in branch:
+            branch[k] = tree.__class__()
+        branch = branch[k]
+
+
+def _remove(tree, path):
+    if not path or path[0] == 'sops':
+        raise TreePathError("cannot unset tree path: tree%s" %
+                            format_tree_path(path))
+    try:
+        del truncate_tree(tree, format_tree_path(path[:-1]))[path[-1]]
+    except (KeyError, IndexError, TypeError, TreePathError):
+        raise TreePathError("tree path not found: tree%s" %
+                            format_tree_path(path))
+
+
+def load(path, filetype=None, hedge_delay=None):
+    """Load the encrypted document at `path` into a Document.
+
+    The type of the file is detected from its extension if `filetype` is
+    not provided. `hedge_delay` is passed to get_key when the data key is
+    decrypted.
+
+    """
+    if filetype is None:
+        filetype = detect_filetype(path)
+    tree = load_file_into_tree(path, filetype)
+    if not isinstance(tree, dict) or not isinstance(tree.get('sops'), dict):
+        raise DocumentError("%s is not encrypted with sops" % path)
+    return Document(tree, path=path, filetype=filetype,
+                    hedge_delay=hedge_delay)
+
+
+def decrypt_tree(tree, key, ignore_mac=False, jobs=1):
+    """Return a decrypted copy of an encrypted tree.
+
+    The MAC is checked unless `ignore_mac` is set, and MacError is raised
+    if it doesn't match.
+
+    """
+    cipher = LeafCipher(key, tree_version(tree))
+    return walk_and_decrypt(copy_tree(tree), key, ignoreMac=ignore_mac,
+                            cipher=cipher, jobs=jobs)
+
+
+def encrypt_tree(tree, key, stash=None, jobs=1):
+    """Return an encrypted copy of a tree, with its MAC.
+
+    If a `Stash` filled when the tree was decrypted is provided, unchanged
+    values keep their ciphertext.
+
+    """
+    return walk_and_encrypt(copy_tree(tree), key, stash=stash, jobs=jobs)
+
+
+def timestamp():
+    """Return the current UTC time, as stored in documents."""
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def tree_version(tree):
+    """Return the version of sops a tree was encrypted with."""
+    try:
+        return tree['sops']['version']
+    except (KeyError, TypeError):
+        return VERSION
+
+
+class Document(object):
+    """An encrypted document, and the data key to decrypt it.
+
+    The data key is decrypted with the master keys of the document the
+    first time it is needed, and kept for the life of the Document. Errors
+    are raised as SopsError.
+
+        doc = sops.load('secrets.yaml')
+        password = doc.decrypt()['db']['password']
+        doc.update([(('db', 'password'), 'hunter2')])
+        doc.save()
+
+    """
+
+    def __init__(self, tree, key=None, path=None, filetype=None,
+                 hedge_delay=None):
+        self.tree = tree
+        self.path = path
+        self.filetype = filetype
+        self.hedge_delay = hedge_delay
+        self._key = key
+
+    @property
+    def key(self):
+        """The data key of the document, decrypted by get_key with the
+        `hedge_delay` of the Document.
+        """
+        if self._key is None:
+            self._key, self.tree = get_key(self.tree,
+                                           hedge_delay=self.hedge_delay)
+        return self._key
+
+    def decrypt(self, ignore_mac=False, jobs=1):
+        """Return a decrypted copy of the tree, see decrypt_tree."""
+        return decrypt_tree(self.tree, self.key, ignore_mac=ignore_mac,
+                            jobs=jobs)
+
+    def lazy(self, verify_on_iter=False):
+        """Return a LazyTree view of the document."""
+        return LazyTree(self.tree, self.key, verify_on_iter=verify_on_iter)
+
+    def extract(self, paths, ignore_mac=False):
+        """Return the decrypted branches or values at the tree paths
+        provided, see extract_paths.
+        """
+        lazy = self.lazy()
+        if not ignore_mac:
+            lazy.verify(paths)
+        return extract_paths(lazy, paths)
+
+    def update(self, assignments=(), removals=(), ignore_mac=False, jobs=1):
+        """Set and remove values of the tree, see update_tree."""
+        self.tree = update_tree(self.tree, self.key, assignments, removals,
+                                ignoreMac=ignore_mac, jobs=jobs)
+
+    def save(self, path=None, filetype=None):
+        """Write the encrypted document to `path`, or to the file it was
+        loaded from, and return the path written to.
+        """
+        if filetype is None:
+            filetype = self.filetype
+        if filetype == 'bytes':
+            # encrypted binary files are stored in a json enveloppe
+            filetype = 'json'
+        if path is None:
+            path = self.path
+        return write_file(self.tree, path=path, filetype=filetype)
+
+
+def _monotonic():
+    # time.monotonic doesn't exist in python 2
+    return getattr(time, 'monotonic', time.time)()
+
+
+class KeyCache(object):
+    """Keep the data keys decrypted by master keys in memory, so loading
+    the same document again, or another document that shares its data
+    key, doesn't call KMS or gpg.
+
+    Keys are indexed by the type and identity of the master key (ARN and
+    role, or fingerprint) and the encrypted data key. They expire `ttl`
+    seconds after they were decrypted, and the least recently used key is
+    evicted when more than `maxsize` are kept. A `ttl` of 0 disables the
+    cache.
+
+    """
+
+    def __init__(self, maxsize=256, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    _clock = staticmethod(lambda: _monotonic())
+
+    @staticmethod
+    def index(kind, entry):
+        """Return the index of the data key encrypted in a master key
+        entry of type `kind`, 'kms' or 'pgp'.
+        """
+        if kind == 'kms':
+            identity = (entry.get('arn'), entry.get('role'))
+        else:
+            identity = (entry.get('fp'),)
+        return (kind,) + identity + (entry.get('enc'),)
+
+    def get(self, kind, entry):
+        """Return the data key of a master key entry, or None."""
+        index = self.index(kind, entry)
+        with self._lock:
+            cached = self._keys.pop(index, None)
+            if cached is None or cached[1] <= self._clock():
+                self.misses += 1
+                return None
+            # reinserted at the end, as the most recently used
+            self._keys[index] = cached
+            self.hits += 1
+            return cached[0]
+
+    def put(self, kind, entry, key):
+        """Save the data key of a master key entry."""
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+        index = self.index(kind, entry)
+        with self._lock:
+            self._keys.pop(index, None)
+            self._keys[index] = (key, self._clock() + self.ttl)
+            while len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+    def invalidate(self, kind=None, entry=None):
+        """Forget the data key of a master key entry, every key of a type
+        of master key, or every key if no argument is given.
+        """
+        with self._lock:
+            if entry is not None:
+                self._keys.pop(self.index(kind, entry), None)
+                return
+            for index in list(self._keys):
+                if kind is None or index[0] == kind:
+                    del self._keys[index]
+
+    def stats(self):
+        """Return the number of hits, misses and keys of the cache."""
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        size=len(self._keys))
+
+
+KEY_CACHE = KeyCache()
+
+
+def get_key(tree, need_key=False, hedge_delay=None):
     """Obtain a 256 bits symetric key.
 
     If the document contain an encrypted key, try to decrypt it using
     KMS or PGP. Otherwise, generate a new random key.
 
+    The master keys are tried one after the other, or hedged after
+    `hedge_delay` seconds, which defaults to HEDGE_DELAY, see
+    get_key_hedged.
+
     """
     if need_key:
         # if we're here, the tree doesn't have a key yet. generate
         # one and store it in the tree
         print("please wait while a data encryption key is being generated"
               " and stored securely", file=sys.stderr)
-        key = os.urandom(32)
-        has_at_least_one_method = False
-        if 'kms' in tree['sops']:
-            i = -1
-            for entry in tree['sops']['kms']:
-                i += 1
-                updated = encrypt_key_with_kms(key, entry)
-                if 'enc' in updated and updated['enc'] != "":
-                    tree['sops']['kms'][i] = updated
-                    has_at_least_one_method = True
-        if 'pgp' in tree['sops']:
-            i = -1
-            for entry in tree['sops']['pgp']:
-                i += 1
-                updated = encrypt_key_with_pgp(key, entry)
-                if 'enc' in updated and updated['enc'] != "":
-                    tree['sops']['pgp'][i] = updated
-                    has_at_least_one_method = True
-        if not has_at_least_one_method:
-            panic("No method available to store new data key, aborting", 37)
-        return key, tree
-    key = get_key_from_kms(tree)
-    if not (key is None):
-        return key, tree
-    key = get_key_from_pgp(tree)
-    if not (key is None):
-        return key, tree
-    panic("could not retrieve a key to encrypt/decrypt the tree",
-          error_code=128)
+        return generate_key(tree), tree
+    if hedge_delay is None:
+        hedge_delay = HEDGE_DELAY
+    if hedge_delay is not None:
+        key = get_key_hedged(tree, hedge_delay)
+        if key is not None:
+            return key, tree
+        raise MasterKeyError("could not retrieve a key to encrypt/decrypt "
+                             "the tree")
+    for decrypt_key, entry, i in master_key_attempts(tree):
+        key = decrypt_key(entry, i)
+        if not (key is None):
+            return key, tree
+    raise MasterKeyError("could not retrieve a key to encrypt/decrypt the "
+                         "tree")
+
+
+HEDGE_DELAY = None
+
+
+def get_key_hedged(tree, delay=0):
+    """Decrypt the data key with the KMS then PGP master keys of the tree,
+    and return the first 32 bytes key decrypted, or None.
+
+    The master keys are tried in the order of master_key_attempts. The
+    first one is started, and the next one when the previous ones haven't
+    answered within `delay` seconds, or as soon as
+    one fails. With a `delay` of 0, every master key is tried at once.
+    Once a key is decrypted, no other master key is started, and those
+    still running are abandoned in the background.
 
+    """
+    attempts = master_key_attempts(tree)
+    results = queue.Queue()
 
-def get_key_from_kms(tree):
-    """Get the key form the KMS tree leave."""
-    try:
-        kms_tree = tree['sops']['kms']
-    except KeyError:
-        return None
-    i = -1
-    for entry in kms_tree:
-        i += 1
+    def attempt(decrypt_key, entry, i):
         try:
-            enc = entry['enc']
-        except KeyError:
-            continue
-        if 'arn' not in entry or entry['arn'] == "":
-            print("KMS ARN not found, skipping entry %s" % i, file=sys.stderr)
-            continue
-        kms = get_aws_session_for_entry(entry)
-        if kms is None:
-            print("failed to initialize AWS KMS client for entry",
-                  file=sys.stderr)
+            results.put(decrypt_key(entry, i))
+        except Exception as e:
+            print("[warning] failed to decrypt key with entry %s: %s" %
+                  (i, e), file=sys.stderr)
+            results.put(None)
+
+    def start(n):
+        thread = threading.Thread(target=attempt, args=attempts[n])
+        thread.daemon = True
+        thread.start()
+
+    started = answered = 0
+    while answered < len(attempts):
+        remaining = started < len(attempts)
+        if remaining and (started == answered or delay <= 0):
+            start(started)
+            started += 1
             continue
         try:
-            kms_response = kms.decrypt(CiphertextBlob=b64decode(enc))
-        except Exception as e:
-            print("[warning] skipping kms %s: %s " % (entry['arn'], e),
-                  file=sys.stderr)
+            key = results.get(timeout=delay if remaining else None)
+        except queue.Empty:
+            # no answer within the delay, hedge with the next master key
+            start(started)
+            started += 1
             continue
-        return kms_response['Plaintext']
+        answered += 1
+        if key is not None and len(key) == 32:
+            return key
+    return None
+
+
+def master_key_attempts(tree, kinds=('kms', 'pgp')):
+    """Return the (decrypt_key, entry, i) calls that decrypt the data key
+    with the master keys of the tree, in the order to try them.
+
+    Master keys without statistics in MASTER_KEY_STATS come first, to
+    learn about them, then the healthy ones from the fastest, then the
+    others. Master keys of the same rank keep their order in the tree,
+    KMS first.
+
+    """
+    decrypt_keys = {'kms': decrypt_key_with_kms, 'pgp': decrypt_key_with_pgp}
+    attempts = []
+    for kind in kinds:
+        for i, entry in enumerate(tree['sops'].get(kind) or []):
+            rank = MASTER_KEY_STATS.rank(kind, entry)
+            attempts.append((rank, len(attempts),
+                             (decrypt_keys[kind], entry, i)))
+    attempts.sort(key=lambda attempt: attempt[:2])
+    return [attempt[2] for attempt in attempts]
+
+
+class MasterKeyStats(object):
+    """The success rates and latencies of master keys, measured when they
+    decrypt data keys, and kept in a JSON file at `path`, or in memory
+    only if `path` is None.
+
+    Each master key has a number of calls and failures, a health between
+    0 and 1 and a latency in milliseconds, both moving averages of its
+    last calls, and the time of its last call. Master keys that failed
+    more often than not lately are unhealthy, and tried again as unknown
+    master keys after `retry_after` seconds.
+
+    Several sops processes can record calls at once, such as the workers
+    of --recursive: each call is added to the statistics read from the
+    file, under a lock on the file, rather than to those of the process.
+
+    """
+    alpha = 0.3
+
+    def __init__(self, path=None, retry_after=86400):
+        self.path = path
+        self.retry_after = retry_after
+        self._records = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def name(kind, entry):
+        """Return the name of the master key of an entry, as shown by
+        `sops stats`.
+        """
+        if kind == 'kms':
+            name = entry.get('arn') or ''
+            if entry.get('role'):
+                name += '+' + entry['role']
+        else:
+            name = entry.get('fp') or ''
+        return '%s:%s' % (kind, name)
+
+    def records(self):
+        """Return the statistics of each master key, by name."""
+        if self._records is None:
+            self._records = dict()
+            if self.path is not None:
+                try:
+                    with open(self.path) as stats_file:
+                        self._records = json.load(stats_file)
+                except (IOError, OSError, ValueError):
+                    pass
+        return self._records
+
+    def _file_lock(self):
+        """Lock the file of the statistics, until the returned file is
+        closed, or return None if it can't be locked.
+        """
+        if self.path is None or fcntl is None:
+            return None
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            lock = open(self.path + '.lock', 'a')
+        except (IOError, OSError):
+            return None
+        try:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        except (IOError, OSError):
+            lock.close()
+            return None
+        return lock
+
+    def record(self, kind, entry, success, latency):
+        """Add a call of `latency` seconds to the statistics of a master
+        key, and save them.
+        """
+        with self._lock:
+            lock = self._file_lock()
+            try:
+                self._record(kind, entry, success, latency)
+            finally:
+                if lock is not None:
+                    lock.close()
+
+    def _record(self, kind, entry, success, latency):
+        if self.path is not None:
+            # read the calls recorded by other processes since the last
+            # time, so that they are kept
+            self._records = None
+        records = self.records()
+        name = self.name(kind, entry)
+        stats = records.setdefault(name, dict(
+            calls=0, failures=0, health=1.0 if success else 0.0,
+            latency=None))
+        stats['calls'] += 1
+        stats['health'] += self.alpha * ((1 if success else 0) -
+                                         stats['health'])
+        if success:
+            latency = latency * 1000
+            if stats['latency'] is not None:
+                latency = stats['latency'] + \
+                    self.alpha * (latency - stats['latency'])
+            stats['latency'] = latency
+        else:
+            stats['failures'] += 1
+        stats['last'] = time.time()
+        self.save()
+
+    def rank(self, kind, entry):
+        """Return a key to sort master keys in the order to try them."""
+        return self._rank(self.records().get(self.name(kind, entry)))
+
+    def _rank(self, stats):
+        if stats is None:
+            return (0, 0)
+        if stats['health'] < 0.5 or stats['latency'] is None:
+            if time.time() - stats.get('last', 0) > self.retry_after:
+                return (0, 0)
+            return (2, 0)
+        return (1, stats['latency'])
+
+    def reset(self):
+        """Forget the statistics of every master key."""
+        with self._lock:
+            lock = self._file_lock()
+            try:
+                self._records = dict()
+                self.save()
+            finally:
+                if lock is not None:
+                    lock.close()
+
+    def save(self):
+        if self.path is None:
+            return
+        try:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory, 0o700)
+            # replace the file at once, for other sops processes reading it
+            fd, tmppath = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as stats_file:
+                json.dump(self._records, stats_file, indent=1,
+                          sort_keys=True)
+            os.rename(tmppath, self.path)
+        except (IOError, OSError) as e:
+            print("[warning] could not save master key statistics to %s: "
+                  "%s" % (self.path, e), file=sys.stderr)
+
+
+def stats_path():
+    """Return the path of the master key statistics, in the XDG cache
+    directory.
+    """
+    cache = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache, 'sops', 'master_keys.json')
+
+
+MASTER_KEY_STATS = MasterKeyStats(stats_path())
+
+
+def stats_main(argv):
+    """Run the `sops stats` command."""
+    parser = argparse.ArgumentParser(
+        prog='sops stats',
+        description="show the success rates and latencies of the master "
+                    "keys, in the order sops tries them")
+    parser.add_argument('--reset', action='store_true',
+                        help="forget the statistics of every master key")
+    args = parser.parse_args(argv)
+    if args.reset:
+        MASTER_KEY_STATS.reset()
+        return
+    records = MASTER_KEY_STATS.records()
+    print("statistics in %s" % MASTER_KEY_STATS.path)
+    print("%6s %9s %7s %11s  %-19s  %s" % (
+        "calls", "failures", "health", "latency ms", "last call",
+        "master key"))
+    for name in sorted(records, key=lambda name: (
+            MASTER_KEY_STATS._rank(records[name]), name)):
+        stats = records[name]
+        latency = '-'
+        if stats['latency'] is not None:
+            latency = '%.1f' % stats['latency']
+        last = datetime.fromtimestamp(stats['last']).strftime(
+            '%Y-%m-%d %H:%M:%S')
+        print("%6d %9d %6d%% %11s  %s  %s" % (
+            stats['calls'], stats['failures'], stats['health'] * 100,
+            latency, last, name))
+
+
+def get_key_from_kms(tree):
+    """Get the key form the KMS tree leave."""
+    for decrypt_key, entry, i in master_key_attempts(tree, ['kms']):
+        key = decrypt_key(entry, i)
+        if key is not None:
+            return key
     return None
 
 
+def decrypt_key_with_kms(entry, i=0):
+    """Decrypt the key with the KMS entry number `i`, or return None."""
+    if 'enc' not in entry:
+        return None
+    if 'arn' not in entry or entry['arn'] == "":
+        print("KMS ARN not found, skipping entry %s" % i, file=sys.stderr)
+        return None
+    return _decrypt_key('kms', entry, unwrap_key_with_kms)
+
+
+def _decrypt_key(kind, entry, unwrap):
+    """Return the data key of a master key entry from the key cache, from
+    the sops agent if SOPS_AGENT_SOCK is set, or decrypted by `unwrap`.
+    """
+    key = KEY_CACHE.get(kind, entry)
+    if key is not None:
+        return key
+    sock = os.environ.get('SOPS_AGENT_SOCK')
+    if sock:
+        from sops import agent
+        try:
+            key = agent.request_key(sock, kind, entry)
+        except agent.AgentError as e:
+            print("[warning] sops agent unavailable, decrypting the data "
+                  "key directly: %s" % e, file=sys.stderr)
+            key = unwrap_and_record(kind, entry, unwrap)
+    else:
+        key = unwrap_and_record(kind, entry, unwrap)
+    if key is not None:
+        KEY_CACHE.put(kind, entry, key)
+    return key
+
+
+def unwrap_and_record(kind, entry, unwrap):
+    """Decrypt the data key of a master key entry with `unwrap`, record
+    the call in MASTER_KEY_STATS, and return the key or None.
+    """
+    start = _monotonic()
+    key = unwrap(entry)
+    MASTER_KEY_STATS.record(kind, entry, key is not None,
+                            _monotonic() - start)
+    return key
+
+
+def unwrap_key_with_kms(entry):
+    """Decrypt the data key of a KMS entry with KMS, or return None."""
+    kms = get_aws_session_for_entry(entry)
+    if kms is None:
+        print("failed to initialize AWS KMS client for entry",
+              file=sys.stderr)
+        return None
+    try:
+        kms_response = KMS_LIMITER.call(
+            kms_region(entry['arn']), kms.decrypt,
+            CiphertextBlob=b64decode(entry['enc']))
+    except Exception as e:
+        print("[warning] skipping kms %s: %s " % (entry['arn'], e),
+              file=sys.stderr)
+        return None
+    return kms_response['Plaintext']
+
+
+def generate_key(tree):
+    """Generate a new data key, encrypt it with the master keys of the
+    tree, and return it.
+
+    When the tree has a single KMS master key, KMS generates the data key
+    and returns it encrypted in one GenerateDataKey call, in place of an
+    Encrypt call. With several KMS master keys, the data key is generated
+    locally, so that they are all called at once. Raise MasterKeyError if
+    no master key could encrypt the data key.
+
+    """
+    kms_entries = [i for i, entry in enumerate(tree['sops'].get('kms') or [])
+                   if entry.get('arn')]
+    key = None
+    if len(kms_entries) == 1:
+        i = kms_entries[0]
+        key, entry = generate_key_with_kms(_copy_entry(tree['sops']['kms'][i]))
+    if key is not None:
+        tree['sops']['kms'][i] = entry
+        KEY_CACHE.put('kms', entry, key)
+        encrypt_key_with_master_keys(key, tree, exclude=[('kms', i)])
+        return key
+    key = os.urandom(32)
+    if not encrypt_key_with_master_keys(key, tree):
+        raise MasterKeyError("No method available to store new data "
+                             "key, aborting", 37)
+    return key
+
+
+def _copy_entry(entry):
+    copy = _empty_like(entry)
+    copy.update(entry)
+    return copy
+
+
+def encrypt_key_with_master_keys(key, tree, only_missing=False, exclude=()):
+    """Encrypt the data key with the KMS and PGP master keys of the tree,
+    and store it in their entries. Return the number of entries updated.
+
+    The KMS master keys are called concurrently by MASTER_KEY_WORKERS
+    threads, and the PGP ones together in one gpg process alongside, see
+    encrypt_key_with_pgp_entries. Entries that fail, or take more than
+    MASTER_KEY_TIMEOUT seconds, are reported and left unchanged, and are
+    neither counted nor added to KEY_CACHE. With `only_missing`, only the
+    entries without an encrypted key are updated. The (kind, index) pairs
+    of `exclude` are skipped.
+
+    """
+    entries = dict(kms=[], pgp=[])
+    for kind in ('kms', 'pgp'):
+        for i, entry in enumerate(tree['sops'].get(kind) or []):
+            if (kind, i) in exclude:
+                continue
+            if only_missing:
+                if 'enc' in entry and entry['enc'] != "":
+                    continue
+                print("updating %s entry" % kind)
+            # the entry is updated on a copy, that a master key which
+            # times out can't change after the tree is written. The
+            # ciphertext of the previous key is cleared on the copy, so
+            # that an entry that fails isn't taken for one that succeeded
+            entry = _copy_entry(entry)
+            if 'enc' in entry:
+                entry['enc'] = ""
+            entries[kind].append((i, entry))
+    # a task encrypts the key with a list of entries, and returns them
+    tasks = [('kms', [(i, entry)],
+              lambda key, entries: [encrypt_key_with_kms(key, entries[0])])
+             for i, entry in entries['kms']]
+    if entries['pgp']:
+        tasks.append(('pgp', entries['pgp'], _encrypt_key_with_pgp_in_turn))
+    results = _map_with_timeout(
+        lambda task: task[2](key, [entry for i, entry in task[1]]), tasks,
+        MASTER_KEY_WORKERS, MASTER_KEY_TIMEOUT)
+    count = 0
+    for (kind, task_entries, encrypt_key), result in zip(tasks, results):
+        for n, (i, entry) in enumerate(task_entries):
+            if result is _TIMED_OUT:
+                print("timed out encrypting key with %s entry %d after %ss, "
+                      "skipping it" % (kind, i, MASTER_KEY_TIMEOUT),
+                      file=sys.stderr)
+            elif isinstance(result, Exception):
+                print("failed to encrypt key with %s entry %d: %s, skipping "
+                      "it" % (kind, i, result), file=sys.stderr)
+            elif 'enc' in result[n] and result[n]['enc'] != "":
+                tree['sops'][kind][i] = result[n]
+                KEY_CACHE.put(kind, result[n], key)
+                count += 1
+    return count
+
+
+MASTER_KEY_WORKERS = 16
+
+# gpg processes that share a GNUPGHOME wait on the locks of its keyring,
+# they take longer to run concurrently than one after the other
+_GPG_LOCK = threading.Lock()
+
+MASTER_KEY_TIMEOUT = 60
+
+_TIMED_OUT = object()
+
+
+def _encrypt_key_with_pgp_in_turn(key, entries):
+    with _GPG_LOCK:
+        return encrypt_key_with_pgp_entries(key, entries)
+
+
+def _map_with_timeout(func, items, workers, timeout):
+    """Return the results of `func` on each item, computed by up to
+    `workers` threads. The result of an item is the exception it raised,
+    or _TIMED_OUT if it didn't return within `timeout` seconds.
+
+    A thread that times out is abandoned and replaced, it keeps running
+    in the background until `func` returns, without blocking the exit of
+    the process.
+
+    """
+    results = [None] * len(items)
+    pending = list(reversed(range(len(items))))
+    running = dict()
+    cond = threading.Condition()
+
+    def work():
+        while True:
+            with cond:
+                if not pending:
+                    return
+                i = pending.pop()
+                running[i] = _monotonic()
+                cond.notify()
+            try:
+                result = func(items[i])
+            except Exception as e:
+                result = e
+            with cond:
+                if running.pop(i, None) is not None:
+                    results[i] = result
+                    cond.notify()
+
+    def start_worker():
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+
+    with cond:
+        for n in range(max(1, min(workers, len(items)))):
+            start_worker()
+        while True:
+            now = _monotonic()
+            for i, start in list(running.items()):
+                if now - start >= timeout:
+                    del running[i]
+                    results[i] = _TIMED_OUT
+                    start_worker()
+            if not pending and not running:
+                break
+            waits = [start + timeout - now for start in running.values()]
+            cond.wait(max(0.01, min(waits)) if waits else None)
+    return results
+
+
 def encrypt_key_with_kms(key, entry):
     """Encrypt the key using the KMS."""
     if 'arn' not in entry or entry['arn'] == "":
@@ -796,79 +2733,350 @@ def encrypt_key_with_kms(key, entry):
               file=sys.stderr)
         return entry
     try:
-        kms_response = kms.encrypt(KeyId=entry['arn'], Plaintext=key)
+        kms_response = KMS_LIMITER.call(
+            kms_region(entry['arn']), kms.encrypt,
+            KeyId=entry['arn'], Plaintext=key)
     except Exception as e:
         print("failed to encrypt key using kms arn %s: %s, skipping it" %
               (entry['arn'], e), file=sys.stderr)
-        return None
+        return entry
     entry['enc'] = b64encode(
         kms_response['CiphertextBlob']).decode('utf-8')
-    entry['created_at'] = NOW
+    entry['created_at'] = timestamp()
     return entry
 
 
+def generate_key_with_kms(entry):
+    """Generate a new data key with KMS, and return it along with the
+    entry holding it encrypted, or (None, entry).
+    """
+    if 'arn' not in entry or entry['arn'] == "":
+        return None, entry
+    kms = get_aws_session_for_entry(entry)
+    if kms is None:
+        print("failed to initialize AWS KMS client for entry",
+              file=sys.stderr)
+        return None, entry
+    try:
+        kms_response = KMS_LIMITER.call(
+            kms_region(entry['arn']), kms.generate_data_key,
+            KeyId=entry['arn'], KeySpec='AES_256')
+        key = kms_response['Plaintext']
+        enc = b64encode(kms_response['CiphertextBlob']).decode('utf-8')
+    except Exception as e:
+        print("failed to generate key using kms arn %s: %s, generating it "
+              "locally" % (entry['arn'], e), file=sys.stderr)
+        return None, entry
+    entry['enc'] = enc
+    entry['created_at'] = timestamp()
+    return key, entry
+
+
 def get_aws_session_for_entry(entry):
-    """Return a boto3 session using a role if one exists in the entry"""
-    # extract the region from the ARN
-    # arn:aws:kms:{REGION}:...
-    res = re.match('^arn:aws:kms:(.+):([0-9]+):key/(.+)$', entry['arn'])
-    if res is None:
+    """Return a KMS client for the region of the entry, using a role if
+    one exists in the entry. Clients are reused from AWS_CLIENTS.
+    """
+    region = kms_region(entry['arn'])
+    if region is None:
         print("Invalid ARN '%s' in entry" % entry['arn'], file=sys.stderr)
         return None
-    try:
-        region = res.group(1)
-    except:
-        print("Unable to find region from ARN '%s' in entry" %
-              entry['arn'], file=sys.stderr)
-        return None
-    # if there are no role to assume, return the client directly
-    if not ('role' in entry):
-        return boto3.client('kms', region_name=region)
-    # otherwise, create a client using temporary tokens that assume the role
-    try:
-        client = boto3.client('sts')
-        role = client.assume_role(RoleArn=entry['role'],
-                                  RoleSessionName='sops@'+gethostname())
-    except Exception as e:
-        print("Unable to switch roles: %s" % e, file=sys.stderr)
+    return AWS_CLIENTS.kms_client(region, entry.get('role'))
+
+
+def kms_region(arn):
+    """Return the region of a KMS ARN, or None."""
+    # arn:aws:kms:{REGION}:...
+    res = re.match('^arn:aws:kms:(.+):([0-9]+):key/(.+)$', arn)
+    if res is None:
         return None
+    return res.group(1)
+
+
+class AwsClientPool(object):
+    """Keep a boto3 KMS client for each region and role, so their
+    connections are reused, and the temporary credentials of assumed roles
+    until `expiry_margin` seconds before they expire.
+    """
+
+    def __init__(self, expiry_margin=300):
+        self.expiry_margin = expiry_margin
+        self._clients = dict()
+        self._credentials = dict()
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    _clock = staticmethod(time.time)
+
+    def clear(self):
+        """Forget every client and credentials."""
+        with self._lock:
+            self._clients.clear()
+            self._credentials.clear()
+
+    def kms_client(self, region, role=None):
+        """Return the KMS client of a region, using the credentials of an
+        assumed role if `role` is set, or None.
+        """
+        index = (region, role)
+        with self._lock:
+            # clients of different regions and roles are created
+            # concurrently, the same one only once
+            lock = self._locks.setdefault(index, threading.Lock())
+        with lock:
+            client, expiration = self._clients.get(index, (None, None))
+            if client is not None and not self._expired(expiration):
+                return client
+            if role is None:
+                client = self._client('kms', region_name=region)
+            else:
+                credentials = self._assume_role(role)
+                if credentials is None:
+                    return None
+                expiration = credentials['Expiration']
+                client = self._client(
+                    'kms', region_name=region,
+                    aws_access_key_id=credentials['AccessKeyId'],
+                    aws_secret_access_key=credentials['SecretAccessKey'],
+                    aws_session_token=credentials['SessionToken'])
+            self._clients[index] = (client, expiration)
+            return client
+
+    def _expired(self, expiration):
+        return expiration is not None and \
+            self._clock() >= expiration - self.expiry_margin
+
+    def _client(self, *args, **kwargs):
+        # boto3 takes longer to import than the rest of sops, it is only
+        # imported when a client is needed
+        import boto3
+        # the default boto3 session isn't thread safe
+        with self._lock:
+            return boto3.client(*args, **kwargs)
+
+    def _assume_role(self, role):
+        """Return the temporary credentials of a role, with their
+        expiration as a timestamp, or None.
+        """
+        credentials = self._credentials.get(role)
+        if credentials is not None and \
+           not self._expired(credentials['Expiration']):
+            return credentials
+        try:
+            client = self._client('sts')
+            assumed = client.assume_role(RoleArn=role,
+                                         RoleSessionName='sops@' +
+                                         gethostname())
+        except Exception as e:
+            print("Unable to switch roles: %s" % e, file=sys.stderr)
+            return None
+        try:
+            print("Assuming AWS role '%s'" % assumed['AssumedRoleUser']['Arn'],
+                  file=sys.stderr)
+            credentials = dict(
+                (name, assumed['Credentials'][name])
+                for name in ('AccessKeyId', 'SecretAccessKey', 'SessionToken'))
+            credentials['Expiration'] = calendar.timegm(
+                assumed['Credentials']['Expiration'].utctimetuple())
+        except KeyError:
+            return None
+        self._credentials[role] = credentials
+        return credentials
+
+
+AWS_CLIENTS = AwsClientPool()
+
+THROTTLING_ERRORS = ('ThrottlingException', 'Throttling',
+                     'TooManyRequestsException', 'RequestLimitExceeded')
+
+
+def _is_throttling(error):
+    """Tell if a boto3 error reports a throttled request."""
     try:
-        print("Assuming AWS role '%s'" % role['AssumedRoleUser']['Arn'],
-              file=sys.stderr)
-        keyid = role['Credentials']['AccessKeyId']
-        secretkey = role['Credentials']['SecretAccessKey']
-        token = role['Credentials']['SessionToken']
-        return boto3.client('kms', region_name=region,
-                            aws_access_key_id=keyid,
-                            aws_secret_access_key=secretkey,
-                            aws_session_token=token)
-    except KeyError:
-        return None
+        return error.response['Error']['Code'] in THROTTLING_ERRORS
+    except (AttributeError, KeyError, TypeError):
+        return False
+
+
+class KmsRateLimiter(object):
+    """Limit the KMS requests sent to each region, and retry the requests
+    that KMS throttles, so bulk operations run at the rate KMS sustains.
+
+    Each region has a bucket of tokens that holds a second of requests and
+    refills at `rate` requests per second, or at the rate of the region in
+    `rates`. A rate of 0 doesn't limit the requests. A throttled request
+    halves the rate of its region, which then grows back by a twentieth of
+    its configured value with each successful request, and is retried up
+    to `retries` times after a random delay, of up to `base_delay` seconds
+    doubled at each attempt, and at most `max_delay`. If `semaphore` is
+    set, each request holds it while it is sent, which bounds the requests
+    in flight, across processes with a multiprocessing semaphore.
+
+    """
+
+    def __init__(self, rate=0, retries=5, base_delay=0.1, max_delay=5,
+                 semaphore=None):
+        self.rate = rate
+        self.semaphore = semaphore
+        self.rates = dict()
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._buckets = dict()
+        self._metrics = dict()
+        self._lock = threading.Lock()
+
+    _clock = staticmethod(lambda: _monotonic())
+    _sleep = staticmethod(time.sleep)
+    _random = staticmethod(random.random)
+
+    def configure(self, rates):
+        """Set the rates from a comma separated list of requests per
+        second, for every region, or for one region as REGION=RATE.
+        Raise ValueError if a rate isn't a number.
+        """
+        for item in rates.split(','):
+            region, _, rate = item.strip().rpartition('=')
+            if region:
+                self.rates[region] = float(rate)
+            else:
+                self.rate = float(rate)
+        with self._lock:
+            self._buckets.clear()
+
+    def clear(self):
+        """Forget the buckets and metrics of every region."""
+        with self._lock:
+            self._buckets.clear()
+            self._metrics.clear()
+
+    def _bucket(self, region):
+        bucket = self._buckets.get(region)
+        if bucket is None:
+            limit = self.rates.get(region, self.rate)
+            bucket = dict(limit=limit, rate=limit, tokens=max(1, limit),
+                          time=self._clock())
+            self._buckets[region] = bucket
+        return bucket
+
+    def _metric(self, region):
+        return self._metrics.setdefault(region, dict(
+            requests=0, throttles=0, retries=0, waited=0.0))
+
+    def acquire(self, region):
+        """Wait until the bucket of a region has a token, and take it."""
+        while True:
+            with self._lock:
+                bucket = self._bucket(region)
+                metric = self._metric(region)
+                if bucket['limit'] <= 0:
+                    metric['requests'] += 1
+                    return
+                now = self._clock()
+                bucket['tokens'] = min(
+                    max(1, bucket['rate']),
+                    bucket['tokens'] + (now - bucket['time']) * bucket['rate'])
+                bucket['time'] = now
+                if bucket['tokens'] >= 1:
+                    bucket['tokens'] -= 1
+                    metric['requests'] += 1
+                    return
+                wait = (1 - bucket['tokens']) / bucket['rate']
+                metric['waited'] += wait
+            self._sleep(wait)
+
+    def call(self, region, func, *args, **kwargs):
+        """Call `func` with the arguments when the bucket of a region
+        allows it, retrying it while it is throttled, and return its
+        result.
+        """
+        attempt = 0
+        while True:
+            self.acquire(region)
+            try:
+                result = self._send(func, args, kwargs)
+            except Exception as e:
+                if not _is_throttling(e):
+                    raise
+                retry = attempt < self.retries
+                self._throttled(region, retry)
+                if not retry:
+                    raise
+                self._sleep(self._random() * min(
+                    self.max_delay, self.base_delay * 2 ** attempt))
+                attempt += 1
+                continue
+            self._succeeded(region)
+            return result
+
+    def _send(self, func, args, kwargs):
+        if self.semaphore is None:
+            return func(*args, **kwargs)
+        with self.semaphore:
+            return func(*args, **kwargs)
+
+    def _throttled(self, region, retry):
+        with self._lock:
+            metric = self._metric(region)
+            metric['throttles'] += 1
+            if retry:
+                metric['retries'] += 1
+            bucket = self._bucket(region)
+            if bucket['limit'] > 0:
+                bucket['rate'] = max(bucket['rate'] / 2,
+                                     min(1, bucket['limit']))
+
+    def _succeeded(self, region):
+        with self._lock:
+            bucket = self._bucket(region)
+            bucket['rate'] = min(bucket['limit'],
+                                 bucket['rate'] + bucket['limit'] / 20.0)
+
+    def stats(self):
+        """Return the requests, throttles, retries, seconds waited and
+        current rate of each region.
+        """
+        with self._lock:
+            stats = dict()
+            for region, metric in self._metrics.items():
+                stats[region] = dict(metric,
+                                     rate=self._bucket(region)['rate'])
+            return stats
+
+
+KMS_LIMITER = KmsRateLimiter()
 
 
 def get_key_from_pgp(tree):
     """Retrieve the key from the PGP tree leave."""
+    for decrypt_key, entry, i in master_key_attempts(tree, ['pgp']):
+        key = decrypt_key(entry, i)
+        if key is not None:
+            return key
+    return None
+
+
+def decrypt_key_with_pgp(entry, i=0):
+    """Decrypt the key with the PGP entry number `i`, or return None."""
+    if 'enc' not in entry:
+        return None
+    return _decrypt_key('pgp', entry,
+                        lambda entry: unwrap_key_with_pgp(entry, i))
+
+
+def unwrap_key_with_pgp(entry, i=0):
+    """Decrypt the data key of the PGP entry number `i` with gpg, or
+    return None.
+    """
     try:
-        pgp_tree = tree['sops']['pgp']
-    except KeyError:
+        p = subprocess.Popen(['gpg', '-d'], stdout=subprocess.PIPE,
+                             stdin=subprocess.PIPE)
+        key = p.communicate(input=entry['enc'].encode('utf-8'))[0]
+    except Exception as e:
+        print("PGP decryption failed in entry %s with error: %s" %
+              (i, e), file=sys.stderr)
         return None
-    i = -1
-    for entry in pgp_tree:
-        i += 1
-        try:
-            enc = entry['enc']
-        except KeyError:
-            continue
-        try:
-            p = subprocess.Popen(['gpg', '-d'], stdout=subprocess.PIPE,
-                                 stdin=subprocess.PIPE)
-            key = p.communicate(input=enc.encode('utf-8'))[0]
-        except Exception as e:
-            print("PGP decryption failed in entry %s with error: %s" %
-                  (i, e), file=sys.stderr)
-            continue
-        if len(key) == 32:
-            return key
+    if len(key) == 32:
+        return key
     return None
 
 
@@ -888,13 +3096,168 @@ def encrypt_key_with_pgp(key, entry):
     except Exception as e:
         print("failed to encrypt key using pgp fp %s: %s, skipping it" %
               (fp, e), file=sys.stderr)
-        return None
+        return entry
     enc = enc.decode('utf-8')
-    entry['enc'] = ruamel.yaml.scalarstring.PreservedScalarString(enc)
-    entry['created_at'] = NOW
+    entry['enc'] = _yaml().scalarstring.PreservedScalarString(enc)
+    entry['created_at'] = timestamp()
     return entry
 
 
+def encrypt_key_with_pgp_entries(key, entries):
+    """Encrypt the key with the PGP keys of several entries, and return
+    the entries.
+
+    The key is encrypted to every PGP key in one gpg process, and each
+    entry gets a message of its own, made of the session key encrypted
+    for its PGP key and of the data shared by all the messages. If gpg
+    can't encrypt to all the keys at once, the entries are encrypted one
+    after the other with encrypt_key_with_pgp.
+
+    """
+    fps = [entry.get('fp') for entry in entries]
+    if len(entries) > 1 and all(fps):
+        try:
+            messages = _encrypt_key_with_pgp_recipients(key, fps)
+        except Exception:
+            messages = None
+        if messages is not None:
+            for entry, enc in zip(entries, messages):
+                entry['enc'] = _yaml().scalarstring.PreservedScalarString(
+                    enc)
+                entry['created_at'] = timestamp()
+            return entries
+    return [encrypt_key_with_pgp(key, entry) for entry in entries]
+
+
+def _encrypt_key_with_pgp_recipients(key, fps):
+    """Encrypt the key to the PGP keys of `fps` in one gpg process, and
+    return an armored message for each of them.
+    """
+    key_ids = _pgp_encryption_key_ids(fps)
+    command = ['gpg', '--batch', '--no-default-recipient', '--yes',
+               '--encrypt', '--no-encrypt-to', '--status-fd', '2']
+    for fp in fps:
+        command.extend(['-r', fp, '--trusted-key', fp[-16:]])
+    p = subprocess.Popen(command, stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate(input=key)
+    if p.returncode != 0:
+        raise ValueError("gpg failed: %s" % err.decode('utf-8', 'replace'))
+    sessions, data = _split_pgp_message(out)
+    messages = [None] * len(fps)
+    for key_id, packet in sessions:
+        for i in key_ids.get(key_id, ()):
+            messages[i] = _armor_pgp_message(packet + data)
+    if None in messages:
+        # the key ids are listed again the next time, in case the PGP key
+        # got a new encryption subkey
+        for fp in fps:
+            _PGP_KEY_IDS.pop(fp, None)
+        raise ValueError("no session key for PGP key %s" %
+                         fps[messages.index(None)])
+    return messages
+
+
+def _pgp_encryption_key_ids(fps):
+    """Return the indexes in `fps` of the PGP keys that own each
+    encryption key id, in hexadecimal. The key ids of each fingerprint
+    are listed by gpg once, and kept in _PGP_KEY_IDS.
+    """
+    missing = [fp for fp in fps if fp not in _PGP_KEY_IDS]
+    if missing:
+        p = subprocess.Popen(['gpg', '--batch', '--with-colons',
+                              '--fixed-list-mode', '--list-keys'] + missing,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = p.communicate()[0]
+        if p.returncode != 0:
+            raise ValueError("gpg could not list the PGP keys")
+        primary = None
+        # pub and sub records hold a key id and capabilities, followed by
+        # the fpr record of the key
+        for line in out.decode('utf-8', 'replace').splitlines():
+            fields = line.split(':')
+            if fields[0] == 'pub':
+                primary = None
+            if fields[0] in ('pub', 'sub'):
+                key_id, capabilities = fields[4], fields[11]
+            elif fields[0] == 'fpr':
+                if primary is None:
+                    primary = fields[9]
+                for fp in missing:
+                    if primary.endswith(fp.replace(' ', '').upper()):
+                        key_ids = _PGP_KEY_IDS.setdefault(fp, [])
+                        if 'e' in capabilities:
+                            key_ids.append(key_id)
+    key_ids = dict()
+    for i, fp in enumerate(fps):
+        for key_id in _PGP_KEY_IDS.get(fp, ()):
+            key_ids.setdefault(key_id, []).append(i)
+    return key_ids
+
+
+_PGP_KEY_IDS = dict()
+
+
+def _split_pgp_message(message):
+    """Split an OpenPGP message into its public key encrypted session key
+    packets, as a list of (key id, packet), and the packets that follow.
+    """
+    data = bytearray(message)
+    sessions = []
+    pos = 0
+    while pos < len(data):
+        header = data[pos]
+        if not header & 0x80:
+            raise ValueError("invalid OpenPGP packet")
+        if header & 0x40:
+            tag = header & 0x3f
+        else:
+            tag = (header >> 2) & 0x0f
+        if tag != 1:
+            break
+        if header & 0x40:
+            first = data[pos + 1]
+            if first < 192:
+                size, length = 2, first
+            elif first < 224:
+                size, length = 3, ((first - 192) << 8) + data[pos + 2] + 192
+            elif first == 255:
+                size = 6
+                length = struct.unpack('>I', bytes(data[pos + 2:pos + 6]))[0]
+            else:
+                raise ValueError("invalid session key packet length")
+        else:
+            if header & 0x03 == 3:
+                raise ValueError("invalid session key packet length")
+            size = 1 + (1, 2, 4)[header & 0x03]
+            length = 0
+            for byte in data[pos + 1:pos + size]:
+                length = (length << 8) + byte
+        body = data[pos + size:pos + size + length]
+        if len(body) < 9 or body[0] != 3:
+            raise ValueError("unsupported session key packet")
+        key_id = hexlify(bytes(body[1:9])).decode('ascii').upper()
+        sessions.append((key_id, bytes(data[pos:pos + size + length])))
+        pos += size + length
+    return sessions, bytes(data[pos:])
+
+
+def _armor_pgp_message(message):
+    """Return an OpenPGP message in ASCII armor, as gpg -a writes it."""
+    crc = 0xB704CE
+    for byte in bytearray(message):
+        crc ^= byte << 16
+        for i in range(8):
+            crc <<= 1
+            if crc & 0x1000000:
+                crc ^= 0x1864CFB
+    crc = b64encode(struct.pack('>I', crc & 0xFFFFFF)[1:]).decode('ascii')
+    body = b64encode(message).decode('ascii')
+    lines = [body[i:i + 64] for i in range(0, len(body), 64)]
+    return ("-----BEGIN PGP MESSAGE-----\n\n%s\n=%s\n"
+            "-----END PGP MESSAGE-----\n" % ("\n".join(lines), crc))
+
+
 def write_file(tree, path=None, filetype=None):
     """Write the tree content in a file using filetype format.
 
@@ -918,8 +3281,9 @@ def write_file(tree, path=None, filetype=None):
         return path
 
     if filetype == "yaml":
-        fd.write(ruamel.yaml.dump(tree, Dumper=ruamel.yaml.RoundTripDumper,
-                                  indent=4).encode('utf-8'))
+        yaml = _yaml()
+        fd.write(yaml.dump(tree, Dumper=yaml.RoundTripDumper,
+                           indent=4).encode('utf-8'))
     elif filetype == "json":
         fd.write(json.dumps(tree, indent=4).encode('utf-8'))
     else:
@@ -952,7 +3316,8 @@ def run_editor(path):
     if editor:
         subprocess.call([editor, path])
     else:
-        panic("Please define your EDITOR environment variable.", 201)
+        raise SopsError("Please define your EDITOR environment variable.",
+                        201)
     return
 
 
@@ -962,7 +3327,8 @@ def validate_syntax(path, filetype):
         return True
     with open(path, "rb") as fd:
         if filetype == 'yaml':
-            ruamel.yaml.load(fd, ruamel.yaml.RoundTripLoader)
+            yaml = _yaml()
+            yaml.load(fd, yaml.RoundTripLoader)
         if filetype == 'json':
             json.load(fd)
     return True
@@ -970,20 +3336,37 @@ def validate_syntax(path, filetype):
 
 def truncate_tree(tree, path):
     """ return the branch or value of a tree at the path provided """
+    try:
+        for comp in parse_tree_path(path):
+            tree = tree[comp]
+    except (KeyError, IndexError, TypeError):
+        raise TreePathError("tree path not found: tree%s" % path)
+    return tree
+
+
+def parse_tree_path(path):
+    """ return the keys and list indexes of a tree path, as a tuple """
+    keys = []
     comps = path.split('[', -1)
     for comp in comps:
         if comp == "":
             continue
         if comp[len(comp)-1] != "]":
-            panic("invalid tree path format: tree"+path, 91)
+            raise TreePathError("invalid tree path format: tree"+path)
         comp = comp[0:len(comp)-1]
         comp = comp.replace('"', '', 2)
         comp = comp.replace("'", "", 2)
         if re.search(b'^\d+$', comp.encode('utf-8')):
-            tree = tree[int(comp)]
+            keys.append(int(comp))
         else:
-            tree = tree[comp]
-    return tree
+            keys.append(comp)
+    return tuple(keys)
+
+
+def format_tree_path(keys):
+    """ return the tree path of a tuple of keys and list indexes """
+    return ''.join('[%d]' % k if isinstance(k, int) else '["%s"]' % k
+                   for k in keys)
 
 
 def panic(msg, error_code=1):
@@ -991,5 +3374,26 @@ def panic(msg, error_code=1):
     sys.exit(error_code)
 
 
+_AIO_NAMES = ('aload', 'aget_key', 'adecrypt_tree', 'aencrypt_tree')
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # the asyncio interface is imported when first used
+        if name in _AIO_NAMES:
+            from sops import aio
+            return getattr(aio, name)
+        raise AttributeError("module 'sops' has no attribute '%s'" % name)
+elif sys.version_info >= (3, 5) and __name__ != '__main__':
+    # the asyncio interface uses the async syntax of python 3.5
+    from sops.aio import (  # noqa
+        aload, aget_key, adecrypt_tree, aencrypt_tree)
+
+
 if __name__ == '__main__':
-    main()
+    # run as `python sops/__init__.py`: import the sops package and run
+    # its main, so that `sops agent` and --recursive, which import
+    # sops.agent and sops.batch, share the state of the package
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    import sops
+    sops.main()
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""The sops agent keeps the data keys decrypted by KMS and gpg in memory,
+and serves them to sops commands over a Unix socket, like ssh-agent.
+
+    $ eval $(sops agent)
+    $ sops -d secrets.yaml
+
+`sops agent` prints the SOPS_AGENT_SOCK and SOPS_AGENT_PID variables to
+set in the shell. sops asks the agent at SOPS_AGENT_SOCK to decrypt data
+keys, and only calls KMS and gpg itself if the agent can't be reached.
+The socket is only accessible to the user who started the agent, in a
+private directory, and connections from other users are refused where the
+system reports who is connected.
+
+Each connection sends one JSON request on a line, and reads one JSON
+response:
+
+    {"op": "decrypt", "kind": "kms", "entry": {"arn": .., "enc": ..}}
+    -> {"key": "<base64 data key>"}, or {"key": null} if the agent could
+       not decrypt it
+    {"op": "stats"} -> {"hits": .., "misses": .., "size": ..,
+                        "kms": {"<region>": {"requests": .., ..}}}
+    {"op": "invalidate"} -> {}
+
+"""
+
+from __future__ import print_function, unicode_literals
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import struct
+import sys
+import tempfile
+from base64 import b64encode, b64decode
+
+import sops
+
+if sys.version_info[0] == 2:
+    from SocketServer import ThreadingMixIn, UnixStreamServer, \
+        StreamRequestHandler
+else:
+    from socketserver import ThreadingMixIn, UnixStreamServer, \
+        StreamRequestHandler
+
+DEFAULT_TTL = 3600
+
+# the fields of master key entries sent to the agent
+ENTRY_FIELDS = {'kms': ('arn', 'role', 'enc'), 'pgp': ('fp', 'enc')}
+
+MAX_REQUEST = 1 << 20
+
+TIMEOUT = 30
+
+
+class AgentError(sops.SopsError):
+    """The agent could not be reached, or answered with an error."""
+
+
+def request(path, message, timeout=TIMEOUT):
+    """Send a request to the agent listening at `path`, and return its
+    response.
+    """
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.settimeout(timeout)
+            conn.connect(path)
+            conn.sendall(json.dumps(message).encode('utf-8') + b'\n')
+            data = b''
+            while True:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            conn.close()
+        response = json.loads(data.decode('utf-8'))
+    except (socket.error, ValueError) as e:
+        raise AgentError("%s: %s" % (path, e))
+    if 'error' in response:
+        raise AgentError("%s: %s" % (path, response['error']))
+    return response
+
+
+def request_key(path, kind, entry):
+    """Ask the agent at `path` for the data key of a master key entry of
+    type `kind`, 'kms' or 'pgp'. Return None if the agent could not
+    decrypt it.
+    """
+    entry = dict((k, entry[k]) for k in ENTRY_FIELDS[kind] if k in entry)
+    key = request(path, dict(op='decrypt', kind=kind, entry=entry))['key']
+    if key is None:
+        return None
+    return b64decode(key)
+
+
+def _peer_uid(conn):
+    """Return the uid of the process at the other end of a Unix socket,
+    or None if the system doesn't tell.
+    """
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    return struct.unpack('3i', creds)[1]
+
+
+class AgentHandler(StreamRequestHandler):
+
+    def handle(self):
+        try:
+            message = json.loads(
+                self.rfile.readline(MAX_REQUEST).decode('utf-8'))
+            response = self.server.dispatch(message)
+        except Exception as e:
+            response = dict(error="%s: %s" % (e.__class__.__name__, e))
+        self.wfile.write(json.dumps(response).encode('utf-8'))
+
+
+class AgentServer(ThreadingMixIn, UnixStreamServer):
+    """Serve the data keys of a KeyCache on the Unix socket at `path`,
+    and decrypt the keys missing from the cache with KMS and gpg, recording
+    the calls in sops.MASTER_KEY_STATS.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, ttl=DEFAULT_TTL, maxsize=1024):
+        self.cache = sops.KeyCache(maxsize=maxsize, ttl=ttl)
+        self.unwrap = {'kms': sops.unwrap_key_with_kms,
+                       'pgp': sops.unwrap_key_with_pgp}
+        # the socket is only readable and writable by its owner
+        umask = os.umask(0o177)
+        try:
+            UnixStreamServer.__init__(self, path, AgentHandler)
+        finally:
+            os.umask(umask)
+
+    def verify_request(self, request, client_address):
+        return _peer_uid(request) in (None, os.getuid())
+
+    def dispatch(self, message):
+        op = message.get('op')
+        if op == 'decrypt':
+            key = self.decrypt_key(message['kind'], message['entry'])
+            if key is not None:
+                key = b64encode(key).decode('utf-8')
+            return dict(key=key)
+        if op == 'stats':
+            return dict(self.cache.stats(), kms=sops.KMS_LIMITER.stats())
+        if op == 'invalidate':
+            self.cache.invalidate()
+            return dict()
+        raise ValueError("unknown operation %r" % op)
+
+    def decrypt_key(self, kind, entry):
+        if kind not in ENTRY_FIELDS or 'enc' not in entry:
+            raise ValueError("invalid master key entry")
+        entry = dict((k, entry[k]) for k in ENTRY_FIELDS[kind] if k in entry)
+        key = self.cache.get(kind, entry)
+        if key is None:
+            key = sops.unwrap_and_record(kind, entry, self.unwrap[kind])
+            if key is not None:
+                self.cache.put(kind, entry, key)
+        return key
+
+
+def _exit(signum, frame):
+    sys.exit(0)
+
+
+def main(argv):
+    """Run the `sops agent` command."""
+    parser = argparse.ArgumentParser(
+        prog='sops agent',
+        description="keep the data keys decrypted by KMS and PGP in memory "
+                    "and serve them to sops commands over a Unix socket. "
+                    "Prints the environment variables to set, use as "
+                    "`eval $(sops agent)`")
+    parser.add_argument('-a', '--socket', dest='path',
+                        help="path of the socket (default: in a new "
+                             "temporary directory)")
+    parser.add_argument('-t', '--ttl', type=int, default=DEFAULT_TTL,
+                        help="seconds a data key is kept in memory "
+                             "(default: %d)" % DEFAULT_TTL)
+    parser.add_argument('-D', '--foreground', action='store_true',
+                        help="do not fork into the background")
+    parser.add_argument('-k', '--kill', action='store_true',
+                        help="stop the agent of SOPS_AGENT_PID")
+    args = parser.parse_args(argv)
+    sops.configure_kms_rate()
+
+    if args.kill:
+        try:
+            os.kill(int(os.environ['SOPS_AGENT_PID']), signal.SIGTERM)
+        except (KeyError, ValueError, OSError) as e:
+            raise AgentError("could not stop the agent: %s" % e)
+        print("unset SOPS_AGENT_SOCK;\nunset SOPS_AGENT_PID;")
+        return
+
+    tmpdir = None
+    path = args.path
+    if path is None:
+        tmpdir = tempfile.mkdtemp(prefix='sops-agent-')
+        path = os.path.join(tmpdir, 'agent.sock')
+    try:
+        server = AgentServer(path, ttl=args.ttl)
+    except socket.error as e:
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        raise AgentError("could not listen on %s: %s" % (path, e))
+    if args.foreground:
+        pid = os.getpid()
+    else:
+        sys.stdout.flush()
+        pid = os.fork()
+    if pid:
+        print("SOPS_AGENT_SOCK=%s; export SOPS_AGENT_SOCK;\n"
+              "SOPS_AGENT_PID=%d; export SOPS_AGENT_PID;" % (path, pid))
+        sys.stdout.flush()
+        if not args.foreground:
+            return
+    else:
+        # detach the agent from the terminal of the shell that started it
+        os.setsid()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in range(3):
+            os.dup2(devnull, fd)
+    signal.signal(signal.SIGTERM, _exit)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(path)
+        if tmpdir:
+            shutil.rmtree(tmpdir, ignore_errors=True)
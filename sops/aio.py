@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""asyncio interface of sops, for python 3.5 and later.
+
+    doc = await sops.aload('secrets.yaml')
+    secrets = await sops.adecrypt_tree(doc.tree, doc.key)
+
+The calls to KMS and gpg that decrypt data keys block, they run in a pool
+of KEY_WORKERS threads, and the master keys of a document are tried
+concurrently. Leaves are encrypted and decrypted in a pool of
+CRYPTO_WORKERS threads, which the AES-GCM code of `cryptography` runs in
+without holding the GIL. Many documents can be loaded concurrently without
+blocking the event loop.
+
+"""
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import sops
+
+KEY_WORKERS = 32
+
+CRYPTO_WORKERS = os.cpu_count() or 1
+
+_executors = dict()
+
+
+def _executor(name, workers):
+    if name not in _executors:
+        _executors[name] = ThreadPoolExecutor(max_workers=workers)
+    return _executors[name]
+
+
+async def aload(path, filetype=None):
+    """Load the encrypted document at `path` and decrypt its data key,
+    return a Document.
+    """
+    loop = asyncio.get_event_loop()
+    doc = await loop.run_in_executor(_executor('key', KEY_WORKERS),
+                                     sops.load, path, filetype)
+    key, tree = await aget_key(doc.tree)
+    return sops.Document(tree, key=key, path=path, filetype=doc.filetype)
+
+
+async def aget_key(tree):
+    """Decrypt the data key of a tree with its master keys, and return
+    it along with the tree, like `sops.get_key`.
+
+    The KMS master keys are tried concurrently, then the PGP ones, and the
+    first data key decrypted is returned.
+
+    """
+    for decrypt_key, name in [(sops.decrypt_key_with_kms, 'kms'),
+                              (sops.decrypt_key_with_pgp, 'pgp')]:
+        key = await _first_key(decrypt_key, tree['sops'].get(name) or [])
+        if key is not None:
+            return key, tree
+    raise sops.MasterKeyError("could not retrieve a key to encrypt/decrypt "
+                              "the tree")
+
+
+async def _first_key(decrypt_key, entries):
+    loop = asyncio.get_event_loop()
+    executor = _executor('key', KEY_WORKERS)
+    pending = [loop.run_in_executor(executor, decrypt_key, entry, i)
+               for i, entry in enumerate(entries)]
+    try:
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                key = future.result()
+                if key is not None:
+                    return key
+    finally:
+        for future in pending:
+            future.cancel()
+    return None
+
+
+async def adecrypt_tree(tree, key, ignore_mac=False):
+    """Return a decrypted copy of an encrypted tree, see
+    `sops.decrypt_tree`.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        _executor('crypto', CRYPTO_WORKERS),
+        lambda: sops.decrypt_tree(tree, key, ignore_mac=ignore_mac))
+
+
+async def aencrypt_tree(tree, key, stash=None):
+    """Return an encrypted copy of a tree, with its MAC, see
+    `sops.encrypt_tree`.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        _executor('crypto', CRYPTO_WORKERS),
+        lambda: sops.encrypt_tree(tree, key, stash=stash))
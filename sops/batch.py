@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Encrypt, decrypt, rotate the data keys or change the master keys of
+every file of a directory, in a pool of processes.
+
+    $ sops -d --recursive secrets/ --output-dir cleartext/
+    $ sops -e -i --recursive config/ --include '*.yaml' --jobs 8
+    $ sops -i --recursive secrets/ \\
+        --add-pgp 85D77543B3D624B63CEA9E6DBC17301B491B3F21
+
+The files are processed by `jobs` worker processes, each file in a single
+worker, so the time taken grows with the number of files divided by the
+number of cores, and sops is only started once. The workers ask a sops
+agent for the data keys of the files: the agent of SOPS_AGENT_SOCK if one
+is running, or an agent served by the parent process for the duration of
+the run, so that every worker shares one cache of data keys, and a data
+key shared by several files is only decrypted once.
+
+Files are written atomically: to a temporary file in the same directory,
+renamed over the destination once complete, so that a failure or an
+interruption never leaves a file half written. Long runs, such as the
+rotation of the data keys of a whole repository, can record the files
+done in a checkpoint file, and be resumed from it after a failure:
+
+    $ sops -r -i --recursive secrets/ --checkpoint rotate.done \\
+        --kms-concurrency 20 --jobs 16
+
+"""
+
+from __future__ import print_function, unicode_literals
+import fnmatch
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import sops
+
+MODES = ('decrypt', 'encrypt', 'rotate', 'master_keys')
+
+# hidden files and directories, such as .git, are skipped by default
+DEFAULT_EXCLUDE = ('.*',)
+
+
+def find_files(root, include=None, exclude=None):
+    """Return the paths of the files under `root`, relative to it and
+    sorted, that match one of the `include` globs, and none of the
+    `exclude` globs.
+
+    Globs are matched with fnmatch, where `*` also matches `/`. `include`
+    globs are matched against the relative path of files, `exclude` globs
+    against the relative path and against the name of the file and of
+    each of its parent directories, so that excluded directories are not
+    walked.
+
+    """
+    if exclude is None:
+        exclude = DEFAULT_EXCLUDE
+
+    def excluded(path):
+        return any(fnmatch.fnmatch(path, glob) or
+                   fnmatch.fnmatch(os.path.basename(path), glob)
+                   for glob in exclude)
+
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        reldir = os.path.relpath(dirpath, root)
+        if reldir == os.curdir:
+            reldir = ''
+        dirnames[:] = [name for name in dirnames
+                       if not excluded(os.path.join(reldir, name))]
+        for name in filenames:
+            path = os.path.join(reldir, name)
+            if excluded(path):
+                continue
+            if include and not any(fnmatch.fnmatch(path, glob)
+                                   for glob in include):
+                continue
+            paths.append(path)
+    return sorted(paths)
+
+
+def decrypt_file(path, dest, options):
+    """Decrypt the file at `path` and write it to `dest`."""
+    itype = options.get('input_type') or sops.detect_filetype(path)
+    doc = sops.load(path, filetype=itype,
+                    hedge_delay=options.get('hedge_delay'))
+    tree = doc.decrypt(ignore_mac=options.get('ignore_mac', False))
+    if not options.get('show_master_keys'):
+        tree.pop('sops', None)
+    write_file_atomic(tree, dest, options.get('output_type') or itype)
+
+
+def encrypt_file(path, dest, options):
+    """Encrypt the cleartext file at `path` and write it to `dest`."""
+    itype = options.get('input_type') or sops.detect_filetype(path)
+    tree, need_key, _ = sops.initialize_tree(
+        path, itype, kms_arns=options.get('kms_arns'),
+        pgp_fps=options.get('pgp_fps'))
+    need_key = need_key or options.get('new_key', False)
+    key, tree = sops.get_key(tree, need_key,
+                             hedge_delay=options.get('hedge_delay'))
+    if options.get('mac_format'):
+        sops.set_mac_format(tree, options['mac_format'])
+    tree = sops.encrypt_tree(tree, key)
+    _write_encrypted(tree, dest, options.get('output_type') or itype)
+
+
+def rotate_file(path, dest, options):
+    """Encrypt the encrypted file at `path` with a new data key, and write
+    it to `dest`.
+    """
+    itype = options.get('input_type') or sops.detect_filetype(path)
+    doc = sops.load(path, filetype=itype,
+                    hedge_delay=options.get('hedge_delay'))
+    tree = doc.decrypt(ignore_mac=options.get('ignore_mac', False))
+    key = sops.generate_key(tree)
+    if options.get('mac_format'):
+        sops.set_mac_format(tree, options['mac_format'])
+    tree = sops.encrypt_tree(tree, key)
+    _write_encrypted(tree, dest, options.get('output_type') or itype)
+
+
+def master_keys_file(path, dest, options):
+    """Add and remove the master keys of the encrypted file at `path`, see
+    sops.change_master_keys, and write it to `dest`.
+    """
+    itype = options.get('input_type') or sops.detect_filetype(path)
+    doc = sops.load(path, filetype=itype,
+                    hedge_delay=options.get('hedge_delay'))
+    key = None
+    if options.get('add_kms') or options.get('add_pgp'):
+        key = doc.key
+    tree = sops.change_master_keys(
+        doc.tree, key, add_kms=options.get('add_kms'),
+        rm_kms=options.get('rm_kms'), add_pgp=options.get('add_pgp'),
+        rm_pgp=options.get('rm_pgp'))
+    _write_encrypted(tree, dest, options.get('output_type') or itype)
+
+
+def _write_encrypted(tree, dest, filetype):
+    # encrypted binary files are stored in a json enveloppe
+    if filetype == 'bytes':
+        filetype = 'json'
+    write_file_atomic(tree, dest, filetype)
+
+
+def write_file_atomic(tree, path, filetype):
+    """Write a tree to a temporary file next to `path`, see
+    sops.write_file, and rename it to `path`, keeping the permissions of
+    the file it replaces.
+    """
+    directory, name = os.path.split(path)
+    fd, tmppath = tempfile.mkstemp(dir=directory or os.curdir,
+                                   prefix='.%s.' % name, suffix='.tmp')
+    os.close(fd)
+    try:
+        if os.path.exists(path):
+            shutil.copymode(path, tmppath)
+        sops.write_file(tree, path=tmppath, filetype=filetype)
+        os.rename(tmppath, path)
+    except BaseException:
+        os.remove(tmppath)
+        raise
+
+
+PROCESS_FILE = {'decrypt': decrypt_file, 'encrypt': encrypt_file,
+                'rotate': rotate_file, 'master_keys': master_keys_file}
+
+
+def process_file(task):
+    """Run a (mode, path, dest, options) task in a worker, and return the
+    path, the error message if it failed or None, and the seconds taken.
+    """
+    mode, path, dest, options = task
+    start = time.time()
+    error = None
+    try:
+        directory = os.path.dirname(dest)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by another worker in the meantime
+                if not os.path.isdir(directory):
+                    raise
+        PROCESS_FILE[mode](path, dest, options)
+    except sops.SopsError as e:
+        error = str(e)
+    except Exception as e:
+        error = "%s: %s" % (e.__class__.__name__, e)
+    return path, error, time.time() - start
+
+
+def _init_worker(options, semaphore):
+    sops.configure_kms_rate(options.get('kms_rate'))
+    sops.KMS_LIMITER.semaphore = semaphore
+
+
+class Checkpoint(object):
+    """The files done by a run, one path per line in the file at `path`,
+    appended as they are done, so that a run can be resumed after it
+    failed or was interrupted.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as checkpoint:
+                self.done = set(line.rstrip('\n') for line in checkpoint
+                                if line.strip())
+        self._file = open(path, 'a')
+
+    def add(self, path):
+        self._file.write(path + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done.add(path)
+
+    def close(self, remove=False):
+        self._file.close()
+        if remove:
+            os.remove(self.path)
+
+
+def _start_agent():
+    """Serve the data keys of the workers from an agent in a thread of
+    this process, and return a function that stops it.
+    """
+    from sops import agent
+    tmpdir = tempfile.mkdtemp(prefix='sops-batch-')
+    path = os.path.join(tmpdir, 'agent.sock')
+    server = agent.AgentServer(path, ttl=agent.DEFAULT_TTL)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    os.environ['SOPS_AGENT_SOCK'] = path
+
+    def stop():
+        del os.environ['SOPS_AGENT_SOCK']
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return stop
+
+
+def run(root, mode, options=None, output_dir=None, include=None,
+        exclude=None, jobs=None, checkpoint=None, kms_concurrency=None,
+        out=sys.stderr):
+    """Process every file under `root` in `mode`, 'decrypt', 'encrypt',
+    'rotate' or 'master_keys', in a pool of `jobs` processes, one per CPU
+    by default.
+
+    The files are written in place, or to the same relative path under
+    `output_dir` if it is set. `options` are the options of the sops
+    command that apply to each file, see decrypt_file, encrypt_file,
+    rotate_file and master_keys_file. If `checkpoint` is the path of a
+    Checkpoint file, the files it lists are skipped, the files done are
+    added to it, and it is removed if every file succeeded.
+    `kms_concurrency` bounds the KMS requests in flight in all the
+    processes.
+
+    A status line is printed to `out` as each file is done, with the
+    progress and the files per second so far, then a summary. Return a
+    list of (path, error, seconds) tuples, in the order of the files
+    processed, where error is None for files that succeeded.
+
+    """
+    if mode not in PROCESS_FILE:
+        raise ValueError("unknown mode %r" % mode)
+    if not os.path.isdir(root):
+        raise sops.SopsError("%s is not a directory" % root, 100)
+    options = dict(options or {})
+    jobs = jobs or multiprocessing.cpu_count()
+    paths = find_files(root, include, exclude)
+    if checkpoint is not None:
+        checkpoint = Checkpoint(checkpoint)
+        skipped = len(paths)
+        paths = [path for path in paths if path not in checkpoint.done]
+        skipped -= len(paths)
+        if skipped:
+            print("skipping %d files done in %s" % (skipped, checkpoint.path),
+                  file=out)
+    tasks = []
+    relpaths = dict()
+    for path in paths:
+        dest = os.path.join(output_dir or root, path)
+        tasks.append((mode, os.path.join(root, path), dest, options))
+        relpaths[tasks[-1][1]] = path
+
+    semaphore = None
+    if kms_concurrency:
+        semaphore = multiprocessing.BoundedSemaphore(kms_concurrency)
+    # the agent decrypts the data keys in this process
+    limiter_semaphore = sops.KMS_LIMITER.semaphore
+    sops.KMS_LIMITER.semaphore = semaphore
+    stop_agent = None
+    if not os.environ.get('SOPS_AGENT_SOCK'):
+        stop_agent = _start_agent()
+    start = time.time()
+    results = dict()
+    failed = 0
+    pool = multiprocessing.Pool(jobs, _init_worker, (options, semaphore))
+    try:
+        for path, error, seconds in pool.imap_unordered(process_file, tasks):
+            results[path] = (path, error, seconds)
+            progress = "[%d/%d %.1f files/s]" % (
+                len(results), len(tasks),
+                len(results) / max(time.time() - start, 1e-6))
+            if error is None:
+                if checkpoint is not None:
+                    checkpoint.add(relpaths[path])
+                print("%s ok      %s (%.2fs)" % (progress, path, seconds),
+                      file=out)
+            else:
+                failed += 1
+                print("%s FAILED  %s: %s" % (progress, path, error),
+                      file=out)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        sops.KMS_LIMITER.semaphore = limiter_semaphore
+        if stop_agent is not None:
+            stop_agent()
+        if checkpoint is not None:
+            checkpoint.close(remove=len(results) == len(tasks) and
+                             not failed)
+    elapsed = time.time() - start
+    results = [results[task[1]] for task in tasks]
+    print("%d files, %d ok, %d failed in %.2fs with %d processes, "
+          "%.1f files/s" % (len(results), len(results) - failed, failed,
+                            elapsed, jobs,
+                            len(results) / max(elapsed, 1e-6)), file=out)
+    return results
@@ -8,13 +8,24 @@
 # Contributor: Alexis Metaireau <alexis@mozilla.com> [:alexis]
 # Contributor: Rémy Hubscher <natim@mozilla.com> [:natim]
 
+import copy
 import logging
 import unittest2
 import mock
 import os
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import boto3
+import ruamel.yaml
 
 import sops
+from sops import agent, batch
 
 try:
     from collections import OrderedDict
@@ -26,9 +37,53 @@ if sys.version_info[0] == 2:
 else:
     import builtins
 
+if sys.version_info >= (3, 5):
+    import asyncio
+
+
+class FakeKMS(object):
+    """A local stand-in for KMS, counting the calls to each API."""
+
+    def __init__(self, fail=()):
+        self.fail = fail
+        self.keys = {}
+        self.calls = {}
+
+    def _call(self, api):
+        self.calls[api] = self.calls.get(api, 0) + 1
+        if api in self.fail:
+            raise Exception("AccessDenied")
+
+    def encrypt(self, KeyId, Plaintext):
+        self._call('Encrypt')
+        blob = os.urandom(16)
+        self.keys[blob] = Plaintext
+        return {'CiphertextBlob': blob}
+
+    def decrypt(self, CiphertextBlob):
+        self._call('Decrypt')
+        return {'Plaintext': self.keys[CiphertextBlob]}
+
+    def generate_data_key(self, KeyId, KeySpec):
+        assert KeySpec == 'AES_256'
+        self._call('GenerateDataKey')
+        key = os.urandom(32)
+        blob = os.urandom(16)
+        self.keys[blob] = key
+        return {'Plaintext': key, 'CiphertextBlob': blob}
+
 
 class TreeTest(unittest2.TestCase):
 
+    def setUp(self):
+        sops.KEY_CACHE.invalidate()
+        sops.AWS_CLIENTS.clear()
+        sops.KMS_LIMITER.clear()
+        patcher = mock.patch.object(sops, 'MASTER_KEY_STATS',
+                                    sops.MasterKeyStats())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_json_loader_is_used_on_json_filetype(self):
         m = mock.mock_open(read_data=sops.DEFAULT_JSON)
         with mock.patch.object(builtins, 'open', m):
@@ -175,6 +230,589 @@ class TreeTest(unittest2.TestCase):
         cleartree = sops.walk_and_decrypt(OrderedDict(crypttree), key, isRoot=True)
         assert cleartree == tree
 
+    def test_parallel_encrypt_and_decrypt(self):
+        """Test the thread pool walkers are compatible with serial ones"""
+        m = mock.mock_open(read_data=sops.DEFAULT_JSON)
+        key = os.urandom(32)
+        with mock.patch.object(builtins, 'open', m):
+            tree = sops.load_file_into_tree('path', 'json')
+        tree['multiline'] = ruamel.yaml.scalarstring.\
+            PreservedScalarString("a\nb\n")
+        tree['nested_lists'] = [[1, 2, {'a': [True, 'b']}], 3.5]
+        clear = copy.deepcopy(tree)
+        tree['sops'] = dict()
+        crypttree = sops.walk_and_encrypt(tree, key, jobs=4)
+        assert crypttree['example_key'].startswith("ENC[AES256_GCM,data:")
+        cleartree = sops.walk_and_decrypt(copy.deepcopy(crypttree), key)
+        assert cleartree.pop('sops')['mac'] == crypttree['sops']['mac']
+        assert cleartree == clear
+        cleartree['sops'] = dict()
+        crypttree = sops.walk_and_encrypt(cleartree, key)
+        cleartree = sops.walk_and_decrypt(crypttree, key, jobs=4)
+        cleartree.pop('sops')
+        assert cleartree == clear
+        assert isinstance(cleartree['multiline'],
+                          ruamel.yaml.scalarstring.PreservedScalarString)
+
+    def test_parallel_decrypt_fills_stash(self):
+        """Test the thread pool walker stashes IVs like the serial one"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y', {'c': 'z'}])])
+        tree['sops'] = dict()
+        crypttree = sops.walk_and_encrypt(tree, key)
+        serial, parallel = sops.Stash(), sops.Stash()
+        sops.walk_and_decrypt(copy.deepcopy(crypttree), key, stash=serial)
+        sops.walk_and_decrypt(copy.deepcopy(crypttree), key, stash=parallel,
+                              jobs=2)
+        assert sorted(parallel.entries) == sorted(serial.entries) == \
+            [('a',), ('b', 0), ('b', 1, 'c')]
+        for path, entry in serial.entries.items():
+            assert parallel.entries[path].iv == entry.iv
+
+    def test_stash_reuses_iv_of_unchanged_values(self):
+        """Test encrypting with a stash only changes modified values"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y', {'c': 1}])])
+        tree['sops'] = dict()
+        crypttree = copy.deepcopy(sops.walk_and_encrypt(tree, key))
+        stash = sops.Stash()
+        tree = sops.walk_and_decrypt(tree, key, stash=stash)
+        tree['b'][0] = 'changed'
+        tree['b'][1]['c'] = '1'
+        tree = sops.walk_and_encrypt(tree, key, stash=stash)
+        assert tree['a'] == crypttree['a']
+        assert tree['b'][0] != crypttree['b'][0]
+        assert tree['b'][1]['c'] != crypttree['b'][1]['c']
+        assert sops.walk_and_decrypt(tree, key)['b'] == ['changed',
+                                                         {'c': '1'}]
+
+    def test_stash_copies_unchanged_ciphertext(self):
+        """Test unchanged values are not encrypted again"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y', 'z'])])
+        tree['sops'] = dict()
+        crypttree = copy.deepcopy(sops.walk_and_encrypt(tree, key))
+        stash = sops.Stash()
+        tree = sops.walk_and_decrypt(tree, key, stash=stash)
+        tree['b'][1] = 'changed'
+        cipher = sops.LeafCipher(key)
+        cipher._aead = mock.Mock(wraps=cipher._aead)
+        tree = sops.walk_and_encrypt(tree, key, stash=stash, cipher=cipher)
+        # only the changed value and the MAC go through AES-GCM
+        assert cipher._aead.encrypt.call_count == 2
+        assert tree['a'] == crypttree['a']
+        assert tree['b'][0] == crypttree['b'][0]
+        assert tree['b'][1] != crypttree['b'][1]
+        assert sops.walk_and_decrypt(tree, key)['b'] == ['y', 'changed']
+
+    def test_stash_reencrypts_values_of_old_documents(self):
+        """Values of documents older than 0.9 have a different aad once
+        written in the current format, they can't be copied through"""
+        key = os.urandom(32)
+        old = sops.LeafCipher(key, 0.8)
+        tree = OrderedDict([('a', old.encrypt('x', aad=b'a'))])
+        stash = sops.Stash()
+        sops.walk_and_decrypt(tree, key, stash=stash, cipher=old,
+                              ignoreMac=True)
+        assert stash.entries[('a',)].enc is None
+        tree['sops'] = dict()
+        tree = sops.walk_and_encrypt(tree, key, stash=stash)
+        assert sops.walk_and_decrypt(tree, key)['a'] == 'x'
+
+    def test_walk_deep_tree(self):
+        """Test the walkers are not limited by the recursion limit"""
+        key = os.urandom(32)
+        tree = OrderedDict()
+        branch = tree
+        for i in range(sys.getrecursionlimit() * 2):
+            branch['k'] = [OrderedDict()]
+            branch = branch['k'][0]
+        branch['k'] = 'leaf'
+        tree['sops'] = dict()
+        sops.walk_and_encrypt(tree, key)
+        assert branch['k'].startswith("ENC[AES256_GCM,data:")
+        sops.walk_and_decrypt(tree, key)
+        assert branch['k'] == 'leaf'
+
+    def test_walk_and_decrypt_carries_aad_before_0_9(self):
+        """Documents older than 0.9 use the keys that precede a value in
+        its branch as additional data"""
+        key = os.urandom(32)
+        cipher = sops.LeafCipher(key, 0.8)
+        tree = OrderedDict()
+        tree['sops'] = dict()
+        tree['a'] = cipher.encrypt('x', aad=b'a')
+        tree['b'] = OrderedDict([('c', cipher.encrypt('y', aad=b'abc')),
+                                 ('d', cipher.encrypt('z', aad=b'abcd'))])
+        tree['e'] = [cipher.encrypt(1, aad=b'abe'), [cipher.encrypt(
+            2, aad=b'abe')]]
+        tree = sops.walk_and_decrypt(tree, key, cipher=cipher, ignoreMac=True)
+        assert tree['a'] == 'x'
+        assert tree['b'] == {'c': 'y', 'd': 'z'}
+        assert tree['e'] == [1, [2]]
+
+    def test_lazy_tree_decrypts_values_on_access(self):
+        """Test a LazyTree decrypts each value once, when it is read, and
+        keeps the encrypted tree and the multiline strings of yaml as is"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y', {'c': 1.5}])])
+        tree['multiline'] = ruamel.yaml.scalarstring.\
+            PreservedScalarString("a\nb\n")
+        tree['sops'] = dict(version=sops.VERSION)
+        tree = sops.walk_and_encrypt(tree, key)
+        lazy = sops.LazyTree(tree, key)
+        lazy._state.cipher._aead = mock.Mock(
+            wraps=lazy._state.cipher._aead)
+        assert lazy['b'][1]['c'] == 1.5
+        assert lazy['b'][1]['c'] == 1.5
+        assert lazy._state.cipher._aead.decrypt.call_count == 1
+        assert 'a' in lazy
+        assert lazy._state.cipher._aead.decrypt.call_count == 1
+        assert tree['a'].startswith("ENC[AES256_GCM,data:")
+        assert isinstance(lazy['multiline'],
+                          ruamel.yaml.scalarstring.PreservedScalarString)
+        assert lazy['b'][-1] == {'c': 1.5}
+        assert lazy['sops'] is tree['sops']
+        cleartree = sops.walk_and_decrypt(copy.deepcopy(tree), key)
+        assert lazy == cleartree
+
+    def test_lazy_tree_verify(self):
+        """Test a LazyTree only checks the MAC when verify() is called"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y', 'z'])])
+        tree['sops'] = dict(version=sops.VERSION)
+        tree = sops.walk_and_encrypt(tree, key)
+        sops.LazyTree(tree, key).verify()
+        tree['b'].pop()
+        lazy = sops.LazyTree(tree, key)
+        assert lazy['a'] == 'x'
+        with self.assertRaises(sops.MacError):
+            lazy.verify()
+
+    def test_lazy_tree_verify_on_iteration(self):
+        """Test a LazyTree with verify_on_iter checks the MAC the first
+        time a branch is iterated over, not when a value is read"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y', 'z'])])
+        tree['sops'] = dict(version=sops.VERSION)
+        tree = sops.walk_and_encrypt(tree, key)
+        tree['b'].pop()
+        lazy = sops.LazyTree(tree, key, verify_on_iter=True)
+        assert lazy['a'] == 'x'
+        with self.assertRaises(sops.MacError):
+            list(lazy['b'])
+
+    def test_lazy_tree_carries_aad_before_0_9(self):
+        """Test a LazyTree decrypts documents older than 0.9, whose values
+        carry the aad of the previous keys of their branch"""
+        key = os.urandom(32)
+        cipher = sops.LeafCipher(key, 0.8)
+        tree = OrderedDict()
+        tree['sops'] = dict(version=0.8)
+        tree['a'] = cipher.encrypt('x', aad=b'a')
+        tree['b'] = OrderedDict([('c', cipher.encrypt('y', aad=b'abc'))])
+        lazy = sops.LazyTree(tree, key)
+        assert lazy['b']['c'] == 'y'
+        assert lazy['a'] == 'x'
+
+    def test_extract_paths_decrypts_only_extracted_branches(self):
+        """Test extracting paths from a LazyTree only decrypts the values
+        of the extracted branches, and returns a mapping of several paths"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y', {'c': 1.5}])])
+        tree['sops'] = dict(version=sops.VERSION)
+        tree = sops.walk_and_encrypt(tree, key)
+        lazy = sops.LazyTree(tree, key)
+        lazy._state.cipher._aead = mock.Mock(
+            wraps=lazy._state.cipher._aead)
+        assert sops.extract_paths(lazy, ['["b"][1]']) == {'c': 1.5}
+        assert lazy._state.cipher._aead.decrypt.call_count == 1
+        results = sops.extract_paths(lazy, ['["a"]', '["b"][0]'])
+        assert list(results.items()) == [('["a"]', 'x'), ('["b"][0]', 'y')]
+        assert tree['a'].startswith("ENC[AES256_GCM,data:")
+
+    def test_merkle_mac(self):
+        """Test the merkle MAC stores the hash of each branch, and catches
+        list items swapped, which share their aad"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y', {'c': 1.5}])])
+        tree['d'] = OrderedDict([('e', OrderedDict([('f', 'z')])),
+                                 ('g', [1, 2])])
+        tree['sops'] = dict(version=sops.VERSION)
+        sops.set_mac_format(tree, 'merkle')
+        tree = sops.walk_and_encrypt(tree, key)
+        assert sorted(tree['sops']['mac_tree']) == [
+            '["b"]', '["b"][1]', '["d"]', '["d"]["e"]', '["d"]["g"]']
+        cleartree = sops.walk_and_decrypt(copy.deepcopy(tree), key)
+        assert cleartree['d']['e']['f'] == 'z'
+        # list items share their aad, only the MAC catches a swap
+        tree['d']['g'].reverse()
+        with self.assertRaises(sops.MacError):
+            sops.walk_and_decrypt(tree, key)
+
+    def test_merkle_mac_verifies_paths(self):
+        """Test the merkle MAC is checked along paths without decrypting
+        values, and catches changes in the branches or the stored hashes"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y', {'c': 1.5}])])
+        tree['d'] = OrderedDict([('e', OrderedDict([('f', 'z')])),
+                                 ('g', [1, 2])])
+        tree['sops'] = dict(version=sops.VERSION)
+        sops.set_mac_format(tree, 'merkle')
+        tree = sops.walk_and_encrypt(tree, key)
+        cipher = sops.LeafCipher(key)
+        cipher._aead = mock.Mock(wraps=cipher._aead)
+        tree['d']['e']['f'] = tree['a']
+        sops.verify_merkle_mac(tree, cipher, [('b', 1), ('d', 'g')])
+        # only the MAC itself was decrypted
+        assert cipher._aead.decrypt.call_count == 2
+        for path in [('d', 'e'), ()]:
+            with self.assertRaises(sops.MacError):
+                sops.verify_merkle_mac(tree, cipher, [path])
+        tree['sops']['mac_tree']['["d"]'] = "00" * 64
+        with self.assertRaises(sops.MacError):
+            sops.verify_merkle_mac(tree, cipher, [('a',)])
+
+    def test_merkle_mac_updates_paths(self):
+        """Test the merkle MAC is updated along the changed paths to the
+        MAC of the whole tree, also when branches are removed"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y', {'c': 1.5}])])
+        tree['d'] = OrderedDict([('e', OrderedDict([('f', 'z')])),
+                                 ('g', [1, 2])])
+        tree['sops'] = dict(version=sops.VERSION)
+        sops.set_mac_format(tree, 'merkle')
+        tree = sops.walk_and_encrypt(tree, key)
+        cipher = sops.LeafCipher(key)
+        tree['d']['e']['f'] = cipher.encrypt('w', aad=b'd:e:f:')
+        del tree['b'][1]
+        sops.store_merkle_mac(tree, cipher, [('d', 'e', 'f'), ('b',)])
+        sops.verify_merkle_mac(tree, cipher)
+        updated = dict(tree['sops']['mac_tree'])
+        sops.store_merkle_mac(tree, cipher)
+        assert updated == tree['sops']['mac_tree']
+        del tree['d']['e']
+        sops.store_merkle_mac(tree, cipher, [('d', 'e', 'f')])
+        assert '["d"]["e"]' not in tree['sops']['mac_tree']
+        sops.verify_merkle_mac(tree, cipher)
+
+    def test_lazy_tree_verifies_merkle_mac_of_branches(self):
+        """Test a LazyTree with a merkle MAC only checks the branches it
+        iterates over or verifies"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y', {'c': 1.5}])])
+        tree['d'] = OrderedDict([('e', OrderedDict([('f', 'z')])),
+                                 ('g', [1, 2])])
+        tree['sops'] = dict(version=sops.VERSION)
+        sops.set_mac_format(tree, 'merkle')
+        tree = sops.walk_and_encrypt(tree, key)
+        tree['b'][1]['c'] = tree['a']
+        lazy = sops.LazyTree(tree, key, verify_on_iter=True)
+        assert list(lazy['d']['e']) == ['f']
+        lazy.verify(['["d"]["g"]'])
+        with self.assertRaises(sops.MacError):
+            list(lazy['b'])
+        with self.assertRaises(sops.MacError):
+            lazy.verify()
+
+    def test_update_tree(self):
+        """Test update_tree sets and removes values, with each MAC format,
+        and keeps the ciphertext of the values it doesn't change"""
+        key = os.urandom(32)
+        for mac_format in sops.MAC_FORMATS:
+            tree = OrderedDict([('a', 'x'), ('b', ['y', {'c': 1.5}])])
+            tree['d'] = OrderedDict([('e', OrderedDict([('f', 'z')])),
+                                     ('g', [1, 2])])
+            tree['sops'] = dict(version=sops.VERSION)
+            sops.set_mac_format(tree, mac_format)
+            tree = sops.walk_and_encrypt(tree, key)
+            kept = (tree['a'], tree['b'][0], tree['d']['g'][0])
+            tree = sops.update_tree(
+                tree, key,
+                [(('d', 'e', 'f'), 'w'), (('d', 'h'), {'i': [True]}),
+                 (('b', 2), 3)],
+                [('b', 1), ('d', 'g', 1)])
+            assert (tree['a'], tree['b'][0], tree['d']['g'][0]) == kept
+            cleartree = sops.walk_and_decrypt(tree, key)
+            assert cleartree['b'] == ['y', 3]
+            assert cleartree['d'] == {'e': {'f': 'w'}, 'g': [1],
+                                      'h': {'i': [True]}}
+
+    def test_update_tree_invalid_paths(self):
+        """Test update_tree raises TreePathError for paths through a value
+        or past the end of a list, in the sops branch, or not found, and
+        leaves the tree as it was"""
+        key = os.urandom(32)
+        for mac_format in sops.MAC_FORMATS:
+            tree = OrderedDict([('a', 'x'), ('b', ['y', {'c': 'z'}])])
+            tree['sops'] = dict(version=sops.VERSION)
+            sops.set_mac_format(tree, mac_format)
+            tree = sops.walk_and_encrypt(tree, key)
+            original = copy.deepcopy(tree)
+            for assignments, removals in [
+                    ([(('a', 'b'), 1)], []),
+                    ([(('b', 3), 1)], []),
+                    ([(('sops', 'x'), 1)], []),
+                    ([(('b', 1, 'c'), 'w')], [('x',)])]:
+                with self.assertRaises(sops.TreePathError):
+                    sops.update_tree(tree, key, assignments, removals)
+                assert tree == original
+
+    def test_parse_value(self):
+        """Test values of --set are parsed as JSON, or else as strings"""
+        assert sops.parse_value('5432') == 5432
+        assert sops.parse_value('"5432"') == '5432'
+        assert sops.parse_value('hunter2') == 'hunter2'
+        assert sops.parse_value('{"a": [1, null]}') == {'a': [1, None]}
+
+    def test_document(self):
+        """Test a Document decrypts, extracts, updates and saves its tree,
+        and load raises DocumentError for a file that isn't encrypted"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y', {'c': 1.5}])])
+        tree['d'] = OrderedDict([('e', OrderedDict([('f', 'z')]))])
+        tree['sops'] = dict(version=sops.VERSION)
+        tree = sops.walk_and_encrypt(tree, key)
+        doc = sops.Document(tree, key=key, filetype='json')
+        assert doc.decrypt()['d']['e']['f'] == 'z'
+        assert tree['d']['e']['f'].startswith("ENC[AES256_GCM,data:")
+        assert doc.extract(['["b"][1]["c"]', '["a"]']) == \
+            {'["b"][1]["c"]': 1.5, '["a"]': 'x'}
+        doc.update([(('d', 'e', 'f'), 'w')])
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            assert doc.save(path) == path
+            loaded = sops.load(path)
+            with mock.patch.object(sops, 'get_key',
+                                   side_effect=lambda tree, **kw: (key, tree)):
+                assert loaded.decrypt()['d']['e']['f'] == 'w'
+            with open(path, 'w') as fd:
+                fd.write('{"a": "b"}')
+            with self.assertRaises(sops.DocumentError):
+                sops.load(path)
+        finally:
+            os.remove(path)
+
+    def test_document_raises_typed_errors(self):
+        """Test a Document raises TreePathError for paths not in its tree,
+        and MacError for a value that fails authentication"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', ['y'])])
+        tree['d'] = OrderedDict([('e', OrderedDict([('f', 'z')]))])
+        tree['sops'] = dict(version=sops.VERSION)
+        tree = sops.walk_and_encrypt(tree, key)
+        doc = sops.Document(tree, key=key, filetype='json')
+        for path in ['["nope"]', '["b"][9]', '["a"]["x"]']:
+            with self.assertRaises(sops.TreePathError):
+                doc.extract([path], ignore_mac=True)
+        # a value moved to another key fails the authentication of its aad
+        tree['d']['e']['f'] = tree['a']
+        with self.assertRaises(sops.MacError) as cm:
+            doc.extract(['["d"]["e"]["f"]'], ignore_mac=True)
+        assert '["d"]["e"]["f"]' in str(cm.exception)
+        with self.assertRaises(sops.MacError):
+            sops.walk_and_decrypt(tree, key, ignoreMac=True)
+
+    def test_parallel_decrypt_raises_errors_of_workers(self):
+        """Test the typed errors of the workers of a parallel decryption
+        are raised to the caller"""
+        key = os.urandom(32)
+        tree = OrderedDict(("key%d" % i, "value") for i in range(100))
+        tree['sops'] = dict(version=sops.VERSION)
+        tree = sops.encrypt_tree(tree, key)
+        tree['key50'] = tree['key50'].replace('type:str', 'type:nope')
+        with self.assertRaises(sops.DocumentError) as cm:
+            sops.decrypt_tree(tree, key, jobs=4)
+        assert cm.exception.error_code == 23
+
+    def test_main_exits_with_error_code(self):
+        """Test main prints the SopsError it fails with, and exits with its
+        error code"""
+        error = sops.MacError("Checksum verification failed!")
+        with mock.patch.object(sops, '_main', side_effect=error):
+            with mock.patch.object(builtins, 'print') as print_mock:
+                with self.assertRaises(SystemExit) as cm:
+                    sops.main()
+        assert cm.exception.code == 51
+        print_mock.assert_called_with(
+            "PANIC: Checksum verification failed!", file=sys.stderr)
+
+    def test_update_old_document_raises_its_version(self):
+        """Test updating a document of version 0.8 writes it in the current
+        format, with its version raised"""
+        key = os.urandom(32)
+        old = sops.LeafCipher(key, 0.8)
+        old_tree = OrderedDict([('a', old.encrypt('x', aad=b'a')),
+                                ('b', OrderedDict([('c', old.encrypt(
+                                    'y', aad=b'abc'))]))])
+        old_tree['sops'] = dict(version=0.8)
+        sops.store_mac(old_tree, old, sops.hashlib.sha512(b'xy'))
+        doc = sops.Document(old_tree, key=key)
+        doc.update([(('b', 'd'), 'z')])
+        assert doc.tree['sops']['version'] == sops.VERSION
+        cleartree = sops.decrypt_tree(doc.tree, key)
+        cleartree.pop('sops')
+        assert cleartree == {'a': 'x', 'b': {'c': 'y', 'd': 'z'}}
+
+    def test_rotate_old_document(self):
+        """Test rotating the data key of a document of version 0.8 writes
+        it in the current format, with its version raised"""
+        key, new_key = os.urandom(32), os.urandom(32)
+        old = sops.LeafCipher(key, 0.8)
+        old_tree = OrderedDict([('a', old.encrypt('x', aad=b'a')),
+                                ('b', OrderedDict([('c', old.encrypt(
+                                    'y', aad=b'abc'))]))])
+        old_tree['sops'] = dict(version=0.8)
+        sops.store_mac(old_tree, old, sops.hashlib.sha512(b'xy'))
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'old.json')
+        sops.write_file(old_tree, path=path, filetype='json')
+        with mock.patch.object(sops, 'get_key',
+                               side_effect=lambda tree, *a, **kw: (key, tree)):
+            with mock.patch.object(sops, 'generate_key',
+                                   return_value=new_key):
+                batch.rotate_file(path, path, {})
+        tree = sops.load_file_into_tree(path, 'json')
+        assert tree['sops']['version'] == sops.VERSION
+        cleartree = sops.decrypt_tree(tree, new_key)
+        cleartree.pop('sops')
+        assert cleartree == {'a': 'x', 'b': {'c': 'y'}}
+
+    def test_batch_passes_hedge_delay_to_get_key(self):
+        """Test the files of --recursive decrypt their data key with the
+        --hedge-delay of the command"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x')])
+        tree['sops'] = dict(version=sops.VERSION)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'secrets.json')
+        sops.write_file(sops.encrypt_tree(tree, key), path=path,
+                        filetype='json')
+        for process_file in (batch.decrypt_file, batch.rotate_file,
+                             batch.master_keys_file):
+            with mock.patch.object(
+                    sops, 'get_key',
+                    side_effect=lambda tree, *a, **kw: (key, tree)) as get_key:
+                with mock.patch.object(sops, 'change_master_keys',
+                                       side_effect=lambda tree, *a, **kw:
+                                       tree):
+                    with mock.patch.object(sops, 'generate_key',
+                                           return_value=key):
+                        process_file(path, os.path.join(tmpdir, 'out.json'),
+                                     dict(hedge_delay=0.5, add_pgp='fp'))
+            assert get_key.call_args[1]['hedge_delay'] == 0.5
+
+    def test_decrypt_documents_of_different_versions_concurrently(self):
+        """Test documents of version 0.8 and 0.9 decrypted at once in
+        several threads each use the format rules of their version"""
+        key = os.urandom(32)
+        old = sops.LeafCipher(key, 0.8)
+        old_tree = OrderedDict([('a', old.encrypt('x', aad=b'a')),
+                                ('b', OrderedDict([('c', old.encrypt(
+                                    'y', aad=b'abc'))]))])
+        old_tree['sops'] = dict(version=0.8)
+        sops.store_mac(old_tree, old, sops.hashlib.sha512(b'xy'))
+        new_tree = OrderedDict([('a', 'x'), ('b', OrderedDict([('c', 'y')]))])
+        new_tree['sops'] = dict(version=sops.VERSION)
+        new_tree = sops.encrypt_tree(new_tree, key)
+        results = []
+
+        def decrypt(tree):
+            for i in range(50):
+                cleartree = sops.walk_and_decrypt(copy.deepcopy(tree), key)
+                results.append(cleartree['b']['c'] == 'y')
+
+        threads = [threading.Thread(target=decrypt, args=(tree,))
+                   for tree in [old_tree, new_tree] * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(results) == 200 and all(results)
+
+    def test_mac_is_stored_with_the_time_of_the_operation(self):
+        """Test the MAC and lastmodified are stored with the timestamp of
+        the LeafCipher of the operation"""
+        key = os.urandom(32)
+        cleartree = OrderedDict([('a', 'x')])
+        cleartree['sops'] = dict(version=sops.VERSION)
+        with mock.patch.object(sops, 'timestamp',
+                               return_value='2016-01-01T00:00:00Z'):
+            tree = sops.encrypt_tree(cleartree, key)
+        assert tree['sops']['lastmodified'] == '2016-01-01T00:00:00Z'
+        cipher = sops.LeafCipher(key, now='2016-01-02T00:00:00Z')
+        tree = sops.walk_and_encrypt(cleartree, key, cipher=cipher)
+        assert tree['sops']['lastmodified'] == '2016-01-02T00:00:00Z'
+        sops.decrypt_tree(tree, key)
+
+    def _run_async(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    @unittest2.skipIf(sys.version_info < (3, 5), "requires python 3.5")
+    def test_aload(self):
+        """Test aload decrypts the data key of a document with its master
+        keys, and adecrypt_tree and aencrypt_tree round trip its tree"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x')])
+        tree['d'] = OrderedDict([('e', OrderedDict([('f', 'z')])),
+                                 ('g', [1, 2])])
+        tree['sops'] = dict(version=sops.VERSION)
+        tree = sops.walk_and_encrypt(tree, key)
+        tree['sops']['kms'] = [
+            {'arn': 'arn:aws:kms:us-east-1:123:key/%d' % i, 'enc': 'eA=='}
+            for i in range(2)]
+        kms = mock.Mock()
+        kms.decrypt.side_effect = [Exception("AccessDenied"),
+                                   {'Plaintext': key}]
+        fd, path = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            sops.write_file(tree, path=path, filetype='json')
+            with mock.patch.object(sops, 'get_aws_session_for_entry',
+                                   return_value=kms):
+                with mock.patch.object(builtins, 'print'):
+                    doc = self._run_async(sops.aload(path))
+        finally:
+            os.remove(path)
+        assert doc.key == key
+        assert kms.decrypt.call_count == 2
+        cleartree = self._run_async(sops.adecrypt_tree(doc.tree, key))
+        assert cleartree['d']['e']['f'] == 'z'
+        tree = self._run_async(sops.aencrypt_tree(cleartree, key))
+        assert sops.decrypt_tree(tree, key)['d'] == cleartree['d']
+
+    @unittest2.skipIf(sys.version_info < (3, 5), "requires python 3.5")
+    def test_aget_key_tries_master_keys_concurrently(self):
+        """Test aget_key tries the KMS master keys at once, and raises
+        MasterKeyError if none decrypts the data key"""
+        key = os.urandom(32)
+        tree = {'sops': {'kms': [{}] * 3, 'pgp': [{}]}}
+        started = threading.Barrier(3, timeout=5)
+
+        def decrypt_key_with_kms(entry, i):
+            # only returns once the three keys are tried at the same time
+            started.wait()
+            return key if i == 2 else None
+
+        with mock.patch.object(sops, 'decrypt_key_with_kms',
+                               side_effect=decrypt_key_with_kms):
+            with mock.patch.object(sops, 'decrypt_key_with_pgp') as pgp:
+                assert self._run_async(sops.aget_key(tree)) == (key, tree)
+        assert not pgp.called
+        with mock.patch.object(sops, 'decrypt_key_with_kms',
+                               return_value=None):
+            with mock.patch.object(sops, 'decrypt_key_with_pgp',
+                                   return_value=None):
+                with self.assertRaises(sops.MasterKeyError):
+                    self._run_async(sops.aget_key(tree))
+
     def test_walk_list_and_encrypt(self):
         """Walk a list contained in a branch and encrypts its values."""
         # - test stash value
@@ -197,6 +835,37 @@ class TreeTest(unittest2.TestCase):
         clearstr = sops.decrypt(sops.encrypt(origin, key, aad=aad), key, aad=aad)
         assert clearstr == origin
 
+    def test_leaf_cipher_roundtrip_types(self):
+        """Test the leaf cipher preserves the type of values"""
+        cipher = sops.LeafCipher(os.urandom(32))
+        for origin in ["AAAA", "", 1234, 12.5, True, False, b'\x00\xff']:
+            enc = cipher.encrypt(origin, aad=b'key:')
+            assert cipher.decrypt(enc, aad=b'key:') == origin
+
+    def test_leaf_cipher_ignores_cleartext(self):
+        """Values that are not in encrypted form are returned as is"""
+        cipher = sops.LeafCipher(os.urandom(32))
+        for value in ["ENC[AES256_GCM,data:foo]", "cleartext", 1234, None]:
+            assert cipher.decrypt(value) == value
+
+    def test_leaf_cipher_reads_untyped_values(self):
+        """Documents older than 0.8 don't store the type of values"""
+        key = os.urandom(32)
+        enc = sops.LeafCipher(key).encrypt("AAAA")
+        enc = enc[:enc.index(',type:')] + ']'
+        assert sops.LeafCipher(key, 0.7).decrypt(enc) == "AAAA"
+        assert sops.LeafCipher(key, 0.9).decrypt(enc) == enc
+
+    def test_leaf_cipher_without_aead_interface(self):
+        """The Cipher fallback reads and writes the same format"""
+        key = os.urandom(32)
+        enc = sops.LeafCipher(key).encrypt("AAAA", aad=b'aad')
+        with mock.patch.object(sops, 'AESGCM', None):
+            cipher = sops.LeafCipher(key)
+            assert cipher.decrypt(enc, aad=b'aad') == "AAAA"
+            enc = cipher.encrypt("BBBB", aad=b'aad')
+        assert sops.LeafCipher(key).decrypt(enc, aad=b'aad') == "BBBB"
+
     # Test keys management
     def test_get_key(self):
         """Test we obtain a 256 bits symetric key."""
@@ -207,6 +876,698 @@ class TreeTest(unittest2.TestCase):
     def test_get_key_from_kms(self):
         """Test we get the key form the KMS tree leave."""
 
+    def test_key_cache(self):
+        """Test the KeyCache indexes keys by master key and ciphertext, evicts
+        the least recently used ones and those older than its ttl"""
+        cache = sops.KeyCache(maxsize=2, ttl=10)
+        entries = [{'arn': 'arn%d' % i, 'enc': 'enc'} for i in range(3)]
+        with mock.patch.object(sops.KeyCache, '_clock', return_value=100):
+            cache.put('kms', entries[0], b'key0')
+            cache.put('kms', entries[1], b'key1')
+            assert cache.get('kms', entries[0]) == b'key0'
+            # the master key identity is part of the index
+            assert cache.get('pgp', {'fp': 'arn0', 'enc': 'enc'}) is None
+            assert cache.get('kms', dict(entries[0], role='r')) is None
+            cache.put('kms', entries[2], b'key2')
+            # entry 1 was the least recently used
+            assert cache.get('kms', entries[1]) is None
+            assert cache.get('kms', entries[2]) == b'key2'
+            cache.invalidate('kms', entries[2])
+            assert cache.get('kms', entries[2]) is None
+        with mock.patch.object(sops.KeyCache, '_clock', return_value=110):
+            assert cache.get('kms', entries[0]) is None
+        assert cache.stats() == dict(hits=2, misses=5, size=0)
+        cache.put('pgp', {'fp': 'fp', 'enc': 'enc'}, b'key')
+        cache.invalidate('kms')
+        assert len(cache) == 1
+        cache.invalidate()
+        assert len(cache) == 0
+        cache = sops.KeyCache(ttl=0)
+        cache.put('kms', entries[0], b'key0')
+        assert cache.get('kms', entries[0]) is None
+
+    def test_get_key_uses_key_cache(self):
+        """Test get_key decrypts a data key with KMS once, then takes it from
+        KEY_CACHE, along with the keys it generates"""
+        key = os.urandom(32)
+        tree = {'sops': {'kms': [{'arn': 'arn:aws:kms:us-east-1:1:key/1',
+                                  'enc': 'eA=='}]}}
+        kms = mock.Mock()
+        kms.decrypt.return_value = {'Plaintext': key}
+        with mock.patch.object(sops, 'get_aws_session_for_entry',
+                               return_value=kms):
+            for i in range(3):
+                assert sops.get_key(copy.deepcopy(tree)) == (key, tree)
+            assert kms.decrypt.call_count == 1
+            sops.KEY_CACHE.invalidate()
+            sops.get_key(tree)
+            assert kms.decrypt.call_count == 2
+        # a newly generated key is cached with its encrypted form
+        kms.encrypt.return_value = {'CiphertextBlob': b'y'}
+        with mock.patch.object(sops, 'get_aws_session_for_entry',
+                               return_value=kms):
+            with mock.patch.object(builtins, 'print'):
+                key, tree = sops.get_key(tree, need_key=True)
+            assert sops.get_key(tree) == (key, tree)
+        assert kms.decrypt.call_count == 2
+
+    def test_new_data_key_is_generated_by_kms(self):
+        """Test a new data key is generated by KMS with a single KMS master
+        key, locally with several, or when GenerateDataKey fails"""
+        def encrypt_key_with_pgp(key, entry):
+            entry['enc'] = 'enc'
+            return entry
+        kms = FakeKMS()
+        with mock.patch.object(sops, 'get_aws_session_for_entry',
+                               side_effect=lambda entry: kms):
+            with mock.patch.object(sops, 'encrypt_key_with_pgp',
+                                   side_effect=encrypt_key_with_pgp):
+                with mock.patch.object(builtins, 'print'):
+                    key, tree = sops.get_key({'sops': {
+                        'kms': [{'arn': 'arn1'}],
+                        'pgp': [{'fp': 'fp1'}]}}, need_key=True)
+                    assert kms.calls == {'GenerateDataKey': 1}
+                    assert len(key) == 32
+                    assert 'created_at' in tree['sops']['kms'][0]
+                    # the other master keys still encrypt the data key
+                    assert tree['sops']['pgp'][0]['enc'] == 'enc'
+                    sops.KEY_CACHE.invalidate()
+                    assert sops.get_key(tree)[0] == key
+                    # several KMS master keys encrypt a local key at once
+                    kms.calls = {}
+                    sops.get_key({'sops': {'kms': [
+                        {'arn': 'arn1'}, {'arn': 'arn2'}]}}, need_key=True)
+                    assert kms.calls == {'Encrypt': 2}
+                    # the key is generated locally if GenerateDataKey fails
+                    kms = FakeKMS(fail=['GenerateDataKey'])
+                    key, tree = sops.get_key({'sops': {'kms': [
+                        {'arn': 'arn1'}]}}, need_key=True)
+                    assert kms.calls == {'GenerateDataKey': 1, 'Encrypt': 1}
+                    sops.KEY_CACHE.invalidate()
+                    assert sops.get_key(tree)[0] == key
+
+    def test_generate_key_keeps_entries_that_fail_to_encrypt(self):
+        """Test a master key that fails to encrypt a new data key keeps the
+        previous one, and isn't cached or counted as encrypting the new"""
+        old = [{'arn': 'arn1', 'enc': 'eA=='}, {'arn': 'arn2', 'enc': 'eQ=='}]
+        kms = {'arn1': FakeKMS(fail=['Encrypt']), 'arn2': FakeKMS()}
+        with mock.patch.object(sops, 'get_aws_session_for_entry',
+                               side_effect=lambda entry: kms[entry['arn']]):
+            with mock.patch.object(builtins, 'print'):
+                tree = {'sops': {'kms': [dict(e) for e in old]}}
+                key = sops.generate_key(tree)
+                assert tree['sops']['kms'][0] == old[0]
+                assert tree['sops']['kms'][1]['enc'] != old[1]['enc']
+                assert sops.KEY_CACHE.get('kms', old[0]) is None
+                assert sops.KEY_CACHE.get('kms', tree['sops']['kms'][1]) == \
+                    key
+                kms['arn2'].fail = ['Encrypt']
+                tree = {'sops': {'kms': [dict(e) for e in old]}}
+                with self.assertRaises(sops.MasterKeyError):
+                    sops.generate_key(tree)
+                assert tree['sops']['kms'] == old
+                assert sops.KEY_CACHE.get('kms', old[0]) is None
+                assert sops.KEY_CACHE.get('kms', old[1]) is None
+
+    def test_agent_serves_data_keys(self):
+        """Test the agent serves the data keys it decrypts to sops commands,
+        and sops decrypts them itself when the agent is gone"""
+        key = os.urandom(32)
+        tree = {'sops': {'kms': [{'arn': 'arn:aws:kms:us-east-1:1:key/1',
+                                  'enc': 'eA=='},
+                                 {'arn': 'arn:aws:kms:us-east-1:1:key/2',
+                                  'enc': 'eQ=='}]}}
+
+        def decrypt(CiphertextBlob):
+            if CiphertextBlob != b'y':
+                raise Exception("AccessDeniedException")
+            return {'Plaintext': key}
+        kms = mock.Mock()
+        kms.decrypt.side_effect = decrypt
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'agent.sock')
+        server = agent.AgentServer(path)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            assert oct(os.stat(path).st_mode & 0o777) == oct(0o600)
+            with mock.patch.dict(os.environ, SOPS_AGENT_SOCK=path):
+                with mock.patch.object(sops, 'get_aws_session_for_entry',
+                                       return_value=kms):
+                    with mock.patch.object(builtins, 'print'):
+                        for i in range(3):
+                            sops.KEY_CACHE.invalidate()
+                            assert sops.get_key(tree) == (key, tree)
+                    # the calls of the agent are recorded, the failed entry
+                    # is tried last
+                    assert kms.decrypt.call_count == 2
+                    records = sops.MASTER_KEY_STATS.records()
+                    assert records['kms:' + tree['sops']['kms'][0]['arn']][
+                        'failures'] == 1
+                    # the failed entry is tried again, not the other one
+                    for i in range(2):
+                        assert agent.request_key(
+                            path, 'kms', tree['sops']['kms'][0]) is None
+                    assert agent.request_key(
+                        path, 'kms', tree['sops']['kms'][1]) == key
+                    assert kms.decrypt.call_count == 4
+                    assert agent.request(path, {'op': 'stats'}) == \
+                        dict(hits=3, misses=4, size=1, kms={'us-east-1': dict(
+                            requests=4, throttles=0, retries=0, waited=0,
+                            rate=0)})
+                    with self.assertRaises(agent.AgentError):
+                        agent.request(path, {'op': 'delete'})
+                    server.shutdown()
+                    server.server_close()
+                    # without an agent, keys are decrypted directly
+                    sops.KEY_CACHE.invalidate()
+                    with mock.patch.object(builtins, 'print') as print_mock:
+                        assert sops.get_key(tree) == (key, tree)
+                    assert 'agent unavailable' in \
+                        print_mock.call_args_list[0][0][0]
+                    assert kms.decrypt.call_count == 5
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+            shutil.rmtree(tmpdir)
+
+    def test_recursive_decrypt_in_process_pool(self):
+        """Decrypt the files of a directory into a mirrored directory"""
+        key = os.urandom(32)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        src = os.path.join(tmpdir, 'src')
+        for path in ('a.json', os.path.join('b', 'c.json'),
+                     os.path.join('.git', 'd.json'), 'e.txt'):
+            directory = os.path.dirname(os.path.join(src, path))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tree = OrderedDict([('name', path), ('sops', dict(version=0.9))])
+            sops.write_file(sops.encrypt_tree(tree, key),
+                            path=os.path.join(src, path), filetype='json')
+        sops.write_file(OrderedDict([('sops', dict(version=0.9))]),
+                        path=os.path.join(src, 'broken.json'),
+                        filetype='json')
+        assert batch.find_files(src, include=['*.json']) == [
+            'a.json', os.path.join('b', 'c.json'), 'broken.json']
+        out = os.path.join(tmpdir, 'out')
+        devnull = open(os.devnull, 'w')
+        self.addCleanup(devnull.close)
+        with mock.patch.object(sops, 'get_key',
+                               side_effect=lambda tree, *a, **kw: (key, tree)):
+            results = batch.run(src, 'decrypt', output_dir=out,
+                                include=['*.json'], jobs=2, out=devnull)
+        assert [(os.path.relpath(path, src), error is None)
+                for path, error, seconds in results] == [
+            ('a.json', True), (os.path.join('b', 'c.json'), True),
+            ('broken.json', False)]
+        assert 'mac' in results[2][1]
+        tree = sops.load_file_into_tree(
+            os.path.join(out, 'b', 'c.json'), 'json')
+        assert tree == {'name': os.path.join('b', 'c.json')}
+        assert not os.path.exists(os.path.join(out, '.git'))
+        assert 'SOPS_AGENT_SOCK' not in os.environ
+
+    def test_recursive_run_resumes_from_checkpoint(self):
+        """Skip the files of the checkpoint, and remove it when done"""
+        key = os.urandom(32)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        src = os.path.join(tmpdir, 'src')
+        os.mkdir(src)
+        tree = OrderedDict([('a', 'x'), ('sops', dict(version=0.9))])
+        for name in ('a.json', 'b.json', 'c.json'):
+            sops.write_file(sops.encrypt_tree(tree, key),
+                            path=os.path.join(src, name), filetype='json')
+        os.chmod(os.path.join(src, 'b.json'), 0o640)
+        os.remove(os.path.join(src, 'c.json'))
+        os.mkdir(os.path.join(src, 'c.json'))
+        checkpoint = os.path.join(tmpdir, 'checkpoint')
+        with open(checkpoint, 'w') as fd:
+            fd.write('a.json\n')
+        devnull = open(os.devnull, 'w')
+        self.addCleanup(devnull.close)
+        with mock.patch.object(sops, 'get_key',
+                               side_effect=lambda tree, *a, **kw: (key, tree)):
+            results = batch.run(src, 'decrypt', include=['*.json'], jobs=2,
+                                checkpoint=checkpoint, kms_concurrency=2,
+                                out=devnull)
+            # c.json is a directory, and isn't processed
+            assert [os.path.basename(r[0]) for r in results] == ['b.json']
+            assert sops.load_file_into_tree(
+                os.path.join(src, 'b.json'), 'json') == {'a': 'x'}
+            assert oct(os.stat(os.path.join(src, 'b.json')).st_mode &
+                       0o777) == oct(0o640)
+            assert not os.path.exists(checkpoint)
+            # b.json is now in cleartext and fails, it stays out of the
+            # checkpoint, which is kept
+            results = batch.run(src, 'decrypt', include=['*.json'], jobs=2,
+                                checkpoint=checkpoint, out=devnull)
+        assert [r[1] is None for r in results] == [True, False]
+        with open(checkpoint) as fd:
+            assert fd.read() == 'a.json\n'
+        assert sorted(os.listdir(src)) == ['a.json', 'b.json', 'c.json']
+        assert sops.KMS_LIMITER.semaphore is None
+
+    def test_aws_clients_are_reused(self):
+        """Test KMS clients are reused per region and role, and the
+        credentials of a role renewed before they expire"""
+        expiration = datetime.utcfromtimestamp(10000)
+        sts = mock.Mock()
+        sts.assume_role.return_value = {
+            'AssumedRoleUser': {'Arn': 'assumed'},
+            'Credentials': {'AccessKeyId': 'id', 'SecretAccessKey': 'secret',
+                            'SessionToken': 'token',
+                            'Expiration': expiration}}
+
+        def client(service, **kwargs):
+            return sts if service == 'sts' else mock.Mock(kwargs=kwargs)
+        entries = [{'arn': 'arn:aws:kms:%s:1:key/1' % region}
+                   for region in ('us-east-1', 'us-west-2', 'us-east-1')]
+        role = 'arn:aws:iam::1:role/sops'
+        with mock.patch.object(boto3, 'client',
+                               side_effect=client) as boto3_client:
+            with mock.patch.object(sops.AwsClientPool, '_clock',
+                                   return_value=9000):
+                clients = [sops.get_aws_session_for_entry(e)
+                           for e in entries]
+                assert clients[0] is clients[2]
+                assert clients[0] is not clients[1]
+                assert boto3_client.call_count == 2
+                with mock.patch.object(builtins, 'print'):
+                    role_clients = [
+                        sops.get_aws_session_for_entry(dict(e, role=role))
+                        for e in entries]
+                assert role_clients[0] is role_clients[2]
+                assert role_clients[0] is not clients[0]
+                assert role_clients[1].kwargs['aws_session_token'] == 'token'
+                # the credentials of the role are shared by the regions
+                assert sts.assume_role.call_count == 1
+            # credentials are renewed shortly before they expire
+            with mock.patch.object(sops.AwsClientPool, '_clock',
+                                   return_value=9800):
+                assert sops.get_aws_session_for_entry(entries[0]) is \
+                    clients[0]
+                with mock.patch.object(builtins, 'print'):
+                    client = sops.get_aws_session_for_entry(
+                        dict(entries[0], role=role))
+                assert client is not role_clients[0]
+                assert sts.assume_role.call_count == 2
+            sts.assume_role.side_effect = Exception("AccessDenied")
+            sops.AWS_CLIENTS.clear()
+            with mock.patch.object(builtins, 'print'):
+                assert sops.get_aws_session_for_entry(
+                    dict(entries[0], role=role)) is None
+
+    def test_master_keys_encrypt_data_key_concurrently(self):
+        """Test the KMS master keys encrypt a new data key concurrently, and
+        the PGP ones in turn"""
+        tree = {'sops': {'kms': [{'arn': 'arn%d' % i} for i in range(6)],
+                         'pgp': [{'fp': 'fp%d' % i} for i in range(4)]}}
+        tree['sops']['pgp'][0]['enc'] = 'kept'
+
+        def encrypt_key(key, entry):
+            time.sleep(0.3)
+            entry['enc'] = 'enc'
+            return entry
+        start = time.time()
+        with mock.patch.object(sops, 'encrypt_key_with_kms',
+                               side_effect=encrypt_key):
+            with mock.patch.object(sops, 'encrypt_key_with_pgp',
+                                   side_effect=encrypt_key):
+                with mock.patch.object(builtins, 'print'):
+                    sops.update_master_keys(tree, b'key')
+                    # 6 KMS keys concurrently, and 3 PGP keys in turn
+                    assert time.time() - start < 1.5
+                    assert sops.encrypt_key_with_master_keys(
+                        b'key', tree) == 10
+        assert [e['enc'] for e in tree['sops']['pgp']] == ['enc'] * 4
+
+    def test_change_master_keys_keeps_values(self):
+        """Test adding and removing master keys leaves the encrypted values,
+        the MAC and the version of the document as they are"""
+        key = os.urandom(32)
+        tree = OrderedDict([('a', 'x'), ('b', [1, 2])])
+        tree['sops'] = {'version': 0.8, 'kms': [
+            {'arn': 'arn1', 'enc': 'k1'},
+            {'arn': 'arn1', 'role': 'arn:aws:iam::1:role/r', 'enc': 'k2'},
+            {'arn': 'arn2', 'enc': 'k3'}, {'arn': ''}],
+            'pgp': [{'fp': 'abcd', 'enc': 'p1'}]}
+        tree = sops.walk_and_encrypt(tree, key)
+        encrypted = copy.deepcopy(tree)
+
+        def encrypt_key(key, entry):
+            entry['enc'] = 'new'
+            return entry
+        with mock.patch.object(sops, 'encrypt_key_with_kms',
+                               side_effect=encrypt_key) as kms:
+            with mock.patch.object(sops, 'encrypt_key_with_pgp',
+                                   side_effect=encrypt_key):
+                with mock.patch.object(builtins, 'print'):
+                    sops.change_master_keys(tree, rm_kms='arn1',
+                                            rm_pgp='ABCD')
+                    assert kms.call_count == 0
+                    sops.change_master_keys(tree, key, add_kms='arn2,arn3',
+                                            add_pgp='ef01')
+        assert tree['sops']['kms'] == [{'arn': 'arn2', 'enc': 'k3'},
+                                       {'arn': ''},
+                                       {'arn': 'arn3', 'enc': 'new'}]
+        assert tree['sops']['pgp'] == [{'fp': 'ef01', 'enc': 'new'}]
+        for k in ('version', 'mac', 'lastmodified'):
+            assert tree['sops'][k] == encrypted['sops'][k]
+        tree.pop('sops')
+        encrypted.pop('sops')
+        assert tree == encrypted
+        # the data key is needed to add master keys, one must be left
+        tree['sops'] = {'pgp': [{'fp': 'ef01', 'enc': 'new'}]}
+        with self.assertRaises(ValueError):
+            sops.change_master_keys(tree, add_pgp='ef02')
+        with self.assertRaises(sops.MasterKeyError):
+            sops.change_master_keys(tree, rm_pgp='ef01')
+
+    def test_recursive_master_keys_keep_ciphertext(self):
+        """Remove a master key from the files of a directory"""
+        key = os.urandom(32)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'a.yaml')
+        m = mock.mock_open(read_data=sops.DEFAULT_YAML)
+        with mock.patch.object(builtins, 'open', m):
+            tree = sops.load_file_into_tree('path', 'yaml')
+        tree['sops'] = {'version': 0.9, 'pgp': [
+            {'fp': 'fp1', 'enc': 'p1'}, {'fp': 'fp2', 'enc': 'p2'}]}
+        sops.write_file(sops.walk_and_encrypt(tree, key), path=path,
+                        filetype='yaml')
+        with open(path) as fd:
+            before = fd.read()
+        devnull = open(os.devnull, 'w')
+        self.addCleanup(devnull.close)
+        results = batch.run(tmpdir, 'master_keys', dict(rm_pgp='fp1'),
+                            jobs=1, out=devnull)
+        assert results[0][1] is None
+        with open(path) as fd:
+            after = fd.read()
+        values = before[:before.index('sops:')]
+        assert after[:after.index('sops:')] == values
+        assert 'fp1' not in after and 'fp2' in after
+
+    def test_master_keys_report_failures_and_timeouts(self):
+        """Test master keys that fail or time out are reported and left as
+        they are, and MasterKeyError raised when none encrypts the key"""
+        tree = {'sops': {'kms': [{'arn': 'arn%d' % i} for i in range(3)]}}
+        release = threading.Event()
+
+        def encrypt_key(key, entry):
+            if entry['arn'] == 'arn0':
+                release.wait(5)
+            elif entry['arn'] == 'arn1':
+                raise Exception("AccessDenied")
+            entry['enc'] = 'enc'
+            return entry
+        with mock.patch.object(sops, 'MASTER_KEY_TIMEOUT', 0.2):
+            with mock.patch.object(sops, 'encrypt_key_with_kms',
+                                   side_effect=encrypt_key):
+                with mock.patch.object(builtins, 'print') as print_mock:
+                    assert sops.encrypt_key_with_master_keys(
+                        b'key', tree) == 1
+                    release.set()
+        messages = sorted(c[0][0] for c in print_mock.call_args_list)
+        assert messages[0].startswith("failed to encrypt key with kms "
+                                      "entry 1: AccessDenied")
+        assert messages[1].startswith("timed out encrypting key with kms "
+                                      "entry 0")
+        time.sleep(0.1)
+        assert tree['sops']['kms'] == [
+            {'arn': 'arn0'}, {'arn': 'arn1'}, {'arn': 'arn2', 'enc': 'enc'}]
+        with mock.patch.object(sops, 'encrypt_key_with_kms',
+                               side_effect=lambda key, entry: entry):
+            with mock.patch.object(builtins, 'print'):
+                with self.assertRaises(sops.MasterKeyError) as e:
+                    sops.get_key({'sops': {'kms': [{'arn': 'arn'}]}},
+                                 need_key=True)
+        assert e.exception.error_code == 37
+
+    def test_pgp_entries_are_encrypted_in_one_gpg_process(self):
+        """Test the data key is encrypted to several PGP keys in one gpg
+        process, each entry decrypting to the data key"""
+        gnupghome = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, gnupghome, True)
+        patcher = mock.patch.dict(os.environ, GNUPGHOME=gnupghome)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        devnull = open(os.devnull, 'w')
+        self.addCleanup(devnull.close)
+        try:
+            subprocess.check_call(
+                ['gpg', '--batch', '--import',
+                 os.path.join(os.path.dirname(__file__),
+                              'sops_functional_tests_key.asc')],
+                stdout=devnull, stderr=devnull)
+            subprocess.check_call(
+                ['gpg', '--batch', '--passphrase', '', '--quick-gen-key',
+                 'sops tests', 'future-default', 'default', 'never'],
+                stdout=devnull, stderr=devnull)
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest("requires gpg 2.1")
+        self.addCleanup(subprocess.call, ['gpgconf', '--kill', 'gpg-agent'],
+                        stdout=devnull, stderr=devnull)
+        listing = subprocess.Popen(
+            ['gpg', '--with-colons', '--list-keys', 'sops tests'],
+            stdout=subprocess.PIPE, stderr=devnull).communicate()[0]
+        fp = [line.split(b':')[9].decode('utf-8')
+              for line in listing.splitlines() if line.startswith(b'fpr')][0]
+        functional_fp = '1022470DE3F0BC54BC6AB62DE05550BC07FB1A0A'
+        key = os.urandom(32)
+        entries = [{'fp': functional_fp}, {'fp': fp}, {'fp': functional_fp}]
+        patcher = mock.patch.dict(sops._PGP_KEY_IDS, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with mock.patch.object(sops.subprocess, 'Popen',
+                               side_effect=subprocess.Popen) as popen:
+            sops.encrypt_key_with_pgp_entries(
+                key, [{'fp': fp} for fp in (fp, functional_fp)])
+            # one process lists the keys, and one encrypts
+            assert popen.call_count == 2
+            entries = sops.encrypt_key_with_pgp_entries(key, entries)
+            # the key ids are listed once
+            assert popen.call_count == 3
+        # each entry holds the session key of its PGP key only
+        for entry in entries:
+            lines = entry['enc'].splitlines()
+            sessions, data = sops._split_pgp_message(
+                sops.b64decode(''.join(lines[2:-2])))
+            assert len(sessions) == 1
+            assert sops.unwrap_key_with_pgp(entry) == key
+        assert entries[0]['enc'] == entries[2]['enc'] != entries[1]['enc']
+        # the entries are encrypted one at a time when one of them fails
+        entries = [{'fp': fp}, {'fp': 'E' * 40}]
+        with mock.patch.object(builtins, 'print'):
+            entries = sops.encrypt_key_with_pgp_entries(key, entries)
+        assert sops.unwrap_key_with_pgp(entries[0]) == key
+        assert not entries[1].get('enc')
+
+    def test_kms_rate_limiter(self):
+        """Test the KMS rate limiter paces requests per region, backs off
+        and retries throttled requests, and fails other errors at once"""
+        limiter = sops.KmsRateLimiter(rate=8, retries=2, base_delay=1)
+        limiter.configure('eu-west-1=2')
+        now = [0.0]
+
+        def sleep(seconds):
+            now[0] += seconds
+        limiter._clock = lambda: now[0]
+        limiter._sleep = sleep
+        limiter._random = lambda: 1
+        for i in range(30):
+            limiter.acquire('us-east-1')
+        # a second of requests, then the others at the rate
+        assert now[0] == 2.75
+        now[0] = 0
+        for i in range(5):
+            limiter.acquire('eu-west-1')
+        assert now[0] == 1.5
+
+        def throttled():
+            error = Exception("Rate exceeded")
+            error.response = {'Error': {'Code': 'ThrottlingException'}}
+            raise error
+        calls = []
+
+        def kms_call(**kwargs):
+            calls.append(kwargs)
+            if len(calls) < 3:
+                throttled()
+            return 'ok'
+        now[0] = 100
+        assert limiter.call('us-east-1', kms_call, KeyId='arn') == 'ok'
+        assert calls == [{'KeyId': 'arn'}] * 3
+        # backoff of 1 then 2 seconds
+        assert now[0] == 103
+        stats = limiter.stats()['us-east-1']
+        assert (stats['requests'], stats['throttles'], stats['retries']) == \
+            (33, 2, 2)
+        # the rate was halved twice, then grew back by a twentieth
+        assert stats['rate'] == 2.4
+        # throttled requests fail after the retries, other errors at once
+        with self.assertRaises(Exception):
+            limiter.call('us-east-1', throttled)
+        assert limiter.stats()['us-east-1']['throttles'] == 5
+        with self.assertRaises(KeyError):
+            limiter.call('us-east-1', {}.__getitem__, 'x')
+        assert limiter.stats()['us-east-1']['throttles'] == 5
+        with self.assertRaises(ValueError):
+            limiter.configure('fast')
+        with self.assertRaises(sops.SopsError):
+            sops.configure_kms_rate('us-east-1=')
+
+    def test_kms_rate_limiter_bounds_concurrency(self):
+        """Test the KMS rate limiter holds its semaphore while a request is
+        in flight"""
+        semaphore = mock.MagicMock()
+        limiter = sops.KmsRateLimiter(semaphore=semaphore)
+
+        def send():
+            assert semaphore.__enter__.call_count == 1
+            assert semaphore.__exit__.call_count == 0
+            return 'ok'
+        assert limiter.call('us-east-1', send) == 'ok'
+        assert semaphore.__exit__.call_count == 1
+
+    def test_get_key_hedged(self):
+        """Test get_key tries the next master key after the hedge delay,
+        without waiting on those that fail, and uses the first key
+        decrypted"""
+        key = os.urandom(32)
+        tree = {'sops': {'kms': [{'arn': 'slow'}, {'arn': 'failed'},
+                                 {'arn': 'fast'}],
+                         'pgp': [{'fp': 'fp'}]}}
+        calls = []
+
+        def decrypt_key(entry, i):
+            calls.append(entry.get('arn', 'pgp'))
+            if entry.get('arn') == 'slow':
+                time.sleep(1)
+            elif entry.get('arn') == 'failed':
+                return None
+            return key
+        with mock.patch.object(sops, 'decrypt_key_with_kms',
+                               side_effect=decrypt_key):
+            with mock.patch.object(sops, 'decrypt_key_with_pgp',
+                                   side_effect=decrypt_key):
+                start = time.time()
+                assert sops.get_key(tree, hedge_delay=0.1) == (key, tree)
+                # the failed entry didn't wait for the delay to hedge
+                assert time.time() - start < 0.8
+                assert calls == ['slow', 'failed', 'fast']
+                del calls[:]
+                assert sops.get_key_hedged(tree, 0) == key
+                assert sorted(calls) == ['failed', 'fast', 'pgp', 'slow']
+                del calls[:]
+                # the slow entry answers within the delay
+                with mock.patch.object(sops, 'HEDGE_DELAY', 5):
+                    assert sops.get_key(tree) == (key, tree)
+                assert calls == ['slow']
+        with mock.patch.object(sops, 'decrypt_key_with_kms',
+                               return_value=b'short'):
+            with mock.patch.object(sops, 'decrypt_key_with_pgp',
+                                   side_effect=Exception("no gpg")):
+                with mock.patch.object(builtins, 'print'):
+                    with self.assertRaises(sops.MasterKeyError):
+                        sops.get_key(tree, hedge_delay=0)
+
+    def test_invalid_hedge_delay_exits_with_error(self):
+        """Test a hedge delay that isn't a number of seconds, 0 or more,
+        makes sops exit with an error message"""
+        assert sops.parse_hedge_delay('0') == 0
+        assert sops.parse_hedge_delay('0.25') == 0.25
+        for delay in ['', 'soon', '-1', 'nan', 'inf']:
+            with self.assertRaises(sops.SopsError):
+                sops.parse_hedge_delay(delay)
+        for env, argv in [({'SOPS_HEDGE_DELAY': '1s'}, []),
+                          ({}, ['--hedge-delay', '-0.5'])]:
+            with mock.patch.dict(os.environ, env):
+                with mock.patch.object(sys, 'argv',
+                                       ['sops', '-d', 'file.yaml'] + argv):
+                    with mock.patch.object(builtins, 'print') as print_mock:
+                        with self.assertRaises(SystemExit) as cm:
+                            sops.main()
+            assert cm.exception.code == 1
+            assert print_mock.call_args[0][0].startswith(
+                "PANIC: invalid hedge delay")
+
+    def test_master_keys_are_tried_from_the_fastest(self):
+        """Test master keys are tried once each, then from the fastest, with
+        the unhealthy ones last until they are retried"""
+        key = os.urandom(32)
+        tree = {'sops': {'kms': [{'arn': 'slow', 'enc': 'a'},
+                                 {'arn': 'failed', 'enc': 'b'},
+                                 {'arn': 'fast', 'enc': 'c'}],
+                         'pgp': [{'fp': 'fp', 'enc': 'd'}]}}
+        calls = []
+
+        def unwrap(entry, i=0):
+            calls.append(entry.get('arn', 'pgp'))
+            if entry.get('arn') == 'slow':
+                time.sleep(0.05)
+            elif entry.get('arn') == 'failed':
+                return None
+            elif 'fp' in entry:
+                time.sleep(0.01)
+            return key
+        with mock.patch.object(sops, 'unwrap_key_with_kms',
+                               side_effect=unwrap):
+            with mock.patch.object(sops, 'unwrap_key_with_pgp',
+                                   side_effect=unwrap):
+                for i in range(5):
+                    sops.KEY_CACHE.invalidate()
+                    assert sops.get_key(tree) == (key, tree)
+        # each master key is tried once first, then the fastest
+        assert calls == ['slow', 'failed', 'fast', 'pgp', 'fast', 'fast']
+        stats = sops.MASTER_KEY_STATS.records()
+        assert stats['kms:failed']['failures'] == 1
+        assert stats['kms:fast']['calls'] == 3
+        assert stats['kms:slow']['latency'] > stats['kms:fast']['latency']
+        assert [attempt[1]['enc'] for attempt in
+                sops.master_key_attempts(tree)] == ['c', 'd', 'a', 'b']
+        # unhealthy master keys are tried again after a while
+        sops.MASTER_KEY_STATS.retry_after = 0
+        assert [attempt[1]['enc'] for attempt in
+                sops.master_key_attempts(tree)] == ['b', 'c', 'd', 'a']
+
+    def test_master_key_stats_are_saved(self):
+        """Test the statistics of master keys are saved, merged with those
+        of other processes, shown by `sops stats` and reset"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'sops', 'master_keys.json')
+            stats = sops.MasterKeyStats(path)
+            stats.record('kms', {'arn': 'arn', 'role': 'role'}, True, 0.02)
+            stats.record('pgp', {'fp': 'fp'}, False, 1)
+            # a process that read the statistics before keeps the calls
+            # recorded by the others since
+            other = sops.MasterKeyStats(path)
+            other.records()
+            stats.record('pgp', {'fp': 'fp'}, False, 1)
+            other.record('pgp', {'fp': 'fp'}, False, 1)
+            records = sops.MasterKeyStats(path).records()
+            assert records['pgp:fp']['calls'] == 3
+            assert sorted(records) == ['kms:arn+role', 'pgp:fp']
+            assert records['kms:arn+role']['latency'] == 20
+            assert records['pgp:fp']['health'] == 0
+            with mock.patch.object(sops, 'MASTER_KEY_STATS', stats):
+                with mock.patch.object(builtins, 'print') as print_mock:
+                    sops.stats_main([])
+                lines = [c[0][0] for c in print_mock.call_args_list]
+                assert lines[2].endswith('kms:arn+role')
+                assert lines[3].endswith('pgp:fp')
+                sops.stats_main(['--reset'])
+            assert sops.MasterKeyStats(path).records() == {}
+        finally:
+            shutil.rmtree(tmpdir)
+        with mock.patch.dict(os.environ, XDG_CACHE_HOME='/cache'):
+            assert sops.stats_path() == '/cache/sops/master_keys.json'
+
     def test_encrypt_key_with_kms(self):
         """Test KMS encryption."""
 
@@ -270,3 +1631,41 @@ class TreeTest(unittest2.TestCase):
         assert ntree == tree["example"]["nested"]["values"]
         ntree = sops.truncate_tree(dict(tree), '["example_array"][1]')
         assert ntree == tree["example_array"][1]
+
+    def test_import_defers_boto3_and_yaml(self):
+        """Importing sops doesn't import boto3 or ruamel.yaml"""
+        code = ("import sys, sops; "
+                "print(' '.join(m for m in ('boto3', 'ruamel.yaml') "
+                "if m in sys.modules))")
+        root = os.path.join(os.path.dirname(__file__), '..')
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+        assert out.strip() == b''
+
+    def test_commands_give_way_to_files_of_their_name(self):
+        """`sops agent` and `sops stats` run their command, unless a file
+        of that name is in the current directory"""
+        tmpdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(tmpdir)
+        try:
+            for name in ['agent', 'stats']:
+                with mock.patch.object(sys, 'argv', ['sops', name, '-t', '5']):
+                    assert sops._is_command(name)
+                    open(name, 'w').close()
+                    assert not sops._is_command(name)
+                with mock.patch.object(sys, 'argv', ['sops', '--', name]):
+                    assert not sops._is_command(name)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+
+    def test_script_mode_imports_submodules(self):
+        """sops/__init__.py run as a script can import sops.agent"""
+        script = os.path.join(os.path.dirname(__file__), '..', 'sops',
+                              '__init__.py')
+        devnull = open(os.devnull, 'w')
+        self.addCleanup(devnull.close)
+        out = subprocess.check_output([sys.executable, script, 'agent', '-h'],
+                                      cwd=tempfile.gettempdir(),
+                                      stderr=devnull)
+        assert b'sops agent' in out